@@ -0,0 +1,412 @@
+"""Benchmarks for measuring performance without hardware.
+
+Usage from command line:
+    python benchmark.py eyetracker RECORDING [--pupil-method METHOD]
+                                             [--blink-method METHOD]
+                                             [--memory]
+    python benchmark.py filters [--samples SAMPLES]
+    python benchmark.py ble [--mode MODE] [--rate RATE] [--seconds SECONDS]
+                            [--extended]
+    python benchmark.py serial [--rate RATE] [--seconds SECONDS]
+
+eyetracker -- Push a recording (see recording.py) through the eye
+    tracking pipeline and report frame rate and time spent in each
+    stage (take_snapshot, detect_blink, track_pupil and draw). With
+    --memory, memory allocated for each frame is measured with
+    tracemalloc instead, which slows the pipeline down.
+filters -- Run each filter stage (see filters.py) on a noisy signal
+    sampled at 1 kHz, and report time per sample and how far the output
+    is from the signal without noise.
+ble -- Send drive commands at a fixed rate through BLEHelper to a
+    simulated wheelchair (see ble_simulator.py), and report how many
+    were written and how long writing took. Modes are request (write
+    with response), command (write without response) and socket (write
+    without response through AcquireWrite socket). With --extended,
+    commands are sent in the extended format and round-trip time of
+    acknowledgements is reported too. Needs pydbus and python3-gi.
+serial -- Change the command at a fixed rate through WheelchairSerial
+    with a pseudo-terminal pair standing in for the Arduino, and report
+    how long each command took to arrive there. Linux only.
+"""
+
+import sys
+import time
+import argparse
+import tracemalloc
+
+import numpy as np
+
+# Stages of the eye tracking pipeline, in the order they are run.
+EYETRACKER_STAGES = ('take_snapshot', 'detect_blink', 'track_pupil', 'draw')
+# Filter stages benchmarked, with parameters for the test signal.
+FILTER_CONFIGS = (
+    {'type': 'moving_average', 'size': 4},
+    {'type': 'ema', 'alpha': 0.1},
+    {'type': 'one_euro', 'min_cutoff': 1.0, 'beta': 0.05},
+    {'type': 'median', 'size': 5},
+    {'type': 'dead_zone', 'width': 10},
+    {'type': 'rate_limiter', 'accelerate': 500},
+    {'type': 'hysteresis', 'width': 5},
+    )
+# Ways of writing BLE commands benchmarked.
+BLE_MODES = ('request', 'command', 'socket')
+# Simulated round trip of a BLE write with response and of a D-Bus
+# method call (seconds).
+BLE_WRITE_DELAY = 0.03
+BLE_COMMAND_DELAY = 0.001
+# Samples timed together, since timing a single call costs about as
+# much as the call.
+FILTER_BATCH = 1000
+
+
+# Units durations can be reported in, with their scale from seconds.
+UNITS = {'ms': 1e3, 'us': 1e6}
+
+
+def report(title, frames, total_time, times, unit='ms', item='frames'):
+    """Print processing rate and percentiles of stage durations.
+
+    Arguments:
+    title -- Name of the benchmark (str).
+    frames -- Number of frames processed (int).
+    total_time -- Seconds used for processing all frames (float).
+    times -- Dictionary of stage name and list of stage durations in
+        seconds.
+    unit -- Unit of durations printed, one of UNITS (str).
+    item -- What was processed, printed with the count (str).
+    """
+    print(title)
+    if frames == 0 or total_time <= 0:
+        print('  No {} processed'.format(item))
+        return
+    print('  {} {}, {:.1f} {}/s'.format(frames, item, frames/total_time, item))
+    print('  {:<16}{:>10}{:>10}{:>10}{:>10}'.format(
+        'stage', 'mean ' + unit, 'p50 ' + unit, 'p95 ' + unit, 'p99 ' + unit))
+    for stage, durations in times.items():
+        if not durations:
+            continue
+        scaled = np.array(durations)*UNITS[unit]
+        p50, p95, p99 = np.percentile(scaled, [50, 95, 99])
+        print('  {:<16}{:>10.2f}{:>10.2f}{:>10.2f}{:>10.2f}'.format(
+            stage, scaled.mean(), p50, p95, p99))
+
+
+def benchmark_eyetracker(recording, pupil_method='sweep', blink_method='erode',
+                         search_timeout=10.0, memory=False):
+    """Run eye tracking pipeline for every frame of a recording.
+
+    The eye is searched from the start of the recording first, and the
+    frames after it are used for the benchmark.
+
+    Eyetracker.allocations counts only the buffers it manages. With
+    memory set, everything allocated through Python and numpy,
+    including arrays OpenCV returns, is traced with tracemalloc, and
+    the peak above the memory in use before each frame is reported.
+
+    Arguments:
+    recording -- Path of the recording without file extension (str).
+    pupil_method -- Method for finding the pupil, see
+        eyetracker.PUPIL_METHODS (str).
+    blink_method -- Method for detecting blinks, see
+        eyetracker.BLINK_METHODS (str).
+    search_timeout -- Seconds to search for the eye (float).
+    memory -- Measure memory allocated for each frame (bool).
+
+    Returns tuple (frames, total_time, times, stats) where the first
+    three are for report. stats has the number of managed buffers
+    allocated while tracking, and with memory set the bytes allocated
+    for each frame.
+    """
+    from eyetracker import Eyetracker
+    from recording import ReplayCapture
+
+    tracker = Eyetracker(ReplayCapture(recording, realtime=False), threaded=False)
+    tracker.set_options(pupil_method=pupil_method, blink_method=blink_method)
+    if not tracker.get_bounding_rectangle(timeout=search_timeout):
+        print('No eye found from the recording')
+        return 0, 0.0, {}
+
+    times = {stage: [] for stage in EYETRACKER_STAGES}
+    allocations = tracker.allocations
+    frame_bytes = []
+    if memory:
+        tracemalloc.start()
+    frames = 0
+    total_start = time.perf_counter()
+    while True:
+        if memory:
+            tracemalloc.reset_peak()
+            in_use = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        if not tracker.take_snapshot():
+            break
+        times['take_snapshot'].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        blink = tracker.detect_blink()
+        times['detect_blink'].append(time.perf_counter() - start)
+
+        if not blink:
+            start = time.perf_counter()
+            tracker.track_pupil()
+            times['track_pupil'].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        tracker.draw()
+        times['draw'].append(time.perf_counter() - start)
+        if memory:
+            frame_bytes.append(tracemalloc.get_traced_memory()[1] - in_use)
+        frames += 1
+    total_time = time.perf_counter() - total_start
+    if memory:
+        tracemalloc.stop()
+    stats = {
+        'buffers_allocated': tracker.allocations - allocations,
+        'frame_bytes': frame_bytes,
+        }
+    tracker.release()
+    return frames, total_time, times, stats
+
+
+def benchmark_filter(config, samples=100000, rate=1000.0):
+    """Run a filter on a noisy signal.
+
+    Samples are timed in batches of FILTER_BATCH, and the durations
+    are per sample.
+
+    The signal is a 0.5 Hz sine wave of amplitude 100 with normally
+    distributed noise of standard deviation 5.
+
+    Arguments:
+    config -- Filter chain configuration, see filters.FilterChain.
+    samples -- Number of samples (int).
+    rate -- Sampling rate (Hz).
+
+    Returns tuple (frames, total_time, times, error) where the first
+    three are for report and error is the RMS difference of output and
+    the signal without noise.
+    """
+    from filters import FilterChain
+
+    chain = FilterChain.from_config(config)
+    timestamps = np.arange(samples) / rate
+    clean = 100*np.sin(2*np.pi*0.5*timestamps)
+    noisy = (clean + np.random.default_rng(0).normal(0, 5, samples)).tolist()
+    timestamps = timestamps.tolist()
+
+    output = []
+    times = {'per sample': []}
+    total_start = time.perf_counter()
+    for start in range(0, samples, FILTER_BATCH):
+        end = min(samples, start + FILTER_BATCH)
+        batch_start = time.perf_counter()
+        for i in range(start, end):
+            output.append(chain(noisy[i], timestamps[i]))
+        times['per sample'].append((time.perf_counter() - batch_start) / (end - start))
+    total_time = time.perf_counter() - total_start
+    error = float(np.sqrt(np.mean((np.array(output) - clean)**2)))
+    return samples, total_time, times, error
+
+
+def benchmark_ble(mode, rate=50.0, seconds=5.0, extended=False):
+    """Send drive commands to a simulated wheelchair.
+
+    Arguments:
+    mode -- How commands are written, one of BLE_MODES (str).
+    rate -- Commands given per second (float).
+    seconds -- Length of the benchmark (float).
+    extended -- Send commands in the extended format (bool).
+
+    Returns tuple (frames, total_time, times, stats) where the first
+    three are for report and stats is from BLEHelper.write_stats and
+    BLEHelper.link_stats.
+    """
+    from ble_simulator import SimulatedPeripheral, FakeBus, SERVICE_UUID, \
+        DRIVE_UUID, COMMAND_UUID, ACK_UUID
+    from bluez_dbus import BLEHelper
+
+    address = '00:00:00:00:00:01'
+    peripheral = SimulatedPeripheral(
+        address, flags=('read', 'write', 'write-without-response'),
+        write_delay=BLE_WRITE_DELAY, command_delay=BLE_COMMAND_DELAY,
+        extended=extended, ack_delay=BLE_COMMAND_DELAY)
+    helper = BLEHelper('hci0', address, DRIVE_UUID, bus=FakeBus(peripheral),
+                       service_uuid=SERVICE_UUID,
+                       write_without_response=mode != 'request',
+                       acquire_write=mode == 'socket',
+                       command_uuid=COMMAND_UUID, ack_uuid=ACK_UUID)
+    helper.bt_connect()
+
+    period = 1.0 / rate
+    start = time.monotonic()
+    due = start
+    count = 0
+    while due < start + seconds:
+        helper.write_characteristic([128 + count % 100, 128])
+        count += 1
+        due += period
+        time.sleep(max(0.0, due - time.monotonic()))
+    # Let the last write finish.
+    time.sleep(2*BLE_WRITE_DELAY)
+    total_time = time.monotonic() - start
+    stats = helper.write_stats()
+    stats.update(helper.link_stats())
+    times = {'write': list(helper.writer.latencies)}
+    if extended:
+        times['round trip'] = list(helper.link.rtts)
+    helper.bt_disconnect()
+    return len(peripheral.writes), total_time, times, stats
+
+
+def benchmark_serial(rate=50.0, seconds=5.0):
+    """Send drive commands to a pseudo-terminal through WheelchairSerial.
+
+    The other end of the pseudo-terminal parses frames like the
+    Arduino does.
+
+    Arguments:
+    rate -- Commands given per second (float).
+    seconds -- Length of the benchmark (float).
+
+    Returns tuple (frames, total_time, times, stats) where the first
+    three are for report and stats is from WheelchairSerial.write_stats.
+    """
+    import os
+    import tty
+    import threading
+    from wheelchair_serial import WheelchairSerial, FrameParser
+
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    wheelchair = WheelchairSerial(port=os.ttyname(slave))
+    wheelchair.connect_chair()
+
+    parser = FrameParser()
+    given = {}
+    latencies = []
+    frames = []
+    done = threading.Event()
+
+    def receive():
+        previous = None
+        while not done.is_set():
+            try:
+                data = os.read(master, 4096)
+            except OSError:
+                return
+            now = time.monotonic()
+            for cmd in parser.feed(data):
+                frames.append(cmd)
+                if cmd != previous and cmd in given:
+                    latencies.append(now - given[cmd])
+                previous = cmd
+
+    receiver = threading.Thread(target=receive, daemon=True)
+    receiver.start()
+
+    period = 1.0 / rate
+    start = time.monotonic()
+    due = start
+    count = 0
+    while due < start + seconds:
+        cmd = [1 + count % 254, 128]
+        given[tuple(cmd)] = time.monotonic()
+        wheelchair.drive, wheelchair.turn = cmd
+        wheelchair.write()
+        count += 1
+        due += period
+        time.sleep(max(0.0, due - time.monotonic()))
+    total_time = time.monotonic() - start
+    stats = wheelchair.write_stats()
+    stats['parse_errors'] = parser.dropped
+    wheelchair.disconnect_chair()
+    done.set()
+    os.close(slave)
+    os.close(master)
+    return len(frames), total_time, {'arrival': latencies}, stats
+
+
+def main():
+    """Run benchmarks from command line."""
+    parser = argparse.ArgumentParser(description='Run performance benchmarks.')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    eye_parser = subparsers.add_parser(
+        'eyetracker', help='eye tracking pipeline with a recording')
+    eye_parser.add_argument('recording', help='path of the recording without extension')
+    eye_parser.add_argument('--pupil-method', default=None,
+                            help='pupil method to benchmark (default: all)')
+    eye_parser.add_argument('--blink-method', default=None,
+                            help='blink method to benchmark (default: all)')
+    eye_parser.add_argument('--memory', action='store_true',
+                            help='measure memory allocated for each frame')
+
+    filter_parser = subparsers.add_parser(
+        'filters', help='filter stages with a synthetic signal')
+    filter_parser.add_argument('--samples', type=int, default=100000,
+                               help='number of samples (default: 100000)')
+
+    ble_parser = subparsers.add_parser(
+        'ble', help='BLE writes to a simulated wheelchair')
+    ble_parser.add_argument('--mode', default=None,
+                            help='write mode to benchmark (default: all)')
+    ble_parser.add_argument('--rate', type=float, default=50.0,
+                            help='commands per second (default: 50)')
+    ble_parser.add_argument('--seconds', type=float, default=5.0,
+                            help='length of the benchmark (default: 5)')
+    ble_parser.add_argument('--extended', action='store_true',
+                            help='send commands in the extended format')
+
+    serial_parser = subparsers.add_parser(
+        'serial', help='serial writes to a pseudo-terminal')
+    serial_parser.add_argument('--rate', type=float, default=50.0,
+                               help='command changes per second (default: 50)')
+    serial_parser.add_argument('--seconds', type=float, default=5.0,
+                               help='length of the benchmark (default: 5)')
+
+    args = parser.parse_args()
+
+    if args.benchmark == 'eyetracker':
+        from eyetracker import PUPIL_METHODS, BLINK_METHODS
+        pupil_methods = [args.pupil_method] if args.pupil_method else PUPIL_METHODS
+        blink_methods = [args.blink_method] if args.blink_method else BLINK_METHODS
+        for pupil_method in pupil_methods:
+            for blink_method in blink_methods:
+                frames, total_time, times, stats = benchmark_eyetracker(
+                    args.recording, pupil_method, blink_method, memory=args.memory)
+                report('Eye tracker, pupil method {}, blink method {}'.format(
+                    pupil_method, blink_method), frames, total_time, times)
+                print('  {} managed buffers allocated while tracking'.format(
+                    stats['buffers_allocated']))
+                if stats['frame_bytes']:
+                    kilobytes = np.array(stats['frame_bytes']) / 1024
+                    print('  allocated per frame: mean {:.1f} kB, max {:.1f} kB'.format(
+                        kilobytes.mean(), kilobytes.max()))
+    elif args.benchmark == 'filters':
+        for config in FILTER_CONFIGS:
+            samples, total_time, times, error = benchmark_filter([config], args.samples)
+            report('Filter {}'.format(config['type']), samples, total_time, times,
+                   unit='us', item='samples')
+            print('  RMS error {:.2f} (noise 5.00)'.format(error))
+    elif args.benchmark == 'ble':
+        modes = [args.mode] if args.mode else BLE_MODES
+        for mode in modes:
+            received, total_time, times, stats = benchmark_ble(
+                mode, args.rate, args.seconds, args.extended)
+            report('BLE, {} writes at {:.0f} commands/s'.format(mode, args.rate),
+                   received, total_time, times, item='commands')
+            print('  {} coalesced, {} errors'.format(stats['coalesced'], stats['errors']))
+            if args.extended:
+                print('  {} acknowledged, {} lost, {} reordered'.format(
+                    stats['acked'], stats['lost'], stats['reordered']))
+    elif args.benchmark == 'serial':
+        received, total_time, times, stats = benchmark_serial(args.rate, args.seconds)
+        report('Serial, command changed {:.0f} times/s'.format(args.rate),
+               received, total_time, times, item='frames')
+        print('  {} coalesced, {} dropped, {} parse errors'.format(
+            stats['coalesced'], stats['dropped'], stats['parse_errors']))
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,409 @@
+"""Eye tracking with two cameras, one for each eye.
+
+Both eyes are tracked with their own Eyetracker, each in a worker
+thread of its own. OpenCV releases the GIL while processing images, so
+the two eyes are processed at the same time and tracking both takes
+about as long as tracking one.
+
+Results of the eyes are matched by capture time of the frames and
+fused into one result: pupil offsets from the calibrated centers are
+averaged, which halves the noise of independent measurements, and the
+user blinks only when both eyes are shut.
+"""
+
+import queue
+import threading
+import collections
+from concurrent.futures import Future
+
+import numpy as np
+
+from PySide2.QtCore import QObject, Signal
+
+from eyetracker import Eyetracker
+from cameras import list_cameras
+
+# Largest difference in capture time of the frames fused (seconds).
+# Unsynchronized cameras at 30 fps are at most half a frame apart.
+MAX_SKEW = 0.02
+# Number of results kept from each eye for matching.
+RESULT_HISTORY = 4
+# Seconds to wait for the workers to change settings or calibrate.
+WORKER_TIMEOUT = 5.0
+# Images copied from the eyes for showing.
+IMAGES = ('result_pic', 'pupil_pic', 'blink_pic')
+
+
+class _EyeWorker:
+    """Track one eye in a worker thread.
+
+    The thread owns the Eyetracker. Other threads use it only through
+    submit, which runs a function between frames.
+
+    Arguments:
+    tracker -- Eyetracker of the eye.
+    cond -- Condition notified when a new result is ready.
+    """
+
+    def __init__(self, tracker, cond):
+        self.tracker = tracker
+        self.results = collections.deque(maxlen=RESULT_HISTORY)
+        self.preview = True
+        self.images = {name: None for name in IMAGES}
+        self.image_lock = threading.Lock()
+
+        self._cond = cond
+        self._calls = queue.Queue()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, func, *args):
+        """Run func(tracker, *args) in the worker thread.
+
+        Returns concurrent.futures.Future of the result.
+        """
+        future = Future()
+        self._calls.put((future, func, args))
+        return future
+
+    def stop(self):
+        """Stop the worker thread and release the camera."""
+        self._stop.set()
+        self._thread.join()
+        self.tracker.release()
+
+    def _run_calls(self, timeout):
+        """Run functions submitted, waiting at most timeout for one."""
+        try:
+            call = self._calls.get(timeout=timeout)
+        except queue.Empty:
+            return
+        while True:
+            future, func, args = call
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(func(self.tracker, *args))
+                except Exception as err:
+                    future.set_exception(err)
+            try:
+                call = self._calls.get_nowait()
+            except queue.Empty:
+                return
+
+    def _run(self):
+        """Track the eye in each new frame."""
+        tracker = self.tracker
+        while not self._stop.is_set():
+            if tracker.eye_rec is None:
+                # Nothing to track before the eye is found.
+                self._run_calls(0.1)
+                continue
+            self._run_calls(0)
+            if not tracker.take_snapshot(timeout=0.1):
+                continue
+            blink = tracker.detect_blink()
+            if not blink:
+                tracker.track_pupil()
+            if self.preview:
+                tracker.draw()
+                self._copy_images()
+            result = {
+                'frame_time': tracker.frame_time,
+                'center': tracker.center,
+                'pupil': tracker.pupil,
+                'pupil_smoothed': tracker.pupil_smoothed,
+                'pupil_confidence': tracker.pupil_confidence,
+                'blink': blink,
+                }
+            with self._cond:
+                self.results.append(result)
+                self._cond.notify_all()
+
+    def _copy_images(self):
+        """Copy images drawn to arrays shown by the UI thread."""
+        with self.image_lock:
+            for name in IMAGES:
+                src = getattr(self.tracker, name)
+                if src is None:
+                    continue
+                dst = self.images[name]
+                if dst is None or dst.shape != src.shape:
+                    dst = np.empty_like(src)
+                    self.images[name] = dst
+                np.copyto(dst, src)
+
+
+class BinocularTracker(QObject):
+    """Track both eyes with two cameras.
+
+    Has the same interface as Eyetracker for EyeTrackerController.
+    take_snapshot fuses the newest results of the eyes whose frames
+    were captured at most MAX_SKEW apart. center and pupil are averages
+    of the eyes, so that center minus pupil is the average offset of
+    the pupils. An eye shut alone is left out of the average, and only
+    both eyes shut is a blink. If the eye has been found for only one
+    camera, its results are used alone.
+
+    detect_blink returns the fused blink, and track_pupil and draw do
+    nothing but combine the images of the eyes, since the eyes are
+    tracked in the worker threads.
+
+    Arguments:
+    cameras -- Indices of the cameras of the eyes in self.cams
+        (tuple of two ints).
+    sources -- Objects used instead of cameras, see Eyetracker
+        (tuple of two).
+    """
+    eyeChanged = Signal()
+    eyeSearchProgress = Signal(int, float)
+    eyeSearchFailed = Signal(str)
+
+    def __init__(self, cameras=(0, 1), sources=None):
+        super().__init__()
+        self._cond = threading.Condition()
+        if sources is None:
+            self.cams = list_cameras()
+            trackers = [Eyetracker(camera=num) for num in cameras]
+        else:
+            self.cams = []
+            trackers = [Eyetracker(source) for source in sources]
+        self.cameras = list(cameras)
+        self.eyes = [_EyeWorker(tracker, self._cond) for tracker in trackers]
+
+        self.center = (0, 0)
+        self.pupil = (0, 0)
+        self.pupil_smoothed = (0, 0)
+        self.pupil_confidence = 0.0
+        self.pupil_tracking = False
+        self.blink = False
+        self.frame_time = 0.0
+        self.skew = 0.0
+        self.frames_fused = 0
+        self.frames_unmatched = 0
+        # Capture time of the newest result counted as unmatched.
+        self._unmatched_time = 0.0
+
+        self.eye_pic = None
+        self.pupil_pic = None
+        self.blink_pic = None
+        self.result_pic = None
+
+        self._search_cancel = None
+        self._search_pending = 0
+        self._search_found = []
+        self._search_failed = False
+        self._search_lock = threading.Lock()
+
+    def release(self):
+        """Stop tracking and release the cameras."""
+        self.cancel_find_eye()
+        for eye in self.eyes:
+            eye.stop()
+
+    def _call_all(self, func, *args):
+        """Run func in the worker of each eye and wait for the results.
+
+        Returns list of results, or None if func raised an exception
+        or did not finish in WORKER_TIMEOUT seconds in some worker.
+        """
+        return self._wait([eye.submit(func, *args) for eye in self.eyes])
+
+    @staticmethod
+    def _wait(futures):
+        """Wait for results of futures, see _call_all."""
+        try:
+            return [future.result(WORKER_TIMEOUT) for future in futures]
+        except Exception as err:
+            print('Eye tracker worker failed: {!r}'.format(err))
+            return None
+
+    def set_options(self, **options):
+        """Set options for tracking both eyes, see Eyetracker.set_options."""
+        self._call_all(lambda tracker: tracker.set_options(**options))
+        if 'pupil_tracking' in options:
+            self.pupil_tracking = bool(options['pupil_tracking'])
+
+    def set_preview(self, enabled):
+        """Enable or disable drawing images of the eyes.
+
+        Arguments:
+        enabled -- Draw images for preview (bool).
+        """
+        for eye in self.eyes:
+            eye.preview = enabled
+
+    def select_camera(self, num, eye=0):
+        """Select camera to use for an eye.
+
+        Arguments:
+        num -- Index for the camera to use.
+        eye -- Index of the eye, 0 or 1.
+
+        Returns True if the camera was selected.
+        """
+        self.cameras[eye] = num
+        return self._wait(
+            [self.eyes[eye].submit(lambda tracker: tracker.select_camera(num))]) is not None
+
+    def find_eye_async(self, timeout=None):
+        """Find both eyes in the background.
+
+        The eyes are searched at the same time. Emits eyeChanged when
+        both are found and eyeSearchFailed if either of them is not.
+
+        Arguments:
+        timeout -- Seconds to search before giving up. None searches
+            until the eyes are found (float).
+        """
+        if self.is_searching():
+            return
+        cancel = threading.Event()
+        self._search_cancel = cancel
+        self._search_pending = len(self.eyes)
+        self._search_found = [False] * len(self.eyes)
+        self._search_failed = False
+        for num, eye in enumerate(self.eyes):
+            progress = (lambda attempts, elapsed: self.eyeSearchProgress.emit(attempts, elapsed)) \
+                if num == 0 else None
+            future = eye.submit(
+                lambda tracker, progress=progress: tracker.get_bounding_rectangle(
+                    cancel, timeout, progress, near_last=True))
+            future.add_done_callback(
+                lambda future, num=num: self._search_done(num, future, cancel, timeout))
+
+    def _search_done(self, num, future, cancel, timeout):
+        """Handle end of eye search of one eye, in its worker thread."""
+        found = future.exception() is None and future.result()
+        with self._search_lock:
+            self._search_found[num] = found
+            self._search_pending -= 1
+            if not found and not self._search_failed:
+                # No use searching for the other eye.
+                self._search_failed = True
+                if cancel.is_set():
+                    reason = 'Eye search cancelled'
+                else:
+                    reason = 'No eye {} found in {} seconds'.format(num + 1, timeout)
+                cancel.set()
+                self.eyeSearchFailed.emit(reason)
+            if self._search_pending > 0 or self._search_failed:
+                return
+        self.eye_pic = self._combine([eye.tracker.eye_pic for eye in self.eyes])
+        self.eyeChanged.emit()
+
+    def cancel_find_eye(self):
+        """Cancel eye search running in background."""
+        if self._search_cancel is not None:
+            self._search_cancel.set()
+
+    def is_searching(self):
+        """Return True if eye search is running in background."""
+        return self._search_pending > 0
+
+    def calibrate(self):
+        """Calibrate both eyes looking forward, see Eyetracker.calibrate.
+
+        Returns True if both eyes were calibrated.
+        """
+        results = self._call_all(lambda tracker: tracker.calibrate())
+        return results is not None and all(results)
+
+    def take_snapshot(self, timeout=None):
+        """Fuse the newest results of the eyes.
+
+        Arguments:
+        timeout -- Seconds to wait for a new result. None waits until
+            there is one and 0 does not wait at all (float).
+
+        Returns True if there was a new result, False otherwise.
+        """
+        with self._cond:
+            fused = self._cond.wait_for(self._fuse, timeout)
+        return bool(fused)
+
+    def _fuse(self):
+        """Fuse newest matching results of the eyes if there are new ones.
+
+        Called with self._cond held. Returns True if a new result was
+        fused.
+        """
+        tracked = [eye for eye in self.eyes if eye.tracker.eye_rec is not None]
+        if not tracked or any(not eye.results for eye in tracked):
+            return False
+        if len(tracked) == 1:
+            results = [tracked[0].results[-1]]
+        else:
+            results = self._match(tracked[0].results, tracked[1].results)
+            if results is None:
+                return False
+        frame_time = max(result['frame_time'] for result in results)
+        if frame_time <= self.frame_time:
+            return False
+        self.frame_time = frame_time
+        self.skew = abs(results[0]['frame_time'] - results[-1]['frame_time'])
+        self.frames_fused += 1
+
+        self.blink = all(result['blink'] for result in results)
+        open_eyes = [result for result in results if not result['blink']] or results
+        self.center = self._mean(result['center'] for result in open_eyes)
+        self.pupil = self._mean(result['pupil'] for result in open_eyes)
+        self.pupil_smoothed = self._mean(result['pupil_smoothed'] for result in open_eyes)
+        self.pupil_confidence = min(result['pupil_confidence'] for result in open_eyes)
+        return True
+
+    def _match(self, left, right):
+        """Find the newest pair of results captured at most MAX_SKEW apart.
+
+        Arguments:
+        left, right -- Results of the eyes, oldest first.
+
+        Returns the pair as a list, or None if there is no new pair.
+        """
+        for result in reversed(left):
+            if result['frame_time'] <= self.frame_time:
+                break
+            nearest = min(right, key=lambda other: abs(other['frame_time'] - result['frame_time']))
+            if abs(nearest['frame_time'] - result['frame_time']) <= MAX_SKEW:
+                return [result, nearest]
+        newest = left[-1]['frame_time']
+        if (newest > max(self.frame_time, self._unmatched_time)
+                and right[-1]['frame_time'] > self.frame_time):
+            # Both eyes have new results, but they do not match. Count
+            # each result once, not on every poll.
+            self.frames_unmatched += 1
+            self._unmatched_time = newest
+        return None
+
+    @staticmethod
+    def _mean(points):
+        """Return average of points as tuple (x, y)."""
+        points = list(points)
+        return (sum(point[0] for point in points) / len(points),
+                sum(point[1] for point in points) / len(points))
+
+    def detect_blink(self):
+        """Return blink of both eyes fused by take_snapshot."""
+        return self.blink
+
+    def track_pupil(self):
+        """Pupils are tracked by the workers, does nothing."""
+        return True
+
+    def draw(self):
+        """Combine images of the eyes side by side for showing."""
+        for name in IMAGES:
+            images = []
+            for eye in self.eyes:
+                with eye.image_lock:
+                    image = eye.images[name]
+                    images.append(None if image is None else image.copy())
+            setattr(self, name, self._combine(images))
+
+    @staticmethod
+    def _combine(images):
+        """Return images side by side, or None if any of them is missing."""
+        if any(image is None for image in images):
+            return None
+        height = min(image.shape[0] for image in images)
+        return np.ascontiguousarray(np.hstack([image[:height] for image in images]))
@@ -0,0 +1,471 @@
+"""Simulated BlueZ and wheelchair for running Bluetooth code without hardware.
+
+FakeBus can be given to bluez_dbus.BLEHelper instead of the system bus.
+It answers the D-Bus calls BLEHelper makes like bluetoothd would, for
+one simulated wheelchair peripheral (SimulatedPeripheral). Commands
+written to the peripheral are recorded with their arrival time.
+
+AcquireWrite hands out one end of a socket pair, like bluetoothd does
+for characteristics supporting write without response, and the
+peripheral reads commands from the other end.
+
+With extended set, the peripheral also has the command and
+acknowledgement characteristics of the extended format (see
+link_stats.py), and acknowledges each command written to the command
+characteristic by notifying.
+
+Losing the link is simulated by setting in_range False and calling
+disconnect, which signals the Connected property changing like BlueZ.
+
+pydbus and python3-gi are needed like for BLEHelper itself.
+"""
+
+import os
+import time
+import socket
+import threading
+
+from gi.repository import Gio, GLib
+
+# UUIDs of the wheelchair service and characteristics in the firmware.
+SERVICE_UUID = '19b10000-e8f2-537e-4f6c-d104768a1214'
+DRIVE_UUID = 'c1594143-f449-4dbe-855d-2d4c85a1ac88'
+COMMAND_UUID = 'c1594144-f449-4dbe-855d-2d4c85a1ac88'
+ACK_UUID = 'c1594145-f449-4dbe-855d-2d4c85a1ac88'
+
+GATT_CHARACTERISTIC = 'org.bluez.GattCharacteristic1'
+
+def _bluez_error(name, message):
+    """Return GLib.Error like one from bluetoothd.
+
+    Domain and code are those of D-Bus errors from Gio, so str of the
+    error matches what BLEHelper compares with.
+    """
+    return GLib.Error.new_literal(
+        Gio.io_error_quark(),
+        'GDBus.Error:org.bluez.Error.{}: {}'.format(name, message),
+        Gio.IOErrorEnum.DBUS_ERROR)
+
+
+class SimulatedPeripheral:
+    """Wheelchair peripheral seen through simulated BlueZ.
+
+    Arguments:
+    address -- Bluetooth address of the peripheral (str).
+    adapter -- Name of the Bluetooth adapter (str).
+    flags -- Flags of the drive characteristic (list of str).
+    write_delay -- Seconds a WriteValue call takes, like the round
+        trip of a write with response (float).
+    command_delay -- Seconds a WriteValue call without response takes,
+        like the D-Bus round trip to bluetoothd (float).
+    mtu -- MTU given with AcquireWrite (int).
+    advertising_interval -- Seconds from starting discovery until the
+        peripheral is found (float).
+    extended -- Have the characteristics of the extended format (bool).
+    ack_delay -- Seconds from receiving a command to notifying its
+        acknowledgement (float).
+    """
+
+    def __init__(self, address, adapter='hci0', flags=('read', 'write'),
+                 write_delay=0.0, command_delay=0.0, mtu=23,
+                 advertising_interval=0.1, extended=False, ack_delay=0.0):
+        self.address = address
+        self.advertising_interval = advertising_interval
+        self.flags = list(flags)
+        self.write_delay = write_delay
+        self.command_delay = command_delay
+        self.mtu = mtu
+        self.extended = extended
+        self.ack_delay = ack_delay
+
+        self.adapter_path = '/org/bluez/' + adapter
+        self.device_path = self.adapter_path + '/dev_' + address.replace(':', '_')
+        self.service_path = self.device_path + '/service000a'
+        self.characteristic_path = self.service_path + '/char000b'
+        self.command_path = self.service_path + '/char000d'
+        self.ack_path = self.service_path + '/char000f'
+
+        self.discovered = False
+        self.discovering = False
+        self.discovery_filter = {}
+        self.connected = False
+        # Connecting fails while out of range.
+        self.in_range = True
+        self.interfaces_added = DBusSignal()
+        self.properties_changed = DBusSignal()
+        self.ack_changed = DBusSignal()
+        self.notifying = False
+        self.value = b''
+        # Commands received as (arrival time, bytes).
+        self.writes = []
+        self._lock = threading.Lock()
+        self._sockets = []
+
+    def managed_objects(self):
+        """Return objects like org.freedesktop.DBus.ObjectManager does."""
+        objects = {
+            self.adapter_path: {
+                'org.bluez.Adapter1': {'Discovering': False},
+                },
+            }
+        if self.discovered:
+            objects[self.device_path] = {
+                'org.bluez.Device1': {
+                    'Address': self.address,
+                    'Connected': self.connected,
+                    'UUIDs': [SERVICE_UUID],
+                    },
+                }
+        if self.connected:
+            objects[self.service_path] = {
+                'org.bluez.GattService1': {
+                    'UUID': SERVICE_UUID,
+                    'Device': self.device_path,
+                    'Primary': True,
+                    },
+                }
+            objects[self.characteristic_path] = {
+                GATT_CHARACTERISTIC: {
+                    'UUID': DRIVE_UUID,
+                    'Service': self.service_path,
+                    'Flags': list(self.flags),
+                    },
+                }
+            if self.extended:
+                objects[self.command_path] = {
+                    GATT_CHARACTERISTIC: {
+                        'UUID': COMMAND_UUID,
+                        'Service': self.service_path,
+                        'Flags': [flag for flag in self.flags if flag != 'read'],
+                        },
+                    }
+                objects[self.ack_path] = {
+                    GATT_CHARACTERISTIC: {
+                        'UUID': ACK_UUID,
+                        'Service': self.service_path,
+                        'Flags': ['read', 'notify'],
+                        },
+                    }
+        return objects
+
+    def start_discovery(self):
+        """Find the peripheral after one advertising interval.
+
+        Only if discovery filter allows it, like BlueZ does.
+        """
+        if self.discovering:
+            raise _bluez_error('InProgress', 'Operation already in progress')
+        self.discovering = True
+        uuids = self.discovery_filter.get('UUIDs')
+        if uuids is not None and SERVICE_UUID not in _unpack(uuids):
+            return
+        timer = threading.Timer(self.advertising_interval, self._advertisement)
+        timer.daemon = True
+        timer.start()
+
+    def _advertisement(self):
+        """Add the peripheral when its advertisement is received."""
+        if not self.discovering or self.discovered:
+            return
+        self.discovered = True
+        self.interfaces_added.emit(
+            self.device_path, self.managed_objects()[self.device_path])
+
+    def receive(self, data, path=None):
+        """Record a command written to the drive or command characteristic.
+
+        Commands to the command characteristic are acknowledged.
+        """
+        with self._lock:
+            self.value = bytes(data)
+            self.writes.append((time.monotonic(), bytes(data)))
+        if path == self.command_path and len(data) >= 8 and self.notifying:
+            ack = bytes(data[2:8])
+            if self.ack_delay > 0:
+                timer = threading.Timer(self.ack_delay, self._acknowledge, args=(ack,))
+                timer.daemon = True
+                timer.start()
+            else:
+                self._acknowledge(ack)
+
+    def _acknowledge(self, ack):
+        """Notify acknowledgement like BlueZ signals a notification."""
+        if self.connected and self.notifying:
+            self.ack_changed.emit(GATT_CHARACTERISTIC, {'Value': list(ack)}, [])
+
+    def acquire_write(self, path):
+        """Create socket pair for writing to characteristic at path.
+
+        See FakeBus.con.
+
+        Returns file descriptor of the socket for the writer.
+        """
+        if 'write-without-response' not in self.flags:
+            raise _bluez_error('NotSupported', 'Operation is not supported')
+        if not self.connected:
+            raise _bluez_error('Failed', 'Not connected')
+        writer, reader = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self._sockets.append(reader)
+        threading.Thread(target=self._read_socket, args=(reader, path), daemon=True).start()
+        return writer.detach()
+
+    def _read_socket(self, reader, path):
+        """Receive commands written to an acquired socket."""
+        with reader:
+            while True:
+                try:
+                    data = reader.recv(self.mtu)
+                except OSError:
+                    return
+                if not data:
+                    return
+                self.receive(data, path)
+
+    def connect(self):
+        """Connect the peripheral, see Device1.Connect."""
+        if not self.discovered:
+            raise _bluez_error('DoesNotExist', 'Does Not Exist')
+        if not self.in_range:
+            raise _bluez_error('Failed', 'Software caused connection abort')
+        self._set_connected(True)
+
+    def disconnect(self):
+        """Drop the connection and close acquired sockets.
+
+        Also used for simulating loss of the link.
+        """
+        for reader in self._sockets:
+            try:
+                reader.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self._sockets = []
+        self.notifying = False
+        self._set_connected(False)
+
+    def _set_connected(self, connected):
+        """Change Connected property and signal it like BlueZ."""
+        if connected == self.connected:
+            return
+        self.connected = connected
+        self.properties_changed.emit(
+            'org.bluez.Device1', {'Connected': connected}, [])
+
+
+def _unpack(value):
+    """Return value of GLib.Variant, or the value if it is not one."""
+    if isinstance(value, GLib.Variant):
+        return value.unpack()
+    return value
+
+
+class DBusSignal:
+    """D-Bus signal of a proxy, like in pydbus."""
+
+    def __init__(self):
+        self._handlers = []
+
+    def connect(self, handler):
+        """Call handler with arguments of each signal.
+
+        Returns subscription with disconnect method.
+        """
+        self._handlers.append(handler)
+        return _Subscription(self._handlers, handler)
+
+    def emit(self, *args):
+        """Call handlers connected."""
+        for handler in list(self._handlers):
+            handler(*args)
+
+
+class _Subscription:
+    def __init__(self, handlers, handler):
+        self._handlers = handlers
+        self._handler = handler
+
+    def disconnect(self):
+        if self._handler in self._handlers:
+            self._handlers.remove(self._handler)
+
+
+class _Proxy:
+    """D-Bus object proxy like the ones pydbus returns."""
+
+    def __getattr__(self, name):
+        raise AttributeError("'<CompositeObject>' object has no attribute '{}'".format(name))
+
+
+class _ObjectManager(_Proxy):
+    def __init__(self, peripheral):
+        self._peripheral = peripheral
+
+    def GetManagedObjects(self):
+        return self._peripheral.managed_objects()
+
+    @property
+    def InterfacesAdded(self):
+        return self._peripheral.interfaces_added
+
+
+class _Adapter(_Proxy):
+    def __init__(self, peripheral):
+        self._peripheral = peripheral
+
+    def SetDiscoveryFilter(self, discovery_filter):
+        self._peripheral.discovery_filter = dict(discovery_filter)
+
+    def StartDiscovery(self):
+        self._peripheral.start_discovery()
+
+    def StopDiscovery(self):
+        if not self._peripheral.discovering:
+            raise _bluez_error('Failed', 'No discovery started')
+        self._peripheral.discovering = False
+
+    def RemoveDevice(self, path):
+        self._peripheral.discovered = False
+
+
+class _Device(_Proxy):
+    def __init__(self, peripheral):
+        self._peripheral = peripheral
+
+    @property
+    def Connected(self):
+        return self._peripheral.connected
+
+    @property
+    def PropertiesChanged(self):
+        return self._peripheral.properties_changed
+
+    def Connect(self):
+        self._peripheral.connect()
+
+    def Disconnect(self):
+        self._peripheral.disconnect()
+
+
+class _Characteristic(_Proxy):
+    def __init__(self, peripheral, path, uuid):
+        self._peripheral = peripheral
+        self._path = path
+        self._uuid = uuid
+
+    @property
+    def UUID(self):
+        return self._uuid
+
+    @property
+    def Flags(self):
+        return list(self._peripheral.flags)
+
+    def WriteValue(self, value, options):
+        for option in options.values():
+            if not isinstance(option, GLib.Variant):
+                # pydbus can not pass other values in a{sv}.
+                raise TypeError('Option values must be GLib.Variant, not {}'.format(
+                    type(option).__name__))
+        if not self._peripheral.connected:
+            raise _bluez_error('Failed', 'Not connected')
+        if _unpack(options.get('type')) == 'command':
+            if 'write-without-response' not in self._peripheral.flags:
+                raise _bluez_error('NotSupported', 'Operation is not supported')
+            time.sleep(self._peripheral.command_delay)
+        else:
+            time.sleep(self._peripheral.write_delay)
+        self._peripheral.receive(bytes(value), self._path)
+
+
+class _AckCharacteristic(_Proxy):
+    def __init__(self, peripheral):
+        self._peripheral = peripheral
+
+    @property
+    def UUID(self):
+        return ACK_UUID
+
+    @property
+    def PropertiesChanged(self):
+        return self._peripheral.ack_changed
+
+    def StartNotify(self):
+        if not self._peripheral.connected:
+            raise _bluez_error('Failed', 'Not connected')
+        self._peripheral.notifying = True
+
+    def StopNotify(self):
+        self._peripheral.notifying = False
+
+
+class _Variant:
+    """Return value of a D-Bus call, like GLib.Variant."""
+
+    def __init__(self, *values):
+        self._values = values
+
+    def unpack(self):
+        return self._values
+
+
+class _FdList:
+    """File descriptors passed with a D-Bus call, like Gio.UnixFDList."""
+
+    def __init__(self, *fds):
+        self._fds = fds
+
+    def get(self, index):
+        # Gio.UnixFDList.get returns a duplicate owned by the caller.
+        return os.dup(self._fds[index])
+
+    def __del__(self):
+        for fd in self._fds:
+            os.close(fd)
+
+
+class _Connection:
+    """Gio.DBusConnection of FakeBus, only for passing file descriptors."""
+
+    def __init__(self, peripheral):
+        self._peripheral = peripheral
+
+    def call_with_unix_fd_list_sync(self, bus_name, object_path, interface_name,
+                                    method_name, parameters, reply_type, flags,
+                                    timeout_msec, fd_list, cancellable):
+        peripheral = self._peripheral
+        writable = [peripheral.characteristic_path]
+        if peripheral.extended:
+            writable.append(peripheral.command_path)
+        if object_path not in writable or method_name != 'AcquireWrite':
+            raise _bluez_error('NotSupported', 'Operation is not supported')
+        fds = _FdList(peripheral.acquire_write(object_path))
+        return _Variant(0, self._peripheral.mtu), fds
+
+
+class FakeBus:
+    """System bus with simulated BlueZ, see pydbus.SystemBus.
+
+    Arguments:
+    peripheral -- The simulated wheelchair (SimulatedPeripheral).
+    """
+
+    def __init__(self, peripheral):
+        self.peripheral = peripheral
+        self.con = _Connection(peripheral)
+
+    def get(self, bus_name, object_path='/'):
+        """Return proxy of a BlueZ object."""
+        peripheral = self.peripheral
+        if object_path == '/':
+            return _ObjectManager(peripheral)
+        if object_path == peripheral.adapter_path:
+            return _Adapter(peripheral)
+        if object_path == peripheral.device_path:
+            return _Device(peripheral)
+        if object_path == peripheral.characteristic_path:
+            return _Characteristic(peripheral, object_path, DRIVE_UUID)
+        if peripheral.extended and object_path == peripheral.command_path:
+            return _Characteristic(peripheral, object_path, COMMAND_UUID)
+        if peripheral.extended and object_path == peripheral.ack_path:
+            return _AckCharacteristic(peripheral)
+        return _Proxy()
@@ -1,29 +1,111 @@
 """Module to create BLE connection with DBus api."""
 
 import time
-import re
+import json
+import socket
 import threading
+import collections
 
 import pydbus
 import gi.repository
+from gi.repository import Gio, GLib
 
 from PySide2.QtCore import Slot, Signal, QObject
 
 from util import ConnectionState
+from command_mailbox import MailboxWriter
+from link_stats import LinkStats
+import tracing
+
+DEVICE = "org.bluez.Device1"
+GATT_CHARACTERISTIC = "org.bluez.GattCharacteristic1"
+# Seconds to wait for the characteristic after connecting.
+CHARACTERISTIC_TIMEOUT = 10.0
+# Interval of checking whether the characteristic has appeared.
+CHARACTERISTIC_POLL = 0.1
+# DBus paths of characteristics found, by device address and UUID.
+GATT_CACHE_FILE = "./resources/gatt_cache.JSON"
+# Interval of checking whether searching for the wheelchair is stopped.
+DISCOVERY_POLL = 0.5
+# Delay before the first reconnection attempt after losing the link,
+# doubled after each failed attempt up to RECONNECT_MAX (seconds).
+RECONNECT_MIN = 0.05
+RECONNECT_MAX = 2.0
+
+_main_loop = None
+
+def _start_main_loop():
+    """Run GLib main loop in a thread, to receive D-Bus signals."""
+    global _main_loop
+    if _main_loop is None:
+        _main_loop = GLib.MainLoop()
+        threading.Thread(target=_main_loop.run, name="glib-main-loop", daemon=True).start()
 
 class BLEHelper(QObject):
-    """Class to manage bluetooth connection to wheelchair."""
+    """Class to manage bluetooth connection to wheelchair.
+
+    Commands are written by a single writer thread for each connection,
+    which always sends the newest command given (see command_mailbox).
+    Statistics of the writes are returned by write_stats.
+
+    If write_without_response is set and the characteristic's Flags
+    include write-without-response, commands are written without
+    waiting for the wheelchair to acknowledge them. A socket for
+    writing is then acquired from BlueZ with AcquireWrite when
+    connected, and commands are written to the socket instead of
+    calling WriteValue through D-Bus. WriteValue is used if
+    AcquireWrite is not available.
+
+    Loss of the link is noticed from the device's Connected property.
+    The wheelchair is then reconnected in a background thread, with
+    the device and characteristic found before, trying again with
+    growing delays (RECONNECT_MIN to RECONNECT_MAX) until connected or
+    bt_disconnect is called. connection_status is emitted when the
+    link is lost (CONNECTING) and reconnected (CONNECTED). Times from
+    losing the link to reconnecting are in self.reconnect_times.
+
+    If the wheelchair has the command and acknowledgement
+    characteristics of the extended format (see link_stats.py),
+    commands are written to the command characteristic with a sequence
+    number and timestamp, and acknowledgements are followed for
+    round-trip time, loss and reordering, see link_stats. Otherwise
+    the drive characteristic is written in the old two byte format.
+
+    Arguments:
+    bt_adapter -- Name of the Bluetooth adapter (str).
+    bt_address -- Bluetooth address of the wheelchair (str).
+    bt_uuid -- UUID of the drive characteristic (str).
+    bus -- D-Bus system bus to use, pydbus.SystemBus() if not given.
+        See ble_simulator.FakeBus.
+    service_uuid -- UUID of the service the wheelchair advertises. Only
+        devices advertising it are discovered, if given (str).
+    write_without_response -- Write without response when the
+        characteristic supports it (bool).
+    acquire_write -- Try to write through AcquireWrite socket (bool).
+    command_uuid -- UUID of the command characteristic of the extended
+        format (str).
+    ack_uuid -- UUID of the acknowledgement characteristic of the
+        extended format (str).
+    """
     connection_status = Signal(ConnectionState)
 
-    def __init__(self, bt_adapter, bt_address, bt_uuid):
+    def __init__(self, bt_adapter, bt_address, bt_uuid, bus=None, service_uuid=None,
+                 write_without_response=True, acquire_write=True,
+                 command_uuid=None, ack_uuid=None):
         super().__init__()
         self.stop_thread = False
         
         self.bt_adapter = bt_adapter
         self.bt_address = bt_address
         self.uuid = bt_uuid
+        self.service_uuid = service_uuid
+        self.command_uuid = command_uuid
+        self.ack_uuid = ack_uuid
 
-        self.system_bus = pydbus.SystemBus()
+        _start_main_loop()
+        if bus is None:
+            bus = pydbus.SystemBus()
+        self.system_bus = bus
         self.bluez = self.system_bus.get("org.bluez", "/")
         self.managed_objects = self.bluez.GetManagedObjects()
         self.dbus_base = "/org/bluez"
@@ -39,17 +121,31 @@ class BLEHelper(QObject):
         # Find characteristic and get its dbus object later when connected
         self.dbus_characteristic = None
         self.characteristic = None
+        # UUID of the characteristic written, drive or command.
+        self.characteristic_uuid = None
 
-        self.dev_pattern = re.compile(self.dbus_adapter + "/dev_*")
-        self.bt_devices = list(
-            filter(
-                self.dev_pattern.match,
-                self.managed_objects.keys()
-            ))
+        # Characteristics of the extended format, if the wheelchair has them.
+        self.extended = False
+        self.ack_characteristic = None
+        self.ack_subscription = None
+        self.link = LinkStats()
 
         self.connected = ConnectionState.DISCONNECTED
 
-        self.cmd_thread = None
+        self.writer = None
+        self.write_without_response = write_without_response
+        self.acquire_write = acquire_write
+        # Options for WriteValue, type command is without response.
+        self.write_options = {}
+        self.write_socket = None
+        self.write_mtu = 0
+
+        self.device_subscription = None
+        self.reconnect_thread = None
+        self.reconnects = 0
+        self.reconnect_times = collections.deque(maxlen=100)
+        self._lost_time = None
+        self._lock = threading.Lock()
 
     def __del__(self):
         """Disconnect wheelchair when closing program.
@@ -59,24 +155,55 @@ class BLEHelper(QObject):
         #self.bt_disconnect()
         #self._clear_dbus()
 
-    def _get_characteristic_by_uuid(self):
-        """Get BLE characteristic's DBus location."""
+    def _get_characteristic_by_uuid(self, timeout=CHARACTERISTIC_TIMEOUT):
+        """Get BLE characteristic's DBus location.
+
+        Characteristics are found from the interface properties
+        GetManagedObjects returns, without creating a proxy for each
+        object. The path found is saved to GATT_CACHE_FILE, and on the
+        next connection the saved path is only checked.
+
+        Arguments:
+        timeout -- Seconds to wait for BlueZ to resolve the services of
+            the device (float).
+
+        Returns the DBus path, or None if the characteristic was not
+        found before timeout.
+        """
         uuid = self.uuid.lower()
-        while True:
+        cache = _load_gatt_cache()
+        cached = cache.get(self.bt_address, {}).get(uuid)
+        deadline = time.monotonic() + timeout
+        while not self.stop_thread:
             self.managed_objects = self.bluez.GetManagedObjects()
-            for key in self.managed_objects:
-                if key.startswith(self.dbus_device):
-                    dbus_object = self.system_bus.get("org.bluez", key)
-                    try:
-                        if dbus_object.UUID == uuid:
-                            return key
-                    except AttributeError as err:
-                        test_str = ("'<CompositeObject>' "
-                                    "object has no attribute 'UUID'")
-                        if str(err) == test_str:
-                            pass
-                        else:
-                            raise
+            if cached is not None and self._characteristic_uuid(cached) == uuid:
+                return cached
+            path = self._index_characteristics().get(uuid)
+            if path is not None:
+                cache.setdefault(self.bt_address, {})[uuid] = path
+                _save_gatt_cache(cache)
+                return path
+            if time.monotonic() > deadline:
+                print("Characteristic {} not found in {} seconds".format(uuid, timeout))
+                return None
+            time.sleep(CHARACTERISTIC_POLL)
+        return None
+
+    def _characteristic_uuid(self, path):
+        """Return UUID of characteristic in self.managed_objects, or None."""
+        props = self.managed_objects.get(path, {}).get(GATT_CHARACTERISTIC)
+        if props is None:
+            return None
+        return str(props["UUID"]).lower()
+
+    def _index_characteristics(self):
+        """Return dictionary of device's characteristic paths by UUID."""
+        prefix = self.dbus_device + "/"
+        index = {}
+        for path, interfaces in self.managed_objects.items():
+            if path.startswith(prefix) and GATT_CHARACTERISTIC in interfaces:
+                index[str(interfaces[GATT_CHARACTERISTIC]["UUID"]).lower()] = path
+        return index
 
     def _clear_dbus(self):
         """Clear saved Bluetooth connection to Arduino from operating system
@@ -99,11 +226,84 @@ class BLEHelper(QObject):
         self.device = self.system_bus.get("org.bluez", self.dbus_device)
 
     def _set_characteristic(self):
-        """Set DBus address for wheelchair's BLE characteristic."""
+        """Set DBus address for wheelchair's BLE characteristic.
+
+        The command characteristic is used instead of the drive
+        characteristic if the wheelchair has the characteristics of the
+        extended format. Also choose how to write to it, see
+        write_without_response.
+
+        Returns True if the characteristic was found, False otherwise.
+        """
         self.dbus_characteristic = self._get_characteristic_by_uuid()
+        if self.dbus_characteristic is None:
+            return False
+        self.characteristic_uuid = self.uuid.lower()
+        self._set_extended()
         self.characteristic = self.system_bus.get(
             "org.bluez",
             self.dbus_characteristic)
+        flags = self.managed_objects[self.dbus_characteristic][GATT_CHARACTERISTIC].get("Flags", [])
+        if self.write_without_response and "write-without-response" in flags:
+            self.write_options = {"type": GLib.Variant("s", "command")}
+        else:
+            self.write_options = {}
+        return True
+
+    def _set_extended(self):
+        """Use the extended format if the wheelchair has its characteristics.
+
+        The services of the device have been resolved when the drive
+        characteristic is found, so they are not waited for.
+        """
+        self._unwatch_acks()
+        self.extended = False
+        if self.command_uuid is None or self.ack_uuid is None:
+            return
+        index = self._index_characteristics()
+        command_path = index.get(self.command_uuid.lower())
+        ack_path = index.get(self.ack_uuid.lower())
+        if command_path is None or ack_path is None:
+            print("Wheelchair does not support extended commands")
+            return
+        self.extended = True
+        self.dbus_characteristic = command_path
+        self.characteristic_uuid = self.command_uuid.lower()
+        self.ack_characteristic = self.system_bus.get("org.bluez", ack_path)
+        self.ack_subscription = self.ack_characteristic.PropertiesChanged.connect(
+            self._ack_properties_changed)
+
+    def _start_acks(self):
+        """Start notifications of acknowledgements for the connection."""
+        self.link.reset()
+        if not self.extended:
+            return
+        try:
+            self.ack_characteristic.StartNotify()
+        except gi.repository.GLib.Error as err:
+            print("Acknowledgements not available: {}".format(err))
+
+    def _unwatch_acks(self):
+        """Stop following acknowledgements."""
+        if self.ack_subscription is not None:
+            self.ack_subscription.disconnect()
+            self.ack_subscription = None
+        self.ack_characteristic = None
+
+    def _ack_properties_changed(self, interface, changed, invalidated):
+        """Count acknowledgement, in the GLib main loop thread."""
+        if interface == GATT_CHARACTERISTIC and "Value" in changed:
+            self.link.acknowledge(bytes(changed["Value"]))
+
+    def link_stats(self):
+        """Return round-trip statistics of the connection.
+
+        Empty if the wheelchair does not support the extended format.
+        See link_stats.LinkStats.stats.
+        """
+        if not self.extended:
+            return {}
+        return self.link.stats()
 
     @Slot()
     def bt_connect(self):
@@ -118,27 +318,150 @@ class BLEHelper(QObject):
             self.connected = ConnectionState.DISCONNECTED
             return
         self._set_device()
+        self._watch_device()
         if self._connect_wheelchair():
             # If the application is closed while connecting
             self.connected = ConnectionState.DISCONNECTED
             return
+        if not self._set_characteristic():
+            # Wrong device or the application is closed while connecting
+            self._unwatch_device()
+            self._unwatch_acks()
+            self.device.Disconnect()
+            self.connected = ConnectionState.DISCONNECTED
+            self.connection_status.emit(self.connected)
+            return
         self.connected = ConnectionState.CONNECTED
-        self._set_characteristic()
+        self._start_acks()
+        self._acquire_write()
+        self._start_writer()
         self.connection_status.emit(self.connected)
 
     @Slot()
     def bt_disconnect(self):
         """Disconnect wheelchair."""
+        with self._lock:
+            self.connected = ConnectionState.DISCONNECTED
+        self._unwatch_device()
+        self._stop_writer()
+        self._release_write()
+        self._unwatch_acks()
         if self.device:
             self.device.Disconnect()
-        self.connected = ConnectionState.DISCONNECTED
         self.connection_status.emit(self.connected)
 
+    def _watch_device(self):
+        """Follow changes of the device's properties."""
+        self._unwatch_device()
+        self.device_subscription = self.device.PropertiesChanged.connect(
+            self._device_properties_changed)
+
+    def _unwatch_device(self):
+        """Stop following changes of the device's properties."""
+        if self.device_subscription is not None:
+            self.device_subscription.disconnect()
+            self.device_subscription = None
+
+    def _device_properties_changed(self, interface, changed, invalidated):
+        """Notice loss of the link, in the GLib main loop thread."""
+        if interface == DEVICE and changed.get("Connected") is False:
+            self._link_lost()
+
+    def _link_lost(self):
+        """Stop writing and start reconnecting, if connected."""
+        with self._lock:
+            if self.connected != ConnectionState.CONNECTED:
+                return
+            self.connected = ConnectionState.CONNECTING
+            self._lost_time = time.monotonic()
+        print("Connection to wheelchair lost, reconnecting...")
+        self._stop_writer()
+        self._release_write()
+        self.connection_status.emit(self.connected)
+        self.reconnect_thread = threading.Thread(
+            target=self._reconnect, name="ble-reconnect", daemon=True)
+        self.reconnect_thread.start()
+
+    def _reconnect(self):
+        """Connect the lost wheelchair again.
+
+        The device and characteristic found before are used, so there
+        is no discovery or characteristic lookup.
+        """
+        delay = RECONNECT_MIN
+        while not self.stop_thread and self.connected == ConnectionState.CONNECTING:
+            try:
+                self.device.Connect()
+                if self._wait_characteristic():
+                    break
+            except gi.repository.GLib.Error as err:
+                print("Reconnecting failed: {}".format(err))
+            time.sleep(delay)
+            delay = min(2*delay, RECONNECT_MAX)
+
+        with self._lock:
+            disconnected = self.connected != ConnectionState.CONNECTING or self.stop_thread
+            if not disconnected:
+                self._start_acks()
+                self._acquire_write()
+                self._start_writer()
+                self.connected = ConnectionState.CONNECTED
+                self.reconnects += 1
+                self.reconnect_times.append(time.monotonic() - self._lost_time)
+        if disconnected:
+            # bt_disconnect ran while connecting, so its Disconnect
+            # may have come before the link was up again, and a
+            # Connect in flight may have succeeded after it.
+            try:
+                self.device.Disconnect()
+            except gi.repository.GLib.Error as err:
+                print("Disconnecting failed: {}".format(err))
+            return
+        print("Reconnected in {:.2f} s".format(self.reconnect_times[-1]))
+        self.connection_status.emit(self.connected)
+
+    def _wait_characteristic(self, timeout=CHARACTERISTIC_TIMEOUT):
+        """Wait for the characteristic found before to be available again.
+
+        Returns True if it is available before timeout.
+        """
+        deadline = time.monotonic() + timeout
+        while not self.stop_thread:
+            self.managed_objects = self.bluez.GetManagedObjects()
+            if self._characteristic_uuid(self.dbus_characteristic) == self.characteristic_uuid:
+                return True
+            if time.monotonic() > deadline:
+                return False
+            time.sleep(CHARACTERISTIC_POLL)
+        return False
+
     def _find_wheelchair(self):
-        """Search for wheelchair with BLE scan."""
-        while not self.stop_thread and self.dbus_device not in self.bt_devices:
+        """Search for wheelchair with BLE scan.
+
+        Discovery is limited to LE devices advertising the wheelchair's
+        service, and the search ends as soon as BlueZ tells that the
+        wheelchair has been added. Discovery is stopped after that.
+
+        Returns True if the search was stopped before the wheelchair
+        was found.
+        """
+        found = threading.Event()
+        def interfaces_added(path, interfaces):
+            if path == self.dbus_device:
+                found.set()
+        subscription = self.bluez.InterfacesAdded.connect(interfaces_added)
+        discovering = False
+        try:
+            if self.dbus_device in self.bluez.GetManagedObjects():
+                # Already known to BlueZ.
+                return self.stop_thread
+            discovery_filter = {"Transport": GLib.Variant("s", "le")}
+            if self.service_uuid:
+                discovery_filter["UUIDs"] = GLib.Variant("as", [self.service_uuid.lower()])
+            self.hci0.SetDiscoveryFilter(discovery_filter)
             try:
                 self.hci0.StartDiscovery()
+                discovering = True
             except gi.repository.GLib.GError as err:
                 error_text = ("g-io-error-quark: "
                               "GDBus.Error:org.bluez.Error.InProgress: "
@@ -147,15 +470,15 @@ class BLEHelper(QObject):
                     pass
                 else:
                     raise
-            time.sleep(1)
-            #self.hci0.StopDiscovery()
-            self.managed_objects = self.bluez.GetManagedObjects()
-            self.bt_devices = list(
-                filter(
-                    self.dev_pattern.match,
-                    self.managed_objects.keys()
-                ))
-
+            while not self.stop_thread and not found.wait(DISCOVERY_POLL):
+                pass
+        finally:
+            subscription.disconnect()
+            if discovering:
+                try:
+                    self.hci0.StopDiscovery()
+                except gi.repository.GLib.GError as err:
+                    print("Could not stop discovery: {}".format(err))
         return self.stop_thread
 
     def _connect_wheelchair(self):
@@ -183,30 +506,127 @@ class BLEHelper(QObject):
 
         return self.stop_thread
 
+    def _start_writer(self):
+        """Start writer thread for the connection."""
+        self._stop_writer()
+        self.writer = MailboxWriter(self._write_value, 'ble-writer')
+
+    def _stop_writer(self):
+        """Stop writer thread of the connection, if there is one."""
+        if self.writer is not None:
+            self.writer.stop()
+            self.writer = None
+
+    def _acquire_write(self):
+        """Acquire socket for writing to the characteristic.
+
+        Leaves self.write_socket None if BlueZ does not give one, for
+        example when the characteristic does not support write without
+        response.
+        """
+        self._release_write()
+        if not self.acquire_write or not self._without_response():
+            return
+        try:
+            # pydbus can not pass file descriptors, so call with Gio.
+            result, fd_list = self.system_bus.con.call_with_unix_fd_list_sync(
+                "org.bluez", self.dbus_characteristic,
+                "org.bluez.GattCharacteristic1", "AcquireWrite",
+                GLib.Variant("(a{sv})", ({},)), GLib.VariantType.new("(hq)"),
+                Gio.DBusCallFlags.NONE, -1, None, None)
+        except GLib.Error as err:
+            print("AcquireWrite not available, using WriteValue: {}".format(err))
+            return
+        fd_index, self.write_mtu = result.unpack()
+        self.write_socket = socket.socket(fileno=fd_list.get(fd_index))
+
+    def _without_response(self):
+        """Return True if commands are written without response."""
+        write_type = self.write_options.get("type")
+        return write_type is not None and write_type.unpack() == "command"
+
+    def _release_write(self):
+        """Close socket acquired for writing, if there is one."""
+        if self.write_socket is not None:
+            self.write_socket.close()
+            self.write_socket = None
+
+    def write_stats(self):
+        """Return statistics of writes on the current connection.
+
+        See command_mailbox.MailboxWriter.stats.
+        """
+        if self.writer is None:
+            return {}
+        stats = self.writer.stats()
+        stats['acquired'] = self.write_socket is not None
+        stats['without_response'] = self._without_response()
+        stats['reconnects'] = self.reconnects
+        if self.reconnect_times:
+            stats['reconnect_last'] = self.reconnect_times[-1]
+        return stats
+
     @Slot()
-    def write_characteristic(self, cmd):
+    def write_characteristic(self, cmd, trace=None):
         """Write movement command to wheelchair.
 
-        TODO: Improve exception handling.
-        Errors to handle:
-        If connection is broken (try to reconnect or do what?):
-            g-io-error-quark: GDBus.Error:org.bluez.Error.Failed: \
-                Not connected (36)
+        The command is written by the writer thread as soon as the
+        previous write has finished. If a newer command is given before
+        that, this one is not written at all.
+
+        Arguments:
+        cmd -- Command to write (list of int).
+        trace -- Trace of the command, see tracing.py.
         """
-        if self.connected != ConnectionState.CONNECTED:
+        if self.connected != ConnectionState.CONNECTED or self.writer is None:
             return
+        tracing.mark(trace, 'write_characteristic')
+        self.writer.post(cmd, trace)
+
+    def _write_value(self, cmd):
+        """Write command to characteristic, in the writer thread.
+
+        Command is written to the acquired socket if there is one. If
+        writing to it fails, the socket is closed and WriteValue used
+        instead.
+
+        If the link is broken, the wheelchair is reconnected like when
+        losing the link is noticed from the Connected property.
+        """
+        if self.extended:
+            cmd = list(self.link.encode(cmd))
+        if self.write_socket is not None:
+            try:
+                self.write_socket.send(bytes(cmd))
+                return
+            except OSError as err:
+                print("Writing to acquired socket failed, using WriteValue: {}".format(err))
+                self._release_write()
         try:
-            if self.cmd_thread == None or not self.cmd_thread.is_alive():
-                self.cmd_thread = threading.Thread(target=self.characteristic.WriteValue, args=[cmd, {}])
-                self.cmd_thread.start()
+            self.characteristic.WriteValue(cmd, self.write_options)
         except gi.repository.GLib.Error as err:
             err_connection_broken = ("g-io-error-quark: "
                                      "GDBus.Error:org.bluez.Error.Failed: "
                                      "Not connected (36)")
             if str(err) == err_connection_broken:
-                # What should we do here? try to reconnect?
                 print("Connection broken while trying to write to device.")
-                print("Reconnecting...")
-                self.bt_connect()
+                self._link_lost()
             else:
                 raise
+
+
+def _load_gatt_cache():
+    """Load saved characteristic paths."""
+    try:
+        with open(GATT_CACHE_FILE) as cache_file:
+            return json.load(cache_file)
+    except (OSError, ValueError):
+        return {}
+
+def _save_gatt_cache(cache):
+    """Save characteristic paths."""
+    try:
+        with open(GATT_CACHE_FILE, "w") as cache_file:
+            json.dump(cache, cache_file, indent=2)
+    except OSError as err:
+        print("Could not save characteristic cache: {}".format(err))
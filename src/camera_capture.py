@@ -0,0 +1,221 @@
+"""Threaded frame capture from a camera.
+
+Reading frames with cv2.VideoCapture.read() from the GUI thread returns
+the oldest frame in the driver's buffer and blocks the whole UI while
+the camera is slow to deliver. This module grabs frames continuously
+in a background thread into a small preallocated ring buffer, so the
+vision code always gets the newest frame without waiting for the
+camera.
+"""
+
+import time
+import threading
+
+import numpy as np
+
+# Seconds to wait for the capture thread to stop.
+STOP_TIMEOUT = 1.0
+
+class CameraCapture:
+    """Capture frames from a camera in a background thread.
+
+    Frames are stored to a ring buffer of preallocated arrays and
+    stamped with time.monotonic() at capture. Reader always gets the
+    newest frame. Frames overwritten before anyone read them are
+    counted as dropped.
+
+    Usage: create with an opened cv2.VideoCapture (or any object with
+    the same read/release -methods), call start(), and read frames with
+    read(). Call stop(release=True) to release the camera when done.
+
+    Arguments:
+    cam -- Opened camera object with read() method.
+    buffer_size -- Number of frames in the ring buffer (int).
+    """
+
+    def __init__(self, cam, buffer_size=3):
+        self.cam = cam
+        self.buffer_size = max(2, buffer_size)
+
+        self._frames = [None] * self.buffer_size
+        self._times = [0.0] * self.buffer_size
+        self._latest = -1       # Ring buffer index of the newest frame
+        self._seq = 0           # Number of frames captured
+        self._read_seq = 0      # Sequence number of last frame read
+
+        self._cond = threading.Condition()
+        self._running = False
+        self._release = False
+        self._thread = None
+
+        self.frames_captured = 0
+        self.frames_read = 0
+        self.frames_dropped = 0
+        self.read_errors = 0
+
+    def start(self):
+        """Start capturing frames in a background thread."""
+        if self._running:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self, release=False):
+        """Stop capturing and wait for the capture thread to finish.
+
+        If the camera is released too, the capture thread releases it
+        once it has stopped reading, so a read blocking on the camera
+        does not run into the release. If the thread does not stop in
+        STOP_TIMEOUT seconds, it is left to release the camera when the
+        read returns.
+
+        Arguments:
+        release -- Release the camera (bool).
+
+        Returns True if the capture thread stopped in time.
+        """
+        thread = self._thread
+        if thread is None:
+            if release:
+                self.cam.release()
+            return True
+        self._release = release
+        self._running = False
+        with self._cond:
+            self._cond.notify_all()
+        thread.join(timeout=STOP_TIMEOUT)
+        self._thread = None
+        if thread.is_alive():
+            print('Camera capture did not stop in {} seconds'.format(STOP_TIMEOUT))
+            return False
+        return True
+
+    def is_running(self):
+        """Return True if the capture thread is running."""
+        return self._running
+
+    def _run(self):
+        """Grab frames to the ring buffer until stopped."""
+        try:
+            self._grab()
+        finally:
+            if self._release:
+                self.cam.release()
+
+    def _grab(self):
+        """Grab frames to the ring buffer while running."""
+        while self._running:
+            index = (self._latest + 1) % self.buffer_size
+            slot = self._frames[index]
+            if slot is None:
+                ret, frame = self.cam.read()
+            else:
+                ret, frame = self.cam.read(slot)
+            timestamp = time.monotonic()
+
+            if not ret or frame is None:
+                self.read_errors += 1
+                # Do not spin when the camera is gone.
+                time.sleep(0.01)
+                continue
+
+            with self._cond:
+                # OpenCV allocates a new array if the resolution changed.
+                self._frames[index] = frame
+                self._times[index] = timestamp
+                if self._seq > self._read_seq:
+                    # Previous newest frame was never read.
+                    self.frames_dropped += 1
+                self._latest = index
+                self._seq += 1
+                self.frames_captured += 1
+                self._cond.notify_all()
+
+    def read(self, dst=None, timeout=None):
+        """Get the newest frame.
+
+        Waits until a frame newer than the previously read one has been
+        captured, at most timeout seconds. The frame is copied, so
+        the capture thread can keep on writing to its ring buffer.
+
+        Arguments:
+        dst -- Array to copy the frame to. A new array is allocated if
+            dst is None or its shape does not match the frame.
+        timeout -- Seconds to wait for a new frame. None waits forever
+            and 0 returns immediately (float).
+
+        Returns tuple (ret, frame, timestamp) where ret is True if a
+        new frame was read. If no new frame was captured in time, ret
+        is False and frame is None.
+        """
+        with self._cond:
+            if not self._cond.wait_for(
+                    lambda: self._seq > self._read_seq or not self._running,
+                    timeout):
+                return False, None, 0.0
+            if self._seq == self._read_seq:
+                # Capture was stopped while waiting.
+                return False, None, 0.0
+
+            frame = self._frames[self._latest]
+            if dst is None or dst.shape != frame.shape or dst.dtype != frame.dtype:
+                dst = np.empty_like(frame)
+            np.copyto(dst, frame)
+            timestamp = self._times[self._latest]
+            self._read_seq = self._seq
+            self.frames_read += 1
+        return True, dst, timestamp
+
+
+class DirectCapture:
+    """Read frames from a camera only when asked.
+
+    Has the same interface as CameraCapture, but reads each frame in
+    the calling thread. Used when every frame must be processed, for
+    example when benchmarking with recorded video.
+
+    Arguments:
+    cam -- Opened camera object with read() method.
+    """
+
+    def __init__(self, cam):
+        self.cam = cam
+        self.frames_captured = 0
+        self.frames_read = 0
+        self.frames_dropped = 0
+        self.read_errors = 0
+
+    def start(self):
+        """Nothing to start, frames are read in read()."""
+
+    def stop(self, release=False):
+        """Release the camera if asked. Nothing else to stop, since
+        frames are read in read().
+
+        Returns True like CameraCapture.stop.
+        """
+        if release:
+            self.cam.release()
+        return True
+
+    def is_running(self):
+        """Return True, frames can always be read."""
+        return True
+
+    def read(self, dst=None, timeout=None):
+        """Read next frame from the camera.
+
+        Arguments:
+        dst -- Array to read the frame to, if its shape matches.
+        timeout -- Not used, reading blocks until the camera returns.
+
+        Returns tuple (ret, frame, timestamp) like CameraCapture.read.
+        """
+        ret, frame = self.cam.read(dst)
+        if not ret or frame is None:
+            self.read_errors += 1
+            return False, None, 0.0
+        self.frames_captured += 1
+        self.frames_read += 1
+        return True, frame, time.monotonic()
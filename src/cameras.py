@@ -0,0 +1,278 @@
+"""Discovery of cameras connected to the computer.
+
+OpenCV does not have a method for listing cameras, and opening every
+possible camera index to see which ones work takes seconds and keeps
+the devices open. On Linux the cameras are listed from /dev/video*
+and their names read from sysfs instead, so no camera is opened.
+Elsewhere a few indices are probed and released right away.
+
+Cameras found are cached for the session.
+
+Capture mode (resolution, frame rate, pixel format, buffer size) and
+manual exposure and gain are negotiated with the camera, and the
+profile chosen for each camera is saved to camera_profiles.JSON. Edit
+the file to set exposure and gain for a camera. Profiles are saved by
+the device id of the camera, so identical cameras have their own.
+"""
+
+import os
+import sys
+import glob
+import json
+from collections import namedtuple
+
+import cv2
+
+CameraInfo = namedtuple('CameraInfo', ['index', 'path', 'name', 'device_id'],
+                        defaults=[None])
+CameraInfo.__doc__ = """Camera found from the computer.
+
+index -- OpenCV index of the camera (int).
+path -- Device path, or None if not known (str).
+name -- Human readable name of the camera (str).
+device_id -- Id which stays the same for the device across
+    restarts: USB serial number, or the port the camera is plugged
+    into if it has none. None if not known (str).
+"""
+
+# Number of camera indices probed where devices can not be listed.
+PROBE_INDICES = 4
+# sysfs directory of a V4L2 device by its index.
+SYSFS_VIDEO = '/sys/class/video4linux/video{}'
+
+_cameras = None
+
+def list_cameras(refresh=False, probe=False):
+    """List cameras connected to the computer.
+
+    Arguments:
+    refresh -- Find cameras again instead of using cached list (bool).
+    probe -- Open each camera to check that it works. Each camera is
+        released right after checking (bool).
+
+    Cameras are searched again if none were found the last time.
+
+    Returns list of CameraInfo.
+    """
+    global _cameras
+    if _cameras and not refresh and not probe:
+        return list(_cameras)
+
+    if sys.platform.startswith('linux'):
+        cameras = _list_v4l2()
+        if probe:
+            cameras = [cam for cam in cameras if _probe(cam.index)]
+    else:
+        cameras = [CameraInfo(i, None, 'Camera {}'.format(i))
+                   for i in range(PROBE_INDICES) if _probe(i)]
+
+    _cameras = cameras
+    print("{} cameras found".format(len(cameras)))
+    return list(cameras)
+
+def _list_v4l2():
+    """List V4L2 video capture devices without opening them."""
+    cameras = []
+    for path in glob.glob('/dev/video*'):
+        try:
+            index = int(path[len('/dev/video'):])
+        except ValueError:
+            continue
+        sysfs = SYSFS_VIDEO.format(index)
+        # UVC cameras have a second device node for metadata. Only
+        # the node with index 0 captures video.
+        if _read_sysfs(sysfs, 'index', '0') != '0':
+            continue
+        name = _read_sysfs(sysfs, 'name', 'Camera {}'.format(index))
+        cameras.append(CameraInfo(index, path, name, _device_id(sysfs)))
+    # Identical cheap cameras may share a serial number too, and then
+    # their ports tell them apart.
+    ids = [cam.device_id for cam in cameras]
+    for i, cam in enumerate(cameras):
+        if cam.device_id is not None and ids.count(cam.device_id) > 1:
+            device_id = _device_id(SYSFS_VIDEO.format(cam.index), serial=False)
+            cameras[i] = cam._replace(device_id=device_id)
+    cameras.sort(key=lambda cam: cam.index)
+    return cameras
+
+def _device_id(sysfs, serial=True):
+    """Return id of a V4L2 device which does not change between restarts.
+
+    Unlike /dev/video* numbers, the serial number and the USB port do
+    not depend on the order devices were found in.
+
+    Arguments:
+    sysfs -- sysfs directory of the device (str).
+    serial -- Use the serial number if the device has one, otherwise
+        always the port (bool).
+    """
+    device = os.path.join(sysfs, 'device')
+    if not os.path.exists(device):
+        return None
+    # The device link is the USB interface, serial number is in the
+    # USB device above it.
+    device = os.path.realpath(device)
+    serial_number = _read_sysfs(os.path.dirname(device), 'serial', None) if serial else None
+    if serial_number:
+        return 'serial:' + serial_number
+    return 'port:' + os.path.relpath(device, '/sys/devices')
+
+def _read_sysfs(directory, attribute, default):
+    """Read an attribute of a device from sysfs."""
+    try:
+        with open(os.path.join(directory, attribute)) as attr_file:
+            return attr_file.read().strip()
+    except OSError:
+        return default
+
+def _probe(index):
+    """Check that camera can be opened, and release it right away."""
+    cap = cv2.VideoCapture(index)
+    try:
+        return cap.isOpened()
+    finally:
+        cap.release()
+
+
+# Capture mode requested from a camera unless a profile has been saved
+# for it. Small resolution and compressed or greyscale format keep
+# decoding and transfer cheap, and one frame buffer keeps frames fresh.
+# Exposure and gain are left to the camera if None.
+DEFAULT_PROFILE = {
+    'width': 640,
+    'height': 480,
+    'fps': 30,
+    'format': 'MJPG',
+    'buffer_size': 1,
+    'exposure': None,
+    'gain': None,
+    }
+# Pixel formats tried in order of preference if the requested one is
+# not supported.
+FORMATS = ('MJPG', 'GREY', 'YUYV')
+# Profiles chosen for each camera, by device id (or name if the id is
+# not known, see _profile_key).
+PROFILES_FILE = './resources/camera_profiles.JSON'
+
+def _fourcc(value):
+    """Convert FOURCC code read from camera to string."""
+    value = int(value)
+    return ''.join(chr((value >> 8*i) & 0xFF) for i in range(4))
+
+def apply_profile(cap, profile):
+    """Request capture mode and exposure settings from a camera.
+
+    Arguments:
+    cap -- Opened cv2.VideoCapture.
+    profile -- Dictionary of settings, see DEFAULT_PROFILE. Settings
+        missing or None are not changed.
+
+    Returns dictionary of the settings the camera actually uses.
+    """
+    # Format must be set before resolution for some V4L2 drivers.
+    if profile.get('format'):
+        cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*profile['format']))
+    if profile.get('width') and profile.get('height'):
+        cap.set(cv2.CAP_PROP_FRAME_WIDTH, profile['width'])
+        cap.set(cv2.CAP_PROP_FRAME_HEIGHT, profile['height'])
+    if profile.get('fps'):
+        cap.set(cv2.CAP_PROP_FPS, profile['fps'])
+    if profile.get('buffer_size'):
+        cap.set(cv2.CAP_PROP_BUFFERSIZE, profile['buffer_size'])
+    if profile.get('exposure') is not None:
+        # 1 is manual exposure for V4L2 (and 0.25 for some backends).
+        if not cap.set(cv2.CAP_PROP_AUTO_EXPOSURE, 1):
+            cap.set(cv2.CAP_PROP_AUTO_EXPOSURE, 0.25)
+        cap.set(cv2.CAP_PROP_EXPOSURE, profile['exposure'])
+    if profile.get('gain') is not None:
+        cap.set(cv2.CAP_PROP_GAIN, profile['gain'])
+    return read_profile(cap, profile)
+
+def read_profile(cap, requested=None):
+    """Read settings the camera is using.
+
+    Arguments:
+    cap -- Opened cv2.VideoCapture.
+    requested -- Profile requested. Exposure and gain are reported only
+        if they were requested, since automatic values mean nothing.
+
+    Returns dictionary of settings like DEFAULT_PROFILE.
+    """
+    requested = requested or {}
+    profile = {
+        'width': int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+        'height': int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+        'fps': cap.get(cv2.CAP_PROP_FPS),
+        'format': _fourcc(cap.get(cv2.CAP_PROP_FOURCC)).strip('\x00') or None,
+        'buffer_size': int(cap.get(cv2.CAP_PROP_BUFFERSIZE)) or None,
+        'exposure': None,
+        'gain': None,
+        }
+    if requested.get('exposure') is not None:
+        profile['exposure'] = cap.get(cv2.CAP_PROP_EXPOSURE)
+    if requested.get('gain') is not None:
+        profile['gain'] = cap.get(cv2.CAP_PROP_GAIN)
+    return profile
+
+def negotiate_profile(cap, wanted=None):
+    """Find the closest capture mode to wanted one which camera honours.
+
+    The wanted format is tried first and then the others in FORMATS.
+    A format is accepted if the camera reports it back and delivers a
+    frame of the reported size with it.
+
+    Arguments:
+    cap -- Opened cv2.VideoCapture.
+    wanted -- Profile wanted, DEFAULT_PROFILE if not given.
+
+    Returns dictionary of the settings the camera uses.
+    """
+    wanted = dict(wanted or DEFAULT_PROFILE)
+    formats = [wanted.get('format')] + [fmt for fmt in FORMATS if fmt != wanted.get('format')]
+    actual = None
+    for fmt in formats:
+        actual = apply_profile(cap, dict(wanted, format=fmt))
+        if fmt and actual['format'] != fmt:
+            continue
+        ret, frame = cap.read()
+        if ret and frame.shape[1] == actual['width'] and frame.shape[0] == actual['height']:
+            return actual
+    # Nothing was honoured fully, use what the camera ended up with.
+    return actual
+
+def load_profile(camera):
+    """Load profile saved for a camera.
+
+    Arguments:
+    camera -- Camera as CameraInfo.
+
+    Returns profile dictionary, or None if there is none saved.
+    """
+    return _load_profiles().get(_profile_key(camera))
+
+def save_profile(camera, profile):
+    """Save profile chosen for a camera.
+
+    Arguments:
+    camera -- Camera as CameraInfo.
+    profile -- Profile dictionary.
+    """
+    profiles = _load_profiles()
+    profiles[_profile_key(camera)] = profile
+    try:
+        with open(PROFILES_FILE, 'w') as profiles_file:
+            json.dump(profiles, profiles_file, indent=2)
+    except OSError as err:
+        print('Could not save camera profile: {}'.format(err))
+
+def _profile_key(camera):
+    """Return key of a camera's profile in PROFILES_FILE."""
+    return camera.device_id or camera.name
+
+def _load_profiles():
+    """Load all saved camera profiles."""
+    try:
+        with open(PROFILES_FILE) as profiles_file:
+            return json.load(profiles_file)
+    except (OSError, ValueError):
+        return {}
@@ -0,0 +1,155 @@
+"""Sending the newest command to a link in a writer thread.
+
+Driving commands are produced faster than a slow link (like Bluetooth
+LE) can send them. Queuing them up delays every command after the
+first one, and dropping new commands while a write is in flight can
+drop a stop command. Here commands are posted to a mailbox holding only
+the newest one, and a single long-lived writer thread sends it when the
+link is free. Commands overwritten before they were sent are counted
+as coalesced.
+"""
+
+import time
+import threading
+import collections
+
+import numpy as np
+
+import tracing
+
+class Mailbox:
+    """Thread-safe holder of the newest item posted.
+
+    Posting replaces an item which has not been taken yet.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._item = None
+        self._posted_time = 0.0
+        self._full = False
+        self._closed = False
+        self.posted = 0
+        self.coalesced = 0
+
+    def post(self, item):
+        """Put an item to the mailbox, replacing one not taken yet."""
+        with self._cond:
+            if self._full:
+                self.coalesced += 1
+            self._item = item
+            self._posted_time = time.monotonic()
+            self._full = True
+            self.posted += 1
+            self._cond.notify()
+
+    def take(self, timeout=None):
+        """Take the item from the mailbox.
+
+        Arguments:
+        timeout -- Seconds to wait for an item. None waits until there
+            is one or the mailbox is closed (float).
+
+        Returns tuple (item, posted_time), or None if there was no item
+        before timeout or the mailbox was closed.
+        """
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._full or self._closed, timeout):
+                return None
+            if not self._full:
+                return None
+            self._full = False
+            item, self._item = self._item, None
+            return item, self._posted_time
+
+    def close(self):
+        """Wake up anyone waiting to take an item and refuse to wait after."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+
+class MailboxWriter:
+    """Write the newest command posted in a long-lived thread.
+
+    Usage: create with the function that writes a command to the link,
+    post commands, and stop when the link is closed.
+
+    Statistics of the writes are in attributes:
+    writes -- Commands written.
+    errors -- Writes which raised an exception.
+    latencies -- Seconds from posting to end of write of the latest
+        writes.
+
+    Arguments:
+    write -- Function called with each command to write.
+    name -- Name of the writer thread (str).
+    history -- Number of latencies kept (int).
+    """
+
+    def __init__(self, write, name='writer', history=1000):
+        self.write = write
+        self.mailbox = Mailbox()
+        self.writes = 0
+        self.errors = 0
+        self.latencies = collections.deque(maxlen=history)
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    @property
+    def coalesced(self):
+        """Number of commands replaced before they were written."""
+        return self.mailbox.coalesced
+
+    def post(self, cmd, trace=None):
+        """Write cmd when the link is free, unless a newer one is posted.
+
+        The trace of cmd (see tracing.py) is finished when it has been
+        written.
+        """
+        self.mailbox.post((cmd, trace))
+
+    def stop(self, timeout=None):
+        """Stop the writer thread after the write in progress."""
+        self.mailbox.close()
+        if threading.current_thread() is not self._thread:
+            self._thread.join(timeout)
+
+    def is_running(self):
+        """Return True if the writer thread is running."""
+        return self._thread.is_alive()
+
+    def stats(self):
+        """Return dictionary of write statistics.
+
+        Latencies are in milliseconds.
+        """
+        stats = {
+            'writes': self.writes,
+            'coalesced': self.coalesced,
+            'errors': self.errors,
+            }
+        if self.latencies:
+            millis = np.array(self.latencies)*1000
+            stats['latency_mean'] = float(millis.mean())
+            stats['latency_p95'] = float(np.percentile(millis, 95))
+            stats['latency_max'] = float(millis.max())
+        return stats
+
+    def _run(self):
+        """Write commands until stopped."""
+        while True:
+            taken = self.mailbox.take()
+            if taken is None:
+                return
+            (cmd, trace), posted_time = taken
+            tracing.mark(trace, 'writer')
+            try:
+                self.write(cmd)
+            except Exception as err:
+                self.errors += 1
+                print('Writing command {} failed: {}'.format(cmd, err))
+                continue
+            self.writes += 1
+            self.latencies.append(time.monotonic() - posted_time)
+            tracing.finish(trace, 'written')
@@ -0,0 +1,205 @@
+"""Sending driving commands to the wheelchair at a fixed rate.
+
+Controllers give new commands whenever their own timers or callbacks
+run, on the Qt thread or some other thread. If commands were sent to
+the wheelchair right then, GUI repaints and garbage collection pauses
+on the Qt thread would show up as irregular command timing at the
+wheelchair, and the firmware stops the wheelchair if it gets no command
+for 0.5 seconds.
+
+ControlLoop runs in its own thread instead. Controllers only update the
+setpoint, and the loop sends the newest one at a fixed rate, scheduled
+against absolute deadlines so that timing errors do not accumulate. A
+setpoint older than the timeout is replaced with the neutral command,
+so a stalled controller stops the wheelchair while the firmware's
+watchdog is still kept fed. The timeout is lengthened for controllers
+giving setpoints less often than that (see set_input_period). The thread can be given a raised OS
+scheduling priority.
+"""
+
+import os
+import sys
+import time
+import threading
+import collections
+
+import numpy as np
+
+import tracing
+
+# Setpoint timeout is at least this many intervals of the slowest
+# controller, see ControlLoop.set_input_period.
+SETPOINT_PERIODS = 3
+
+class ControlLoop:
+    """Send the latest setpoint at a fixed rate in a thread.
+
+    Usage: create with the function sending a command, start when the
+    wheelchair is connected, set setpoints from controllers, and stop
+    when disconnected.
+
+    Statistics are in attributes:
+    ticks -- Commands sent.
+    deadline_misses -- Ticks started more than one period late or
+        taking longer than one period. Missed ticks are skipped, not
+        sent late in a burst.
+    timeouts -- Ticks which sent the neutral command because the
+        setpoint was too old.
+    jitter -- Seconds from the deadline to the start of the latest
+        ticks.
+
+    Arguments:
+    send -- Function called with each command and its trace (see
+        tracing.py), in the loop thread. It should not block (see
+        command_mailbox.MailboxWriter). Only the first send of a
+        setpoint is given its trace, and None after that.
+    neutral -- Command sent when there is no fresh setpoint.
+    rate -- Commands sent per second (float).
+    timeout -- Seconds a setpoint is used before sending neutral
+        (float).
+    priority -- Real-time priority of the thread (SCHED_FIFO, 1-99) on
+        Linux, or any value for highest thread priority on Windows.
+        Normal priority if None (int).
+    name -- Name of the thread (str).
+    history -- Number of jitter values kept (int).
+    """
+
+    def __init__(self, send, neutral, rate=20.0, timeout=0.25, priority=None,
+                 name='control-loop', history=1000):
+        self.send = send
+        self.neutral = neutral
+        self.period = 1.0 / rate
+        self.base_timeout = timeout
+        self.timeout = timeout
+        self.priority = priority
+        self.name = name
+
+        self.ticks = 0
+        self.deadline_misses = 0
+        self.timeouts = 0
+        self.jitter = collections.deque(maxlen=history)
+
+        self._lock = threading.Lock()
+        self._setpoint = neutral
+        self._setpoint_time = 0.0
+        self._trace = None
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def set_setpoint(self, cmd, trace=None):
+        """Set the command to send from the next tick on.
+
+        Arguments:
+        cmd -- Command to send.
+        trace -- Trace of the command, see tracing.py.
+        """
+        with self._lock:
+            self._setpoint = cmd
+            self._setpoint_time = time.monotonic()
+            self._trace = trace
+
+    def set_input_period(self, period):
+        """Set the longest interval at which setpoints are given.
+
+        The timeout is made at least SETPOINT_PERIODS such intervals,
+        so that a slow controller (like eye tracking at its lowest
+        frame rate) does not fall to neutral between its setpoints,
+        while a stalled one still stops the wheelchair.
+
+        Arguments:
+        period -- Seconds between setpoints, or None to use the timeout
+            given when created (float).
+        """
+        if period is None:
+            self.timeout = self.base_timeout
+        else:
+            self.timeout = max(self.base_timeout, SETPOINT_PERIODS * period)
+
+    def start(self):
+        """Start the loop thread, if it is not running."""
+        if self.is_running():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """Stop the loop thread after the tick in progress."""
+        self._stop_event.set()
+        thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(timeout)
+
+    def is_running(self):
+        """Return True if the loop thread is running."""
+        return self._thread is not None and self._thread.is_alive()
+
+    def stats(self):
+        """Return dictionary of loop statistics.
+
+        Jitter is in milliseconds.
+        """
+        stats = {
+            'ticks': self.ticks,
+            'deadline_misses': self.deadline_misses,
+            'timeouts': self.timeouts,
+            }
+        if self.jitter:
+            millis = np.array(self.jitter)*1000
+            stats['jitter_mean'] = float(millis.mean())
+            stats['jitter_p95'] = float(np.percentile(millis, 95))
+            stats['jitter_max'] = float(millis.max())
+        return stats
+
+    def _raise_priority(self):
+        """Raise scheduling priority of the calling thread.
+
+        Failing (usually for lack of permissions) is not fatal, the
+        loop runs at normal priority then.
+        """
+        try:
+            if sys.platform.startswith('linux'):
+                # With pid 0 only the calling thread is changed.
+                os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(self.priority))
+            elif sys.platform.startswith('win'):
+                import ctypes
+                thread_priority_highest = 2
+                kernel32 = ctypes.windll.kernel32
+                if not kernel32.SetThreadPriority(kernel32.GetCurrentThread(),
+                                                  thread_priority_highest):
+                    raise OSError('SetThreadPriority failed')
+        except (OSError, ValueError) as err:
+            print('Could not raise priority of {}: {}'.format(self.name, err))
+
+    def _run(self):
+        """Send setpoints at deadlines until stopped."""
+        if self.priority is not None:
+            self._raise_priority()
+        deadline = time.monotonic()
+        while not self._stop_event.wait(max(0.0, deadline - time.monotonic())):
+            start = time.monotonic()
+            late = start - deadline
+            self.jitter.append(late)
+
+            with self._lock:
+                cmd = self._setpoint
+                fresh = start - self._setpoint_time <= self.timeout
+                trace, self._trace = self._trace, None
+            if not fresh:
+                cmd = self.neutral
+                trace = None
+                self.timeouts += 1
+            tracing.mark(trace, 'control_loop')
+            try:
+                self.send(cmd, trace)
+            except Exception as err:
+                print('Sending command {} failed: {}'.format(cmd, err))
+            self.ticks += 1
+
+            deadline += self.period
+            now = time.monotonic()
+            if late > self.period or now - start > self.period:
+                self.deadline_misses += 1
+            if now > deadline:
+                # Skip the ticks already missed.
+                deadline = now
@@ -9,9 +9,22 @@ from PySide2.QtWidgets import QWidget
 from Phidget22.Phidget import *
 from Phidget22.Devices.Accelerometer import *
 
+from filters import FilterChain
+import tracing
+
+# Filters for both driving axes. Tilt is smoothed adaptively and small
+# tilts are counted as zero to prevent unwanted movements.
+AXIS_FILTER = [
+    {"type": "one_euro", "min_cutoff": 1.0, "beta": 0.05},
+    {"type": "dead_zone", "width": 50},
+    ]
+
 class AccelerometerController(QWidget):
     """Use accelerometer data to control the wheelchair
 
+    Acceleration of each axis is filtered with a chain of AXIS_FILTER,
+    which can be changed at runtime through self.forward_filter and
+    self.turn_filter (see filters.py).
     """
     name = 'Accelerometer glasses'
     def __init__(self, wheelchair):
@@ -19,6 +32,9 @@ class AccelerometerController(QWidget):
         self.wheelchair = wheelchair
         #self.init_ui()
 
+        self.forward_filter = FilterChain.from_config(AXIS_FILTER)
+        self.turn_filter = FilterChain.from_config(AXIS_FILTER)
+
         accelerometer0 = Accelerometer()
         accelerometer0.openWaitForAttachment(5000)
         accelerometer0.setDataInterval(50)
@@ -41,33 +57,28 @@ class AccelerometerController(QWidget):
     def write_command(self, accelerometer_obj, acceleration, timestamp):
         """Translate accelerometer data to driving commads.
 
-        Run whenever the accelerometer sends new data. If the
-        accelerometer tilt is too small, count is as zero to
-        prevent unwanted movements.
+        Run whenever the accelerometer sends new data. Tilt is
+        filtered, see AXIS_FILTER.
 
         Arguments:
         acceleration -- Acceleration data. 1.0 means 1g (float)
+        timestamp -- Time of the data in milliseconds (float).
         
         """
         #print("Acceleration: \t"+ str(acceleration[0])+ "  |  "+ str(acceleration[1])+ "  |  "+ str(acceleration[2]))
         #print("Timestamp: " + str(timestamp))
         #print("----------")
 
+        trace = tracing.start('accelerometer')
         cmd = [self.wheelchair.neutral, self.wheelchair.neutral]
 
         x = acceleration[0] # <0 backwards  | >0 forward
         y = acceleration[1]
         z = acceleration[2] # <0 left       | >0 rightward
 
-        cmd[0] = int(127*acceleration[0])
-
-        if abs(cmd[0]) < 50:
-            cmd[0] = 0
-
-        cmd[1] = int(127*acceleration[2])
-
-        if abs(cmd[1]) < 50:
-            cmd[1] = 0
+        seconds = timestamp / 1000
+        cmd[0] = int(self.forward_filter(127*acceleration[0], seconds))
+        cmd[1] = int(self.turn_filter(127*acceleration[2], seconds))
 
 
-        self.wheelchair.write_command(cmd[0], cmd[1])
+        self.wheelchair.write_command(cmd[0], cmd[1], trace)
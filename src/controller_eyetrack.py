@@ -6,20 +6,28 @@ for rnet_ble module by Tuomas Rantataro
 TODO: Pieces to create:
  - Display feed from camera when selecting
  - Calibration for max left/right eye movements
- - Adjusting camera settings (brightness, contrast, saturation, gain, exposure?)
+ - Adjusting camera settings from UI (brightness, contrast, saturation).
+     Exposure and gain are set per camera in camera_profiles.JSON.
      https://docs.opencv.org/2.4/modules/highgui/doc/reading_and_writing_images_and_video.html#videocapture-get
- - Do not crash when no camera is found
 """
 
 import time
-import statistics
+import json
 
 from PySide2.QtCore import Qt, QTimer, Slot
 from PySide2.QtWidgets import QWidget, QGridLayout, QLabel, \
-  QVBoxLayout, QHBoxLayout, QPushButton, QComboBox
+  QVBoxLayout, QHBoxLayout, QPushButton, QComboBox, QCheckBox
 from PySide2.QtGui import QImage, QPixmap
 
 from eyetracker import Eyetracker
+from eyetracker_process import EyetrackerProcess
+from binocular import BinocularTracker
+from frame_scheduler import FrameScheduler
+from filters import FilterChain
+import tracing
+
+# Confidence of filtered pupil position needed for steering with it.
+PUPIL_MIN_CONFIDENCE = 0.3
 
 class EyeTrackerController(QWidget):
     """A Qt Widget for eye tracking controller's UI
@@ -27,6 +35,20 @@ class EyeTrackerController(QWidget):
     Creates UI for calibrating eye tracker controller and showing its
     working principle.
 
+    Settings are loaded from config_eyetracker.JSON. If worker_process
+    is set, eye tracking is run in a separate process and each frame is
+    handled when its result arrives from there. pupil_method selects
+    how the pupil is found (see eyetracker.PUPIL_METHODS), and
+    pupil_tracking filters pupil position between frames instead of
+    using the filter chain in filter (see filters.py). blink_method
+    selects how blinks are detected (see eyetracker.BLINK_METHODS).
+    If binocular is set, both eyes are
+    tracked with the cameras in binocular_cameras (see binocular.py),
+    and worker_process is not used. Frames are handled at a rate
+    between min_fps and max_fps, depending on how long handling them
+    takes. Images are shown at most preview_fps times a second, and not
+    at all if preview is false.
+
     Arguments:
     wheelchair -- Wheelchair adapter currently in use.
     """
@@ -35,34 +57,67 @@ class EyeTrackerController(QWidget):
     def __init__(self, wheelchair):
         super().__init__()
         self.wheelchair = wheelchair
-        self.tracker = Eyetracker()
+
+        with open("resources/config_eyetracker.JSON") as config_file:
+            config = json.load(config_file)
+            self.use_process = config["worker_process"]
+            self.binocular = config["binocular"]
+            self.eye_search_timeout = config["eye_search_timeout"]
+
+        if self.binocular:
+            self.use_process = False
+            self.tracker = BinocularTracker(config["binocular_cameras"])
+        elif self.use_process:
+            self.tracker = EyetrackerProcess()
+            self.tracker.resultReady.connect(self.next_result)
+        else:
+            self.tracker = Eyetracker()
+        self.tracker.set_options(
+            pupil_method=config["pupil_method"],
+            pupil_tracking=config["pupil_tracking"],
+            blink_method=config["blink_method"])
+        self.tracking = False
 
         self.init_ui()
 
         self.tracker.eyeChanged.connect(self.update_calib_image)
+        self.tracker.eyeSearchProgress.connect(self.update_search_progress)
+        self.tracker.eyeSearchFailed.connect(self.eye_search_failed)
 
         self.start = time.time()
         self.end = self.start
         self.blinktimer = 0
         self.forwardmode = False
 
-        self.update_timer = QTimer()
-        self.update_timer.setInterval(50)
-        self.update_timer.timeout.connect(self.next_frame)
+        self.frame_scheduler = FrameScheduler(
+            config["min_fps"], config["max_fps"])
+        self.frame_scheduler.tick.connect(self.next_frame)
+        self.frame_scheduler.rateChanged.connect(self.update_rate)
+        # Commands are given once a frame, which may be slower than
+        # the control loop's setpoint timeout.
+        self.wheelchair.set_input_period(self.frame_scheduler.max_interval)
+
+        # Preview is rendered separately from tracking, at most
+        # preview_fps times a second and only when it is visible.
+        self.new_frame = False
+        self.preview_timer = QTimer()
+        self.preview_timer.setInterval(int(1000/config["preview_fps"]))
+        self.preview_timer.timeout.connect(self.update_preview)
+        self.set_preview(config["preview"])
+        self.preview_select.setChecked(config["preview"])
 
         self.dist_min = 9999
         self.dist_max = -9999
         self.dist_old = 0
 
-        self.distances = [0, 0, 0, 0]
+        self.dist_filter = FilterChain.from_config(config["filter"])
 
         self.rotate = 0
 
         self.rot_calibrated = False
 
     def __del__(self):
-        if self.tracker.cam:
-            self.tracker.cam.release()
+        self.tracker.release()
 
     def set_chair(self, wheelchair):
         """Set new wheelchair object
@@ -74,6 +129,7 @@ class EyeTrackerController(QWidget):
         wheelchair -- New wheelchair adapter to use.
         """
         self.wheelchair = wheelchair
+        self.wheelchair.set_input_period(self.frame_scheduler.max_interval)
 
     def init_ui(self):
         """Initialize user interface.
@@ -92,13 +148,26 @@ class EyeTrackerController(QWidget):
         self.main_image.setFixedSize(self.size())
 
         camera_select = QComboBox()
-        for i in self.tracker.cams:
-            camera_select.addItem('Camera {}'.format(i))
+        for cam in self.tracker.cams:
+            camera_select.addItem(cam.name)
         #cameraSelect.currentIndexChanged.connect(self.tracker.selectCamera)
         camera_select.activated.connect(self.tracker.select_camera)
+        if self.binocular:
+            camera_select.setCurrentIndex(self.tracker.cameras[0])
+            right_camera_select = QComboBox()
+            for cam in self.tracker.cams:
+                right_camera_select.addItem(cam.name)
+            right_camera_select.setCurrentIndex(self.tracker.cameras[1])
+            right_camera_select.activated.connect(
+                lambda num: self.tracker.select_camera(num, 1))
+
+        self.rate_label = QLabel()
 
-        calib_button = QPushButton('Find eye')
-        calib_button.clicked.connect(self.find_eye)
+        self.preview_select = QCheckBox('Show preview')
+        self.preview_select.toggled.connect(self.set_preview)
+
+        self.calib_button = QPushButton('Find eye')
+        self.calib_button.clicked.connect(self.find_eye)
 
         calib_look_button = QPushButton('Calibrate (Look forward)')
         calib_look_button.clicked.connect(self.calibrate_and_start)
@@ -112,12 +181,24 @@ class EyeTrackerController(QWidget):
         imgs.addWidget(self.blink_image)
 
         calib_layout = QVBoxLayout()
-        calib_layout.addWidget(calib_button)
+        calib_layout.addWidget(self.calib_button)
         calib_layout.addWidget(calib_look_button)
         calib_layout.addWidget(camera_select)
+        if self.binocular:
+            calib_layout.addWidget(right_camera_select)
+        calib_layout.addWidget(self.rate_label)
+        calib_layout.addWidget(self.preview_select)
         calib_layout.addLayout(labs)
         calib_layout.addLayout(imgs)
 
+        if not self.tracker.cams:
+            # Nothing to search or track. Cameras are listed again when
+            # the controller is chosen again.
+            self.calib_button.setEnabled(False)
+            calib_look_button.setEnabled(False)
+            self.rate_label.setText('No camera found. Connect a camera and '
+                                    'choose the controller again.')
+
         layout = QGridLayout(self)
         layout.addLayout(calib_layout, 0, 0)
         layout.addWidget(self.main_image, 0, 1)
@@ -127,22 +208,62 @@ class EyeTrackerController(QWidget):
     def find_eye(self):
         """Find eye location from image
 
-        Stops eye movement detection and tries to find an eye again.
+        Stops eye movement detection and tries to find an eye again in
+        background. If the search is already running, cancel it.
+        """
+        if self.tracker.is_searching():
+            self.tracker.cancel_find_eye()
+            return
+        self.stop_tracking()
+        self.calib_button.setText('Cancel search')
+        self.tracker.find_eye_async(self.eye_search_timeout)
+
+    @Slot(int, float)
+    def update_search_progress(self, attempts, elapsed):
+        """Show how long the eye has been searched for.
 
-        TODO: Move to another thread. Hangs UI until eye is found.
+        Arguments:
+        attempts -- Number of pictures searched (int).
+        elapsed -- Seconds since the search started (float).
+        """
+        self.calib_button.setText(
+            'Cancel search ({} frames, {:.0f} s)'.format(attempts, elapsed))
+
+    @Slot(str)
+    def eye_search_failed(self, reason):
+        """Tell that the eye was not found.
+
+        Arguments:
+        reason -- Why the search ended (str).
         """
-        self.update_timer.stop()
-        self.tracker.get_bounding_rectangle()
+        print(reason)
+        self.calib_button.setText('Find eye')
 
     @Slot()
     def calibrate_and_start(self):
         """Start tracking eye movements after calibration.
 
         Calibrate the user's eye to look forward and after that start
-        tracking its movements.
+        tracking its movements. Does nothing while the eye is being
+        searched for, since the search uses the tracker's pictures.
         """
-        self.tracker.calibrate()
-        self.update_timer.start()
+        if self.tracker.is_searching():
+            print('Searching for the eye, calibrate after it is found')
+            return
+        if not self.tracker.calibrate():
+            return
+        self.start_tracking()
+
+    def start_tracking(self):
+        """Start handling frames and driving the wheelchair."""
+        self.tracking = True
+        if not self.use_process:
+            self.frame_scheduler.start()
+
+    def stop_tracking(self):
+        """Stop handling frames."""
+        self.tracking = False
+        self.frame_scheduler.stop()
 
     @Slot()
     def set_max_dirs(self):
@@ -155,12 +276,23 @@ class EyeTrackerController(QWidget):
 
         Take image of an eye for calibration purpose.
         """
+        self.calib_button.setText('Find eye')
         img = self.tracker.eye_pic
         height, width, channels = img.shape
         convert_to_qt_format = QImage(img.data, width, height, width*channels, QImage.Format_RGB888)
         pm_eye = QPixmap.fromImage(convert_to_qt_format)
         self.main_image.setPixmap(pm_eye)
 
+    @Slot(float)
+    def update_rate(self, rate):
+        """Show rate of eye tracking.
+
+        Arguments:
+        rate -- Frames handled per second (float).
+        """
+        self.rate_label.setText('{:.1f} fps, {} deadlines missed'.format(
+            rate, self.frame_scheduler.deadline_misses))
+
     def check_blink(self):
         """Detect eye blinking.
 
@@ -184,14 +316,6 @@ class EyeTrackerController(QWidget):
                 self.forwardmode = True
             self.blinktimer = -9999
 
-    def moving_average(self, new_value):
-        """Calculate moving average of 5 previous frames.
-
-        """
-        self.distances.pop(0)
-        self.distances.append(new_value)
-        return statistics.mean(self.distances)
-
     def drive_wheelchair(self):
         """Set driving command to wheelchair.
 
@@ -203,9 +327,15 @@ class EyeTrackerController(QWidget):
         self.check_blink()
         if not self.tracker.blink:
             self.tracker.track_pupil()
-            dist_new = self.tracker.center[0] - self.tracker.pupil[0]
-
-            dist = self.moving_average(dist_new)
+            if self.tracker.pupil_tracking:
+                # Already filtered. Keep previous value if the pupil
+                # has not been found reliably.
+                if self.tracker.pupil_confidence >= PUPIL_MIN_CONFIDENCE:
+                    self.dist_old = self.tracker.center[0] - self.tracker.pupil_smoothed[0]
+                dist = self.dist_old
+            else:
+                dist_new = self.tracker.center[0] - self.tracker.pupil[0]
+                dist = self.dist_filter(dist_new, self.tracker.frame_time)
 
             if not self.rot_calibrated:
                 self.dist_min = min(self.dist_min, dist)
@@ -233,7 +363,35 @@ class EyeTrackerController(QWidget):
         else:
             cmd = [self.wheelchair.neutral, self.wheelchair.neutral]
 
-        self.wheelchair.write_command(cmd[0], cmd[1])
+        # Traced from capture of the frame.
+        trace = tracing.start('eyetracker', self.tracker.frame_time or None)
+        self.wheelchair.write_command(cmd[0], cmd[1], trace)
+
+    @Slot(bool)
+    def set_preview(self, enabled):
+        """Enable or disable showing images of eye tracking.
+
+        When disabled, the wheelchair is driven without drawing any
+        images.
+
+        Arguments:
+        enabled -- Show the images (bool).
+        """
+        self.preview = enabled
+        if self.use_process or self.binocular:
+            self.tracker.set_preview(enabled)
+        if enabled:
+            self.preview_timer.start()
+        else:
+            self.preview_timer.stop()
+
+    @Slot()
+    def update_preview(self):
+        """Show images of the newest frame tracked, if visible."""
+        if not self.new_frame or not self.isVisible():
+            return
+        self.new_frame = False
+        self.create_images()
 
     def create_images(self):
         """Create images visualizing eye tracker working principle.
@@ -243,6 +401,10 @@ class EyeTrackerController(QWidget):
         movement and blink detection.
         """
         self.tracker.draw()
+        if self.tracker.result_pic is None or self.tracker.pupil_pic is None \
+                or self.tracker.blink_pic is None:
+            # Pupil has not been searched yet.
+            return
         img = self.tracker.result_pic
         height, width, channels = img.shape
         bytes_per_line = channels*width
@@ -267,8 +429,19 @@ class EyeTrackerController(QWidget):
     def next_frame(self):
         """Things done for each frame of eye movement detection.
 
-        Run continously when controlling wheelchair.
+        Run continously when controlling wheelchair. Does nothing if
+        the camera has not captured a new frame since the last one, so
+        the UI does not wait for the camera. Images are not drawn here
+        but in update_preview, so driving never waits for them.
         """
-        self.tracker.take_snapshot()
+        if not self.tracker.take_snapshot(timeout=0):
+            self.frame_scheduler.idle()
+            return
         self.drive_wheelchair()
-        self.create_images()
+        self.new_frame = True
+
+    @Slot()
+    def next_result(self):
+        """Handle a new result from eye tracking process."""
+        if self.tracking:
+            self.next_frame()
@@ -8,6 +8,15 @@ from PySide2.QtCore import Qt, QTimer
 from PySide2.QtGui import QPixmap, QTransform
 from PySide2.QtWidgets import QWidget, QLabel, QGridLayout
 
+from filters import FilterChain
+import tracing
+
+# Filters for both driving axes. Speed grows to full in 0.25 seconds
+# instead of jumping, but drops right away when keys are released.
+AXIS_FILTER = [
+    {"type": "rate_limiter", "accelerate": 508},
+    ]
+
 class KeyboardController(QWidget):
     """Simple keyboard controller for wheelchair.
     
@@ -16,7 +25,9 @@ class KeyboardController(QWidget):
     reliable way. If opposing keys are pressed (left and right or up
     and down) at the same time, does not send command on that axis.
     Keypresses are visualized with a stylished arrow pad with lit
-    arrows for keys pressed.
+    arrows for keys pressed. Commands are filtered with a chain of
+    AXIS_FILTER for each axis, see self.forward_filter and
+    self.turn_filter.
     
     This controller could be much improved but does its job.
 
@@ -32,6 +43,11 @@ class KeyboardController(QWidget):
         # Variables for keypresses
         self.first_release = True
         self.keylist = []
+        # Trace of the latest key event not sent yet, see tracing.py.
+        self.trace = None
+
+        self.forward_filter = FilterChain.from_config(AXIS_FILTER)
+        self.turn_filter = FilterChain.from_config(AXIS_FILTER)
 
         self.release_timer = QTimer()
         self.release_timer.start(50)
@@ -89,9 +105,11 @@ class KeyboardController(QWidget):
             return "Right"
 
     def keyPressEvent(self, event):
+        self.trace = tracing.start('keyboard')
         self.keylist.append(event.key())
 
     def keyReleaseEvent(self, event):
+        self.trace = tracing.start('keyboard')
         self.keylist.remove(event.key())
 
     def processmultikeys(self, keyspressed):
@@ -125,6 +143,9 @@ class KeyboardController(QWidget):
             else:
                 cmd[1] = -127
 
+        cmd[0] = int(self.forward_filter(cmd[0]))
+        cmd[1] = int(self.turn_filter(cmd[1]))
+
         if key_up:
             self.forward_label.setPixmap(self.arrow2)
         else:
@@ -142,4 +163,5 @@ class KeyboardController(QWidget):
         else:
             self.left_label.setPixmap(self.arrow1.transformed(self.rotate_left))
 
-        self.wheelchair.write_command(cmd[0], cmd[1])
+        trace, self.trace = self.trace, None
+        self.wheelchair.write_command(cmd[0], cmd[1], trace)
@@ -9,7 +9,21 @@
  * seconds of last command. If BLE connection is intentionally 
  * closed it also returns DAC values so that the wheelchair stops.
  * 
- * Serial connection can be used for debugging purposes.
+ * Commands can also be written in an extended format to the command
+ * characteristic: forward, turn, a 16-bit sequence number and a
+ * 32-bit timestamp of the computer, little endian. The sequence
+ * number and timestamp of each command applied are sent back by
+ * notifying the acknowledgement characteristic, so the computer can
+ * measure round-trip time and lost commands (see link_stats.py).
+ * 
+ * Commands can also be sent over the serial connection (USB) in
+ * frames of 5 bytes: 0xAA 0x55 forward turn crc, where crc is the
+ * CRC-8 (polynomial 0x07, initial value 0) of forward and turn (see
+ * wheelchair_serial.py). Frames are parsed in loop() without blocking.
+ * After a frame with a wrong CRC, the next header is searched from its
+ * second byte on.
+ * Other bytes are skipped, so the serial connection can still be used
+ * for debugging output.
  * 
   */
 
@@ -18,8 +32,17 @@
 
 BLEService wheelchairService("19B10000-E8F2-537E-4F6C-D104768A1214"); // create service
 
-// create characteristic for controlling DAC values
-BLEShortCharacteristic driveCharacteristic("C1594143-F449-4DBE-855D-2D4C85A1AC88", BLERead | BLEWrite);
+// create characteristic for controlling DAC values. Write without
+// response lets the computer send commands without waiting for an
+// acknowledgement of each one.
+BLEShortCharacteristic driveCharacteristic("C1594143-F449-4DBE-855D-2D4C85A1AC88", BLERead | BLEWrite | BLEWriteWithoutResponse);
+
+// Characteristics for commands in the extended format and their
+// acknowledgements.
+const int COMMAND_LENGTH = 8;
+const int ACK_LENGTH = 6;
+BLECharacteristic commandCharacteristic("C1594144-F449-4DBE-855D-2D4C85A1AC88", BLEWrite | BLEWriteWithoutResponse, COMMAND_LENGTH, true);
+BLECharacteristic ackCharacteristic("C1594145-F449-4DBE-855D-2D4C85A1AC88", BLERead | BLENotify, ACK_LENGTH, true);
 
 const int ledNeutral = 128;
 
@@ -35,13 +58,23 @@ int LED_G = 23;
 int LED_B = 24;
 
 long int prevCommand = millis();
+// True when the wheelchair has been stopped for lack of commands.
+bool stopped = false;
+
+// Serial command frame, see parseSerial().
+const byte FRAME_HEADER_1 = 0xAA;
+const byte FRAME_HEADER_2 = 0x55;
+const int FRAME_LENGTH = 5;
+const byte CRC_POLYNOMIAL = 0x07;
+byte frame[FRAME_LENGTH];
+int frameIndex = 0;
 
 void setup() {
   pinMode(LED_R, OUTPUT);
   pinMode(LED_G, OUTPUT);
   
-  // Serial for debugging
-  Serial.begin(9600);
+  // Serial for commands and debugging
+  Serial.begin(115200);
   //while (!Serial);
   
   // begin BLE initialization
@@ -57,8 +90,10 @@ void setup() {
   // set the UUID for the service this peripheral advertises
   BLE.setAdvertisedService(wheelchairService);
 
-  // add the characteristic to the service
+  // add the characteristics to the service
   wheelchairService.addCharacteristic(driveCharacteristic);
+  wheelchairService.addCharacteristic(commandCharacteristic);
+  wheelchairService.addCharacteristic(ackCharacteristic);
 
   // add service
   BLE.addService(wheelchairService);
@@ -68,6 +103,7 @@ void setup() {
   BLE.setEventHandler(BLEDisconnected, blePeripheralDisconnectHandler);
 
   driveCharacteristic.setEventHandler(BLEWritten, driveCharacteristicWritten);
+  commandCharacteristic.setEventHandler(BLEWritten, commandCharacteristicWritten);
 
   // start advertising
   BLE.advertise();
@@ -82,13 +118,79 @@ void setup() {
 void loop() {
   
   BLE.poll();
+  parseSerial();
   long diff = millis() - prevCommand;
   
   if(diff > 500) { // stop wheelchair if no new command is received
-    setNeutral();
-    // slowdown
-    BLE.poll(5000);
+    if (!stopped) {
+      setNeutral();
+      stopped = true;
+    }
+    // slowdown, but keep reading serial commands
+    BLE.poll(5);
+  }
+}
+
+// Read bytes received over serial without blocking, and apply the
+// command of each complete frame with a correct CRC.
+void parseSerial() {
+  while (Serial.available() > 0) {
+    byte received = Serial.read();
+    if (frameIndex == 0 && received != FRAME_HEADER_1) {
+      continue;
+    }
+    if (frameIndex == 1 && received != FRAME_HEADER_2) {
+      // The byte may start the next frame
+      frameIndex = (received == FRAME_HEADER_1) ? 1 : 0;
+      continue;
+    }
+    frame[frameIndex++] = received;
+    if (frameIndex == FRAME_LENGTH) {
+      byte speedValue = frame[2];
+      byte directionValue = frame[3];
+      if (crc8(frame + 2, 2) == frame[4]) {
+        frameIndex = 0;
+        prevCommand = millis();
+        stopped = false;
+        setSpeed(speedValue);
+        setDirection(directionValue);
+      } else {
+        resyncFrame();
+      }
+    }
+  }
+}
+
+// CRC-8 of length bytes, same as crc8 in wheelchair_serial.py.
+byte crc8(const byte* data, int length) {
+  byte crc = 0;
+  for (int i = 0; i < length; i++) {
+    crc ^= data[i];
+    for (int bit = 0; bit < 8; bit++) {
+      if (crc & 0x80) {
+        crc = (crc << 1) ^ CRC_POLYNOMIAL;
+      } else {
+        crc <<= 1;
+      }
+    }
+  }
+  return crc;
+}
+
+// Drop the first byte of a frame with a wrong CRC and keep the
+// rest from the next header on, since a frame may start inside it.
+// Same as FrameParser in wheelchair_serial.py.
+void resyncFrame() {
+  int start = 1;
+  while (start < FRAME_LENGTH) {
+    if (frame[start] == FRAME_HEADER_1
+        && (start == FRAME_LENGTH - 1 || frame[start + 1] == FRAME_HEADER_2)) {
+      break;
+    }
+    start++;
   }
+  frameIndex = FRAME_LENGTH - start;
+  memmove(frame, frame + start, frameIndex);
 }
 
 void blePeripheralConnectHandler(BLEDevice central) {
@@ -106,6 +208,7 @@ void blePeripheralDisconnectHandler(BLEDevice central) {
 
 void driveCharacteristicWritten(BLEDevice central, BLECharacteristic characteristic) {
   prevCommand = millis();
+  stopped = false;
   int value = driveCharacteristic.value();
   int directionValue = 0x00FF & (value >> 8);
   int speedValue = 0x00FF & value;
@@ -120,6 +223,20 @@ void driveCharacteristicWritten(BLEDevice central, BLECharacteristic characteris
   setDirection(directionValue);
 }
 
+// Apply a command in the extended format and acknowledge it by
+// sending its sequence number and timestamp back.
+void commandCharacteristicWritten(BLEDevice central, BLECharacteristic characteristic) {
+  if (commandCharacteristic.valueLength() < COMMAND_LENGTH) {
+    return;
+  }
+  prevCommand = millis();
+  stopped = false;
+  const byte* value = commandCharacteristic.value();
+  setSpeed(value[0]);
+  setDirection(value[1]);
+  ackCharacteristic.writeValue(value + 2, ACK_LENGTH);
+}
+
 void DACInit() {
   pinMode(DAC_SS_PIN, OUTPUT);
   SPI.begin();
@@ -8,11 +8,71 @@ on horizontal axis and whether the eye is currently blinking or not.
 Written by Antti Alastalo, small modifications for Qt integration by
 Tuomas Rantataro.
 """
+import time
+import threading
+import functools
+
 import cv2
 import numpy as np
 
 from PySide2.QtCore import QObject, Signal
 
+from camera_capture import CameraCapture, DirectCapture
+from cameras import list_cameras, load_profile, save_profile, \
+    apply_profile, negotiate_profile
+from pupil_filter import PupilFilter
+
+# Width and height of the eye region (pixels).
+EYE_SIZE = 250
+# Padding around the eye region when processing only it: 2 pixels for
+# the median blur and 12 for erode and dilate in track_pupil.
+ROI_PAD = 14
+
+# Methods for finding the pupil: sweep tries a range of thresholds and
+# keeps the pupil found with the highest one, histogram picks one
+# threshold from the eye region's histogram and segments the pupil in
+# a single pass.
+PUPIL_METHODS = ('sweep', 'histogram')
+# Smallest blob accepted as a pupil (pixels).
+PUPIL_MIN_AREA = 300
+# How much lighter than its darkest pixels the pupil can be.
+PUPIL_THRESHOLD_MARGIN = 20
+
+# Methods for detecting blinks: erode counts white pixels left after
+# eroding the thresholded eye region, dark counts dark pixels from the
+# histogram of the eye region, which is shared with the pupil stage.
+BLINK_METHODS = ('erode', 'dark')
+# Gray level up to which a pixel is dark (the erode method uses it as
+# its threshold too).
+BLINK_DARK_LEVEL = 70
+# Eye is shut when it has less than this share of the dark pixels it
+# had open at calibration.
+BLINK_DARK_RATIO = 0.3
+
+# Tracking pupil between frames: window searched around the predicted
+# position (pixels), and filter confidence needed for using it.
+TRACK_WINDOW = 120
+TRACK_MIN_CONFIDENCE = 0.5
+
+# Structuring elements for erode and dilate, built once.
+KERNEL_PUPIL = np.ones((5, 5), np.uint8)
+KERNEL_BLINK = np.ones((15, 15), np.uint8)
+
+# Seconds to wait for a picture for calibration.
+CALIBRATION_TIMEOUT = 1.0
+
+# Pre-trained classifier for finding an eye.
+EYE_CASCADE = './resources/haarcascade_eye.xml'
+# Smallest eye searched for at full resolution (pixels).
+EYE_MIN_SIZE = 100
+# Scale of the picture where the eye is searched first.
+EYE_DETECT_SCALE = 0.5
+
+@functools.lru_cache(maxsize=None)
+def load_cascade(path):
+    """Load Haar-cascade classifier once and reuse it after that."""
+    return cv2.CascadeClassifier(path)
+
 class Eyetracker(QObject):
     """Class for eye, pupil and blinking detection.
 
@@ -20,27 +80,66 @@ class Eyetracker(QObject):
     functions detect_blink and track_pupil and draw. They don't call
     it by themselves to allow the same frame to be used for all of
     them, which is the wanted use case.
+
+    Frames are captured in a background thread (see CameraCapture),
+    and take_snapshot always gets the newest one.
+
+    Images processed for each frame are written to buffers which are
+    allocated once and reused while the frame and eye region keep their
+    size. self.allocations counts how many of these managed buffers
+    have been allocated, so it should not grow while tracking. Arrays
+    which OpenCV and numpy return (contours, connected component
+    statistics, pupil filter temporaries) are not counted, see
+    benchmark.py eyetracker --memory for measuring them.
+
+    Arguments:
+    source -- Object used instead of a camera, with the same read and
+        release methods as cv2.VideoCapture (for example
+        recording.ReplayCapture). Cameras are not searched if given.
+    threaded -- Capture frames in a background thread. Otherwise each
+        frame is read when take_snapshot is called (bool).
+    camera -- Index of the camera to open in self.cams, if source is
+        not given (int).
     """
     eyeChanged = Signal()
+    eyeSearchProgress = Signal(int, float)
+    eyeSearchFailed = Signal(str)
     #pupilChanged = Signal()
     #blinkChanged = Signal()
     #resultChanged = Signal()
 
-    def __init__(self):
+    def __init__(self, source=None, threaded=True, camera=0):
         super().__init__()
         self.cams = []
-        self.init_cameras()
         self.cam = None
-        try:
-            self.cam = cv2.VideoCapture(self.cams[0])
-        except IndexError:
-            print('No camera found. Add camera and try again.')
+        self.capture = None
+        self.camera_profile = None
+        self.threaded = threaded
+        if source is not None:
+            self._start_capture(source)
+        else:
+            self.init_cameras()
+            try:
+                self._open_camera(self.cams[camera])
+            except IndexError:
+                print('No camera found. Add camera and try again.')
 
         self.center = (0, 0)
         self.pupil = (0, 0)
         self.img = None
         self.blink_value = 0
         self.blink = False
+        self.blink_method = 'erode'
+        self.blink_dark_open = 0
+        self.dark_pixels = 0
+
+        self.pupil_method = 'sweep'
+        self.pupil_threshold = 0
+
+        self.pupil_tracking = False
+        self.pupil_filter = PupilFilter()
+        self.pupil_smoothed = (0, 0)
+        self.pupil_confidence = 0.0
 
         self.eye_pic = None
         self.pupil_pic = None
@@ -48,23 +147,54 @@ class Eyetracker(QObject):
         self.result_pic = None
 
         self.eye_rec = None
+        self._search_cancel = None
+        self._search_thread = None
+        self.roi_bw = None
+        self.roi_offset = (0, 0)
+        self.roi_eye = None
 
         self.frame = None
+        self.frame_time = 0.0
         self.frame_blurred = None
         self.frame_blurred_bw = None
+        self._eye_cumulative = None
+
+        self._buffers = {}
+        self.allocations = 0
+
+    def set_options(self, **options):
+        """Set options for eye tracking.
+
+        Arguments:
+        pupil_method -- Method for finding the pupil, one of
+            PUPIL_METHODS (str).
+        pupil_tracking -- Track pupil between frames, see track_pupil
+            (bool).
+        blink_method -- Method for detecting blinks, one of
+            BLINK_METHODS (str).
+        """
+        for name, value in options.items():
+            if name == 'pupil_method':
+                if value not in PUPIL_METHODS:
+                    raise ValueError('Unknown pupil method {}'.format(value))
+                self.pupil_method = value
+            elif name == 'pupil_tracking':
+                self.pupil_tracking = bool(value)
+                self.pupil_filter.reset()
+            elif name == 'blink_method':
+                if value not in BLINK_METHODS:
+                    raise ValueError('Unknown blink method {}'.format(value))
+                self.blink_method = value
+            else:
+                raise ValueError('Unknown eye tracker option {}'.format(name))
 
     def init_cameras(self):
         """Find cameras available.
 
-        OpenCV does not have method for listing cameras so doing a
-        brainless loop to find some.
+        Cameras are listed with cameras.list_cameras, which does not
+        open them. self.cams is a list of cameras.CameraInfo.
         """
-        for i in range(4): # There probably are less than 4 cameras
-            cap = cv2.VideoCapture(i)
-            if cap is not None and cap.isOpened():
-                self.cams.append(i)
-
-        print("{} cameras found".format(len(self.cams)))
+        self.cams = list_cameras()
 
     def select_camera(self, num):
         """Select camera to use for eye tracking.
@@ -72,86 +202,382 @@ class Eyetracker(QObject):
         Arguments:
         num -- Index for the camera to use.
         """
-        if self.cam:
-            self.cam.release()
+        self.release()
         try:
-            self.cam = cv2.VideoCapture(self.cams[num])
+            self._open_camera(self.cams[num])
         except IndexError:
             print('selectCamera: Invalid camera number {}', num)
 
-    def take_snapshot(self):
+    def _open_camera(self, camera):
+        """Open camera and start capturing frames from it.
+
+        The capture mode saved for the camera is used. If there is
+        none, a mode close to cameras.DEFAULT_PROFILE is negotiated
+        and saved. The mode used is saved to self.camera_profile.
+
+        Arguments:
+        camera -- Camera to open as cameras.CameraInfo.
+        """
+        cam = cv2.VideoCapture(camera.index)
+        if cam.isOpened():
+            profile = load_profile(camera)
+            if profile is None:
+                self.camera_profile = negotiate_profile(cam)
+                save_profile(camera, self.camera_profile)
+            else:
+                self.camera_profile = apply_profile(cam, profile)
+        self._start_capture(cam)
+
+    def _start_capture(self, cam):
+        """Start capturing frames from an opened camera.
+
+        Arguments:
+        cam -- Camera object with read and release methods.
+        """
+        self.cam = cam
+        if self.threaded:
+            self.capture = CameraCapture(cam)
+        else:
+            self.capture = DirectCapture(cam)
+        self.capture.start()
+
+    def release(self):
+        """Stop capturing frames and release the camera."""
+        if self.is_searching():
+            self.cancel_find_eye()
+            self._search_thread.join()
+        if self.capture:
+            # Released by the capture after its last read.
+            self.capture.stop(release=True)
+            self.capture = None
+        elif self.cam:
+            self.cam.release()
+        self.cam = None
+
+    def take_snapshot(self, timeout=None, full=False):
         """Take a picture from video stream
 
-        Take a picture for processing with other methods. Also process
-        it to black & white and median blurred for some methods.
+        Take the newest picture captured for processing with other
+        methods. Capture time of the picture is saved to
+        self.frame_time.
+
+        When the eye has been found, only the eye region (padded for
+        the filter kernels) is processed to black & white and median
+        blurred to self.roi_bw. Otherwise, or if full is set, the whole
+        picture is processed to self.frame_blurred and
+        self.frame_blurred_bw.
+
+        Arguments:
+        timeout -- Seconds to wait for a new picture. None waits until
+            there is one and 0 does not wait at all (float).
+        full -- Process the whole picture (bool).
+
+        Returns True if a new picture was taken, False otherwise.
+        """
+        if self.capture is None:
+            return False
+        ret, frame, timestamp = self.capture.read(self.frame, timeout)
+        if not ret:
+            return False
+        self.frame = frame
+        self.frame_time = timestamp
+        self._eye_cumulative = None
+        if full or self.eye_rec is None:
+            self.frame_blurred = cv2.medianBlur(
+                self.frame, 5, self._buffer('frame_blurred', self.frame.shape))
+            self.frame_blurred_bw = cv2.cvtColor(
+                self.frame_blurred, cv2.COLOR_BGR2GRAY,
+                self._buffer('frame_blurred_bw', self.frame.shape[:2]))
+        if self.eye_rec is not None:
+            self._process_roi()
+        return True
+
+    def _buffer(self, name, shape, dtype=np.uint8):
+        """Return a reusable buffer for an image.
+
+        The buffer is allocated only the first time, or if its shape or
+        type changes.
+
+        Arguments:
+        name -- Name of the buffer (str).
+        shape -- Shape of the image (tuple).
+        dtype -- Type of the image elements.
+        """
+        buf = self._buffers.get(name)
+        if buf is None or buf.shape != shape or buf.dtype != dtype:
+            buf = np.empty(shape, dtype)
+            self._buffers[name] = buf
+            self.allocations += 1
+        return buf
+
+    def _process_roi(self):
+        """Blur and convert the eye region of the frame to black & white.
+
+        The region is padded with ROI_PAD pixels on each side (where
+        the frame allows), so that the median blur and the morphology
+        in track_pupil give the same result inside the eye region as if
+        the whole frame was processed. The eye region inside self.roi_bw
+        is self.roi_eye as (x, y, width, height).
         """
-        _, self.frame = self.cam.read()
-        self.frame_blurred = cv2.medianBlur(self.frame, 5)
-        self.frame_blurred_bw = cv2.cvtColor(self.frame_blurred, cv2.COLOR_BGR2GRAY)
+        coord_x, coord_y, width, height = self.eye_rec
+        frame_height, frame_width = self.frame.shape[:2]
+        x_start = max(0, coord_x - ROI_PAD)
+        y_start = max(0, coord_y - ROI_PAD)
+        x_end = min(frame_width, coord_x + width + ROI_PAD)
+        y_end = min(frame_height, coord_y + height + ROI_PAD)
+
+        roi = self.frame[y_start:y_end, x_start:x_end]
+        blurred = cv2.medianBlur(roi, 5, self._buffer('roi_blurred', roi.shape))
+        self.roi_bw = cv2.cvtColor(
+            blurred, cv2.COLOR_BGR2GRAY, self._buffer('roi_bw', roi.shape[:2]))
+        self.roi_offset = (x_start, y_start)
+        self.roi_eye = (coord_x - x_start, coord_y - y_start, width, height)
+
+    def _eye_region(self, img):
+        """Return view of the eye region in image processed from self.roi_bw."""
+        return self._region(img, self.roi_eye)
+
+    def _eye_histogram(self):
+        """Return cumulative histogram of the eye region of self.roi_bw.
+
+        Element i is the number of pixels with gray level i or darker.
+        It is computed once per frame and shared by the blink and pupil
+        detection.
+        """
+        if self._eye_cumulative is None:
+            hist = cv2.calcHist([self._eye_region(self.roi_bw)], [0], None, [256], [0, 256],
+                                hist=self._buffer('eye_hist', (256, 1), np.float32))
+            self._eye_cumulative = np.cumsum(
+                hist.ravel(), out=self._buffer('eye_cumsum', (256,), np.float32))
+        return self._eye_cumulative
 
     def detect_blink(self):
         """Detect eye blinking
 
-        Detect whether eye is blinking or not. The frame is processed
-        to black and white. Pupil shows as black in processed image, so
-        blink is detected based on how many white pixels there are. The
-        region of interest is bounded by calibration done before.
+        Detect whether eye is blinking or not with the method selected
+        with self.blink_method, see BLINK_METHODS. The region of
+        interest is bounded by calibration done before.
 
         Returns True if the users eye is shut and False if it is open.
         """
-        frame = self.frame_blurred_bw
+        if self.blink_method == 'dark':
+            self.blink = self._detect_blink_dark()
+        else:
+            self.blink = self._detect_blink_erode()
+        return self.blink
 
-        coord_x, coord_y, width, height = \
-            self.eye_rec[0], self.eye_rec[1], self.eye_rec[2], self.eye_rec[3]
+    def _detect_blink_dark(self):
+        """Detect eye blinking from the number of dark pixels.
+
+        Pupil, iris and eyelashes are dark when the eye is open, and
+        the eyelid is lighter. The dark pixels are counted from the
+        histogram of the eye region, and compared to the count of the
+        open eye saved in self.blink_dark_open when the eye was found
+        or calibrated. Image for showing is made only in draw.
+
+        Returns True if the users eye is shut and False if it is open.
+        """
+        self.dark_pixels = int(self._eye_histogram()[BLINK_DARK_LEVEL])
+        return self.dark_pixels < BLINK_DARK_RATIO*self.blink_dark_open
+
+    def _detect_blink_erode(self):
+        """Detect eye blinking from eroded black and white image.
+
+        The frame is processed to black and white. Pupil shows as black
+        in processed image, so blink is detected based on how many
+        white pixels there are.
+
+        Returns True if the users eye is shut and False if it is open.
+        """
+        eye = self._eye_region(self.roi_bw)
         _, thresh = cv2.threshold( \
-            frame[coord_y:(coord_y+height), coord_x:(coord_x+width)], 70, 250, cv2.THRESH_BINARY)
-        thresh = cv2.erode(thresh, np.ones((15, 15), np.uint8), iterations=4)
+            eye, BLINK_DARK_LEVEL, 250, cv2.THRESH_BINARY,
+            self._buffer('blink_thresh', eye.shape))
+        thresh = cv2.erode(thresh, KERNEL_BLINK, self._buffer('blink_pic', eye.shape),
+                           iterations=4)
 
         self.blink_pic = thresh
         #self.blinkChanged.emit()
 
-        if cv2.countNonZero(thresh) >= self.blink_value:
-            self.blink = True
-            return True
-        self.blink = False
-        return False
+        return cv2.countNonZero(thresh) >= self.blink_value
 
-    def get_bounding_rectangle(self):
+    def calibrate_blink(self):
+        """Save number of dark pixels in the open eye.
+
+        Used by the dark blink method as reference, so the user's eye
+        must be open.
+        """
+        self.blink_dark_open = int(self._eye_histogram()[BLINK_DARK_LEVEL])
+
+    def get_bounding_rectangle(self, cancel=None, timeout=None, progress=None, near_last=False):
         """Find an eye from video frame and save its coordinates.
 
-        Try to find an eye from a picture taken from camera. Stays in
-        a forever loop until an eye is found. OpenCV's machine learning
-        toolset is used to find the eye by using a pre-trained Haar-
-        cascade classifier.
+        Try to find an eye from pictures taken from camera until an eye
+        is found, the search is cancelled or it times out. OpenCV's
+        machine learning toolset is used to find the eye by using a
+        pre-trained Haar-cascade classifier. To save time, the eye is
+        first searched from a downscaled picture and then refined at
+        full resolution.
 
         When an eye is found, updates location of the eye to variable
         self.eye_rec and whole picture used to variable self.eye_pic.
         Also emits a signal to update the image in UI.
+
+        Arguments:
+        cancel -- Stop searching when this threading.Event is set.
+        timeout -- Seconds to search before giving up. None searches
+            until an eye is found (float).
+        progress -- Called after each picture searched with number of
+            pictures searched and seconds elapsed.
+        near_last -- Search first around the previous eye location, and
+            the whole picture only if the eye is not found there (bool).
+
+        Returns True if an eye was found, False otherwise.
+        """
+        eye_cascade = load_cascade(EYE_CASCADE)
+        start = time.monotonic()
+        attempts = 0
+        while cancel is None or not cancel.is_set():
+            elapsed = time.monotonic() - start
+            if timeout is not None and elapsed > timeout:
+                return False
+            # Do not wait too long to be able to cancel.
+            if not self.take_snapshot(timeout=0.1, full=True):
+                continue
+            attempts += 1
+            if progress is not None:
+                progress(attempts, elapsed)
+
+            eye = None
+            if near_last and self.eye_rec is not None:
+                coord_x, coord_y, width, height = self.eye_rec
+                eye = self._detect_eye(eye_cascade, (
+                    coord_x - width//2, coord_y - height//2, 2*width, 2*height))
+            if eye is None:
+                eye = self._detect_eye_scaled(eye_cascade)
+            if eye is None:
+                continue
+
+            (coord_x, coord_y, width, height) = eye
+            self.eye_rec = self._eye_rectangle(
+                int(coord_x-(EYE_SIZE-width)/2), int(coord_y-(EYE_SIZE-height)/2))
+            #self.blink_value = cv2.countNonZero(thresh)+2000
+            self.blink_value = 62000
+            self.pupil_filter.reset()
+            top_left = (self.eye_rec[0], self.eye_rec[1])
+            bottom_right = (self.eye_rec[0] + self.eye_rec[2],\
+                            self.eye_rec[1] + self.eye_rec[3])
+            # Copied, since the buffer is reused for the next frame.
+            self.eye_pic = cv2.rectangle(
+                self.frame_blurred.copy(), top_left, bottom_right, (0, 0, 220), 3)
+            self._process_roi()
+            self._eye_cumulative = None
+            self.calibrate_blink()
+            self.eyeChanged.emit()
+            return True
+        return False
+
+    def _detect_eye_scaled(self, eye_cascade):
+        """Find an eye from downscaled frame and refine its location.
+
+        Returns the eye as (x, y, width, height) in full resolution
+        coordinates, or None if no eye was found.
+        """
+        small = cv2.resize(self.frame_blurred_bw, None,
+                           fx=EYE_DETECT_SCALE, fy=EYE_DETECT_SCALE,
+                           interpolation=cv2.INTER_AREA)
+        min_size = int(EYE_MIN_SIZE*EYE_DETECT_SCALE)
+        eyes = eye_cascade.detectMultiScale(small, 1.2, 1, minSize=(min_size, min_size))
+        if len(eyes) == 0:
+            return None
+        coord_x, coord_y, width, height = \
+            (int(value/EYE_DETECT_SCALE) for value in eyes[0])
+        refined = self._detect_eye(eye_cascade, (
+            coord_x - width//2, coord_y - height//2, 2*width, 2*height))
+        if refined is None:
+            return (coord_x, coord_y, width, height)
+        return refined
+
+    def _detect_eye(self, eye_cascade, region):
+        """Find an eye from a region of the frame at full resolution.
+
+        Arguments:
+        eye_cascade -- Classifier used to find the eye.
+        region -- Region to search as (x, y, width, height). Parts
+            outside the frame are left out.
+
+        Returns the eye as (x, y, width, height) in frame coordinates,
+        or None if no eye was found.
+        """
+        frame_height, frame_width = self.frame_blurred_bw.shape
+        x_start = max(0, region[0])
+        y_start = max(0, region[1])
+        x_end = min(frame_width, region[0] + region[2])
+        y_end = min(frame_height, region[1] + region[3])
+        if x_end - x_start < EYE_MIN_SIZE or y_end - y_start < EYE_MIN_SIZE:
+            return None
+        eyes = eye_cascade.detectMultiScale(
+            self.frame_blurred_bw[y_start:y_end, x_start:x_end],
+            1.2, 1, minSize=(EYE_MIN_SIZE, EYE_MIN_SIZE))
+        if len(eyes) == 0:
+            return None
+        coord_x, coord_y, width, height = eyes[0]
+        return (x_start + int(coord_x), y_start + int(coord_y), int(width), int(height))
+
+    def find_eye_async(self, timeout=None):
+        """Find an eye in a background thread.
+
+        Searches first around the previous eye location if there is
+        one. Emits eyeSearchProgress after each picture searched,
+        eyeChanged when an eye is found and eyeSearchFailed if the
+        search is cancelled or times out. Does nothing if a search is
+        already running.
+
+        Arguments:
+        timeout -- Seconds to search before giving up. None searches
+            until an eye is found (float).
+        """
+        if self.is_searching():
+            return
+        self._search_cancel = threading.Event()
+        self._search_thread = threading.Thread(
+            target=self._search_eye,
+            args=(self._search_cancel, timeout),
+            daemon=True)
+        self._search_thread.start()
+
+    def _search_eye(self, cancel, timeout):
+        """Search for an eye and emit signal if it was not found."""
+        if not self.get_bounding_rectangle(
+                cancel, timeout, self.eyeSearchProgress.emit, near_last=True):
+            if cancel.is_set():
+                self.eyeSearchFailed.emit('Eye search cancelled')
+            else:
+                self.eyeSearchFailed.emit('No eye found in {} seconds'.format(timeout))
+
+    def cancel_find_eye(self):
+        """Cancel eye search running in background."""
+        if self._search_cancel is not None:
+            self._search_cancel.set()
+
+    def is_searching(self):
+        """Return True if eye search is running in background."""
+        return self._search_thread is not None and self._search_thread.is_alive()
+
+    def _eye_rectangle(self, coord_x, coord_y):
+        """Return eye region at given position, moved inside the frame.
+
+        Arguments:
+        coord_x, coord_y -- Top left corner of the region (int).
+
+        Returns eye region as (x, y, width, height).
         """
-        eye_cascade = cv2.CascadeClassifier('./resources/haarcascade_eye.xml')
-        eye_found = False
-        while not eye_found:
-            self.take_snapshot()
-            frame = self.frame_blurred
-            eyes = eye_cascade.detectMultiScale(frame, 1.2, 1, minSize=(100, 100))
-            if len(eyes) > 0:
-                (coord_x, coord_y, width, height) = eyes[0]
-                self.eye_rec = (int(coord_x-(250-width)/2), int(coord_y-(250-height)/2), 250, 250)
-                coord_x2, coord_y2, width2, height2 = \
-                    self.eye_rec[0], self.eye_rec[1], self.eye_rec[2], self.eye_rec[3]
-                _, thresh = cv2.threshold(\
-                    frame[coord_y2:(coord_y2+height2), coord_x2:(coord_x2+width2)], \
-                    70, 250, cv2.THRESH_BINARY)
-                thresh = cv2.erode(thresh, np.ones((10, 10), np.uint8), iterations=4)
-                #self.blink_value = cv2.countNonZero(thresh)+2000
-                self.blink_value = 62000
-                top_left = (self.eye_rec[0], self.eye_rec[1])
-                bottom_right = (self.eye_rec[0] + self.eye_rec[2],\
-                                self.eye_rec[1] + self.eye_rec[3])
-                self.eye_pic = cv2.rectangle(frame, top_left, bottom_right, (0, 0, 220), 3)
-                self.eyeChanged.emit()
-                eye_found = True
-                break
+        frame_height, frame_width = self.frame.shape[:2]
+        width = min(EYE_SIZE, frame_width)
+        height = min(EYE_SIZE, frame_height)
+        coord_x = min(max(0, coord_x), frame_width - width)
+        coord_y = min(max(0, coord_y), frame_height - height)
+        return (coord_x, coord_y, width, height)
 
     def track_pupil(self):
         """Find position of pupil
@@ -159,27 +585,136 @@ class Eyetracker(QObject):
         Finds the position of the pupil and saves it in self.pupil as a
         tuple (x,y). Also updates image of pupil detection in
         self.pupil_pic and emits a signal indicating it changing.
+
+        Method used is selected with self.pupil_method, see
+        PUPIL_METHODS.
+
+        If self.pupil_tracking is set, pupil position is also filtered
+        with PupilFilter to self.pupil_smoothed, with confidence in
+        self.pupil_confidence. While confidence is high enough, pupil
+        is searched only from a TRACK_WINDOW sized window around its
+        predicted position, and from the whole eye region only if it is
+        not found there.
+
+        Returns True if pupil was found, False otherwise.
         """
-        frame = self.frame_blurred_bw
+        # Qt image requiers a c-contiguous array
+        self.pupil_pic = self._buffer('pupil_pic', self.roi_eye[3:1:-1])
+
+        found = False
+        if self.pupil_tracking and self.pupil_filter.confidence >= TRACK_MIN_CONFIDENCE:
+            window = self._tracking_window(self.pupil_filter.predict(self.frame_time))
+            found = self._find_pupil(window, '_window')
+        if not found:
+            found = self._find_pupil(self.roi_eye, '')
+
+        if self.pupil_tracking:
+            if found:
+                self.pupil_filter.update(self.pupil, self.frame_time)
+            else:
+                self.pupil_filter.miss(self.frame_time)
+            self.pupil_smoothed = self.pupil_filter.position
+            self.pupil_confidence = self.pupil_filter.confidence
+        return found
+
+    def _tracking_window(self, predicted):
+        """Return search window around predicted pupil position.
 
-        coord_x, coord_y, width, height = \
-            self.eye_rec[0], self.eye_rec[1], self.eye_rec[2], self.eye_rec[3]
+        Arguments:
+        predicted -- Predicted pupil position in frame coordinates.
+
+        Returns the window as (x, y, width, height) in self.roi_bw
+        coordinates, limited to the eye region.
+        """
+        eye_x, eye_y, eye_width, eye_height = self.roi_eye
+        width = min(TRACK_WINDOW, eye_width)
+        height = min(TRACK_WINDOW, eye_height)
+        coord_x = int(predicted[0]) - self.roi_offset[0] - width//2
+        coord_y = int(predicted[1]) - self.roi_offset[1] - height//2
+        coord_x = min(max(eye_x, coord_x), eye_x + eye_width - width)
+        coord_y = min(max(eye_y, coord_y), eye_y + eye_height - height)
+        return (coord_x, coord_y, width, height)
+
+    def _find_pupil(self, region, key):
+        """Find pupil from a region of self.roi_bw with selected method.
+
+        The region is processed with ROI_PAD pixels of padding around it
+        where self.roi_bw allows. Result of the detection is drawn to
+        the matching part of self.pupil_pic, rest of it is left white.
+
+        Arguments:
+        region -- Region to search as (x, y, width, height) in
+            self.roi_bw coordinates.
+        key -- Suffix for names of the buffers used, so that searching
+            different sized regions does not reallocate them (str).
+
+        Returns True if pupil was found, False otherwise.
+        """
+        coord_x, coord_y, width, height = region
+        roi_height, roi_width = self.roi_bw.shape
+        x_start = max(0, coord_x - ROI_PAD)
+        y_start = max(0, coord_y - ROI_PAD)
+        x_end = min(roi_width, coord_x + width + ROI_PAD)
+        y_end = min(roi_height, coord_y + height + ROI_PAD)
+        padded = self.roi_bw[y_start:y_end, x_start:x_end]
+        inner = (coord_x - x_start, coord_y - y_start, width, height)
+
+        eye_x, eye_y = self.roi_eye[0], self.roi_eye[1]
+        pic = self.pupil_pic[(coord_y-eye_y):(coord_y-eye_y+height),
+                             (coord_x-eye_x):(coord_x-eye_x+width)]
+        if pic.shape != self.pupil_pic.shape:
+            self.pupil_pic.fill(255)
+
+        if self.pupil_method == 'histogram':
+            center = self._track_pupil_histogram(padded, inner, pic, key)
+        else:
+            center = self._track_pupil_sweep(padded, inner, pic, key)
+        if center is None:
+            return False
+        self.pupil = (self.roi_offset[0] + x_start + inner[0] + center[0],
+                      self.roi_offset[1] + y_start + inner[1] + center[1])
+        return True
+
+    @staticmethod
+    def _region(img, region):
+        """Return view of a region (x, y, width, height) of image."""
+        coord_x, coord_y, width, height = region
+        return img[coord_y:(coord_y+height), coord_x:(coord_x+width)]
+
+    def _track_pupil_sweep(self, frame, region, pic, key):
+        """Find position of pupil by sweeping the threshold.
+
+        All thresholds are tried, and the pupil found with the highest
+        of them is used, like the original track_pupil did.
+
+        Arguments:
+        frame -- Black & white image to process.
+        region -- Region of frame where the pupil is searched from as
+            (x, y, width, height). Rest of frame is padding.
+        pic -- Image where the thresholded region is copied to.
+        key -- Suffix for names of the buffers used (str).
+
+        Returns pupil position relative to region as tuple (x, y), or
+        None if pupil was not found.
+        """
+        thresh_buf = self._buffer('pupil_thresh' + key, frame.shape)
+        eroded_buf = self._buffer('pupil_eroded' + key, frame.shape)
+        dilated_buf = self._buffer('pupil_dilated' + key, frame.shape)
+        center = None
+        found = None
         # i is the threshold value used to make the binary image.
-        # It is increased until a pupil is found.
         for i in range(45, 90, 2):
-            _, thresh = cv2.threshold(frame, i, 250, cv2.THRESH_BINARY)
+            _, thresh = cv2.threshold(frame, i, 250, cv2.THRESH_BINARY, thresh_buf)
             # Erode and dilate functions make the pupil
             # a single blob in the thresholded binary image.
-            thresh = cv2.erode(thresh, np.ones((5, 5), np.uint8), iterations=4)
-            thresh = cv2.dilate(thresh, np.ones((5, 5), np.uint8), iterations=2)
+            thresh = cv2.erode(thresh, KERNEL_PUPIL, eroded_buf, iterations=4)
+            thresh = cv2.dilate(thresh, KERNEL_PUPIL, dilated_buf, iterations=2)
 
-            # Qt image requiers a c-contiguous array
-            self.pupil_pic = np.ascontiguousarray(\
-                thresh[coord_y:(coord_y+height), coord_x:(coord_x+width)])
+            np.copyto(pic, self._region(thresh, region))
             #self.pupilChanged.emit()
 
             contours, _ = cv2.findContours(\
-                thresh[coord_y:(coord_y+height), coord_x:(coord_x+width)], \
+                self._region(thresh, region), \
                 cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
             large_blob = contours[0]
             max_area = 0
@@ -195,21 +730,79 @@ class Eyetracker(QObject):
                 # If only one contour is found no pupil is detected.
                 if len(contours) > 1:
                     center = cv2.moments(large_blob)
-                if center['m00'] != 0.0:
-                    center_coord_x, center_coord_y = \
-                        int(center['m10']/center['m00']), int(center['m01']/center['m00'])
-                    self.pupil = (coord_x+center_coord_x, coord_y+center_coord_y)
+                if center is not None and center['m00'] != 0.0:
+                    found = (int(center['m10']/center['m00']),
+                             int(center['m01']/center['m00']))
                     break
+        return found
+
+    def _track_pupil_histogram(self, frame, region, pic, key):
+        """Find position of pupil with a single threshold.
+
+        The threshold is chosen from the histogram of the region:
+        pupil is the darkest blob, so the darkest PUPIL_MIN_AREA pixels
+        belong to it. Threshold is set PUPIL_THRESHOLD_MARGIN above
+        their gray level, and limited to the range the sweep uses.
+        Largest connected blob below the threshold is the pupil.
+
+        Arguments are the same as for _track_pupil_sweep.
+
+        Returns pupil position relative to region as tuple (x, y), or
+        None if pupil was not found.
+        """
+        if key == '':
+            # The whole eye region, histogram is shared with blinks.
+            cumulative = self._eye_histogram()
+        else:
+            hist = cv2.calcHist([self._region(frame, region)], [0], None, [256], [0, 256],
+                                hist=self._buffer('pupil_hist' + key, (256, 1), np.float32))
+            cumulative = np.cumsum(
+                hist.ravel(), out=self._buffer('pupil_cumsum' + key, (256,), np.float32))
+        darkest = int(np.searchsorted(cumulative, PUPIL_MIN_AREA))
+        self.pupil_threshold = min(max(darkest + PUPIL_THRESHOLD_MARGIN, 45), 89)
+
+        # Pupil is white in the mask. Opening removes eyelashes and
+        # other thin dark details from it.
+        _, mask = cv2.threshold(
+            frame, self.pupil_threshold, 255, cv2.THRESH_BINARY_INV,
+            self._buffer('pupil_thresh' + key, frame.shape))
+        mask = cv2.morphologyEx(
+            mask, cv2.MORPH_OPEN, KERNEL_PUPIL,
+            self._buffer('pupil_eroded' + key, frame.shape), iterations=2)
+        mask = self._region(mask, region)
+
+        # Pupil is shown black like with the sweep.
+        np.bitwise_not(mask, out=pic)
+
+        count, _, stats, centroids = cv2.connectedComponentsWithStats(
+            mask, self._buffer('pupil_labels' + key, mask.shape, np.int32),
+            connectivity=8)
+        if count < 2:
+            # Only background, no pupil found.
+            return None
+        largest = 1 + int(np.argmax(stats[1:, cv2.CC_STAT_AREA]))
+        if stats[largest, cv2.CC_STAT_AREA] < PUPIL_MIN_AREA:
+            return None
+        center_coord_x, center_coord_y = centroids[largest]
+        return (int(center_coord_x), int(center_coord_y))
 
     def calibrate(self):
         """Calibrate looking forward
 
         Set zero point, meaning in what position pupil is assumed to be
-        facing directly forward to self.center
+        facing directly forward to self.center. The eye is open, so the
+        blink detection is calibrated too.
+
+        Returns True if calibrated, False if the camera gave no picture
+        in CALIBRATION_TIMEOUT seconds.
         """
-        self.take_snapshot()
+        if not self.take_snapshot(CALIBRATION_TIMEOUT):
+            print('No picture from camera, not calibrated')
+            return False
         self.track_pupil()
         self.center = self.pupil
+        self.calibrate_blink()
+        return True
 
     def draw(self):
         """Create image with descripting text and graphics.
@@ -221,6 +814,13 @@ class Eyetracker(QObject):
         Updates the resulting picture to self.result_pic and emit a
         signal to signify it.
         """
+        if self.blink_method == 'dark':
+            # Blink detection does not make an image, show the dark
+            # pixels it counted.
+            eye = self._eye_region(self.roi_bw)
+            _, self.blink_pic = cv2.threshold(
+                eye, BLINK_DARK_LEVEL, 255, cv2.THRESH_BINARY,
+                self._buffer('blink_pic', eye.shape))
         frame = self.frame
         if self.blink:
             string = "BLINK"
@@ -0,0 +1,445 @@
+"""Eye tracking in a separate process.
+
+Runs Eyetracker in a worker process so that the vision pipeline can
+use a full core without competing with the GUI and Bluetooth threads
+for the GIL. Images are passed back through shared memory, and small
+results (pupil position, blink, timestamps) through a pipe.
+
+EyetrackerProcess has the same interface as Eyetracker, so
+EyeTrackerController can use either of them.
+"""
+
+import time
+import threading
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from PySide2.QtCore import QObject, Signal, Slot, QSocketNotifier
+
+# Images passed from the worker to the UI.
+IMAGES = ('result_pic', 'pupil_pic', 'blink_pic')
+# Number of shared memory buffers for each image. The worker writes to
+# one while the UI reads the other.
+SLOTS = 2
+# Seconds to wait for the worker to reply to calibration. The worker
+# may be in the middle of a frame, and waits for a picture itself.
+CALIBRATION_REPLY_TIMEOUT = 3.0
+
+
+class _SharedImages:
+    """Worker side shared memory buffers for one image.
+
+    A new buffer is created if the image grows larger than the current
+    one, for example when the camera is changed.
+    """
+
+    def __init__(self):
+        self.blocks = [None] * SLOTS
+
+    def write(self, slot, img):
+        """Copy image to shared memory and return its description."""
+        block = self.blocks[slot]
+        if block is None or block.size < img.nbytes:
+            if block is not None:
+                block.close()
+                block.unlink()
+            block = shared_memory.SharedMemory(create=True, size=max(img.nbytes, 1))
+            self.blocks[slot] = block
+        dst = np.ndarray(img.shape, dtype=img.dtype, buffer=block.buf)
+        np.copyto(dst, img)
+        return (block.name, img.shape, img.dtype.str)
+
+    def close(self):
+        """Release all shared memory buffers."""
+        for block in self.blocks:
+            if block is not None:
+                block.close()
+                block.unlink()
+        self.blocks = [None] * SLOTS
+
+
+def _worker_main(conn, locks, slot_seqs):
+    """Main loop of the eye tracking worker process.
+
+    Tracks the eye continuously after it has been found, and sends
+    the results of each frame to the UI process. Commands from the UI
+    process are handled between frames.
+
+    Arguments:
+    conn -- Worker end of the pipe to the UI process.
+    locks -- Locks for the shared memory slots, one for each slot.
+    slot_seqs -- Sequence number of the message whose images are in
+        each slot, written with the images (shared array).
+    """
+    # Imported here so the UI process does not need to load OpenCV
+    # just for starting the worker.
+    from eyetracker import Eyetracker
+
+    tracker = Eyetracker()
+    conn.send(('cameras', tracker.cams))
+
+    images = {name: _SharedImages() for name in IMAGES + ('eye_pic',)}
+    slot = 0
+    seq = 0
+
+    def publish(names):
+        """Copy images to shared memory and return their descriptions."""
+        with locks[slot]:
+            slot_seqs[slot] = seq
+            return {name: images[name].write(slot, getattr(tracker, name))
+                    for name in names if getattr(tracker, name) is not None}
+
+    cancel = threading.Event()
+    pending = []
+    preview = True
+
+    def search_progress(attempts, elapsed):
+        """Report eye search progress and check if it was cancelled."""
+        conn.send(('progress', (attempts, elapsed)))
+        while conn.poll():
+            cmd = conn.recv()
+            if cmd[0] in ('cancel_find_eye', 'stop'):
+                cancel.set()
+            if cmd[0] != 'cancel_find_eye':
+                pending.append(cmd)
+
+    try:
+        while True:
+            # Handle commands. Wait for them if eye has not been found
+            # yet, since there is nothing to track.
+            while pending or conn.poll(0 if tracker.eye_rec else 0.1):
+                cmd, *args = pending.pop(0) if pending else conn.recv()
+                if cmd == 'stop':
+                    return
+                if cmd == 'select_camera':
+                    tracker.select_camera(*args)
+                elif cmd == 'options':
+                    tracker.set_options(**args[0])
+                elif cmd == 'preview':
+                    preview = args[0]
+                elif cmd == 'find_eye':
+                    cancel.clear()
+                    if tracker.get_bounding_rectangle(
+                            cancel, args[0], search_progress, near_last=True):
+                        seq += 1
+                        conn.send(('eye', {
+                            'seq': seq,
+                            'eye_rec': tracker.eye_rec,
+                            'slot': slot,
+                            'images': publish(('eye_pic',)),
+                            }))
+                        slot = (slot + 1) % SLOTS
+                    elif cancel.is_set():
+                        conn.send(('eye_failed', 'Eye search cancelled'))
+                    else:
+                        conn.send(('eye_failed',
+                                   'No eye found in {} seconds'.format(args[0])))
+                elif cmd == 'calibrate':
+                    if tracker.calibrate():
+                        conn.send(('center', tracker.center))
+                    else:
+                        conn.send(('calibrate_failed', None))
+
+            if not tracker.eye_rec:
+                continue
+            if not tracker.take_snapshot(timeout=0.1):
+                continue
+            if not tracker.detect_blink():
+                tracker.track_pupil()
+            if preview:
+                tracker.draw()
+
+            seq += 1
+            conn.send(('result', {
+                'seq': seq,
+                'frame_time': tracker.frame_time,
+                'processed_time': time.monotonic(),
+                'pupil': tracker.pupil,
+                'pupil_smoothed': tracker.pupil_smoothed,
+                'pupil_confidence': tracker.pupil_confidence,
+                'blink': tracker.blink,
+                'slot': slot,
+                'images': publish(IMAGES) if preview else {},
+                }))
+            slot = (slot + 1) % SLOTS
+    except (EOFError, BrokenPipeError):
+        # UI process has gone away.
+        pass
+    finally:
+        tracker.release()
+        for shared in images.values():
+            shared.close()
+
+
+class EyetrackerProcess(QObject):
+    """Eyetracker running in a worker process.
+
+    Provides the same interface as Eyetracker. The worker tracks the
+    eye continuously after it has been found, and take_snapshot
+    takes the newest result from it. detect_blink, track_pupil and draw
+    only return results already computed by the worker.
+
+    A resultReady signal is emitted for each new result. Eye search
+    signals are the same as with Eyetracker.find_eye_async.
+    """
+    eyeChanged = Signal()
+    eyeSearchProgress = Signal(int, float)
+    eyeSearchFailed = Signal(str)
+    resultReady = Signal()
+
+    def __init__(self):
+        super().__init__()
+        context = multiprocessing.get_context('spawn')
+        self._conn, worker_conn = context.Pipe()
+        self._locks = [context.Lock() for _ in range(SLOTS)]
+        # Header of the slots, protected by their locks.
+        self._slot_seqs = context.Array('q', SLOTS, lock=False)
+        self._process = context.Process(
+            target=_worker_main,
+            args=(worker_conn, self._locks, self._slot_seqs),
+            daemon=True)
+        self._process.start()
+        worker_conn.close()
+
+        # Shared memory block mapped for each image in each slot.
+        self._blocks = [{} for _ in range(SLOTS)]
+        self._result = None
+        # Reply to calibration: None while waiting, then True or False.
+        self._calibrated = None
+
+        self.cams = []
+        self.center = (0, 0)
+        self.pupil = (0, 0)
+        self.pupil_tracking = False
+        self.pupil_smoothed = (0, 0)
+        self.pupil_confidence = 0.0
+        self.blink = False
+        self.eye_rec = None
+        self.searching = False
+        self.preview = True
+        self.frame_time = 0.0
+        self.latency = 0.0
+        self.frames_received = 0
+
+        self.eye_pic = None
+        self.pupil_pic = None
+        self.blink_pic = None
+        self.result_pic = None
+
+        # Camera list is needed right away for the UI.
+        if self._conn.poll(10):
+            self._handle(self._conn.recv())
+        else:
+            print('Eye tracker process did not start.')
+
+        self._notifier = QSocketNotifier(self._conn.fileno(), QSocketNotifier.Read)
+        self._notifier.activated.connect(self._receive)
+
+    def _send(self, *cmd):
+        """Send a command to the worker process."""
+        try:
+            self._conn.send(cmd)
+        except (OSError, BrokenPipeError):
+            print('Eye tracker process is not running.')
+
+    @Slot()
+    def _receive(self):
+        """Handle all messages waiting from the worker process."""
+        try:
+            while self._conn.poll():
+                self._handle(self._conn.recv())
+        except EOFError:
+            self._notifier.setEnabled(False)
+            print('Eye tracker process stopped.')
+            return
+
+        if self._result is not None:
+            # Only the newest result is interesting.
+            self.resultReady.emit()
+
+    def _handle(self, msg):
+        """Handle one message from the worker process."""
+        kind, data = msg
+        if kind == 'cameras':
+            self.cams = data
+        elif kind == 'center':
+            self.center = data
+            self._calibrated = True
+        elif kind == 'calibrate_failed':
+            self._calibrated = False
+        elif kind == 'progress':
+            self.eyeSearchProgress.emit(*data)
+        elif kind == 'eye':
+            self.searching = False
+            self.eye_rec = data['eye_rec']
+            self._copy_images(data)
+            self.eyeChanged.emit()
+        elif kind == 'eye_failed':
+            self.searching = False
+            self.eyeSearchFailed.emit(data)
+        elif kind == 'result':
+            self._result = data
+
+    def _copy_images(self, data):
+        """Copy images from shared memory to own arrays.
+
+        Images of a message are dropped if the worker has already
+        written newer ones to the same slot.
+
+        Returns True if the images were copied, False if dropped.
+        """
+        slot = data['slot']
+        blocks = self._blocks[slot]
+        with self._locks[slot]:
+            if self._slot_seqs[slot] != data['seq']:
+                return False
+            for name, (block_name, shape, dtype) in data['images'].items():
+                block = blocks.get(name)
+                if block is None or block.name != block_name:
+                    if block is not None:
+                        # Replaced and unlinked by the worker.
+                        block.close()
+                        del blocks[name]
+                    try:
+                        block = shared_memory.SharedMemory(name=block_name)
+                    except FileNotFoundError:
+                        return False
+                    blocks[name] = block
+                src = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+                dst = getattr(self, name)
+                if dst is None or dst.shape != src.shape or dst.dtype != src.dtype:
+                    dst = np.empty_like(src)
+                    setattr(self, name, dst)
+                np.copyto(dst, src)
+        return True
+
+    def release(self):
+        """Stop the worker process."""
+        self._notifier.setEnabled(False)
+        self._send('stop')
+        self._process.join(timeout=2)
+        if self._process.is_alive():
+            self._process.terminate()
+        for blocks in self._blocks:
+            for block in blocks.values():
+                block.close()
+        self._blocks = [{} for _ in range(SLOTS)]
+
+    def set_options(self, **options):
+        """Set options for eye tracking in the worker process.
+
+        See Eyetracker.set_options for the options.
+        """
+        if 'pupil_tracking' in options:
+            self.pupil_tracking = bool(options['pupil_tracking'])
+        self._send('options', options)
+
+    def set_preview(self, enabled):
+        """Enable or disable drawing images in the worker process.
+
+        Arguments:
+        enabled -- Draw and pass images for preview (bool).
+        """
+        self.preview = enabled
+        self._send('preview', enabled)
+
+    def select_camera(self, num):
+        """Select camera to use for eye tracking.
+
+        Arguments:
+        num -- Index for the camera to use.
+        """
+        self._send('select_camera', num)
+
+    def find_eye_async(self, timeout=None):
+        """Ask the worker to find an eye.
+
+        Returns immediately. Signals are emitted as with
+        Eyetracker.find_eye_async.
+
+        Arguments:
+        timeout -- Seconds to search before giving up. None searches
+            until an eye is found (float).
+        """
+        if self.searching:
+            return
+        self.searching = True
+        self._send('find_eye', timeout)
+
+    def cancel_find_eye(self):
+        """Cancel eye search running in the worker."""
+        self._send('cancel_find_eye')
+
+    def is_searching(self):
+        """Return True if the worker is searching for an eye."""
+        return self.searching
+
+    def calibrate(self):
+        """Calibrate looking forward in the worker.
+
+        Waits for the worker to reply, at most
+        CALIBRATION_REPLY_TIMEOUT seconds.
+
+        Returns True if calibrated, False otherwise.
+        """
+        self._calibrated = None
+        self._send('calibrate')
+        self._wait_for(lambda: self._calibrated is not None, CALIBRATION_REPLY_TIMEOUT)
+        if self._calibrated is None:
+            print('Eye tracker process did not reply, not calibrated')
+        return bool(self._calibrated)
+
+    def _wait_for(self, condition, timeout):
+        """Handle messages from the worker until condition() is true.
+
+        Arguments:
+        condition -- Function returning True when done waiting.
+        timeout -- Seconds to wait at most. None waits until
+            condition is true (float).
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not condition():
+            wait = None if deadline is None else max(0, deadline - time.monotonic())
+            try:
+                if not self._conn.poll(wait):
+                    return
+                self._handle(self._conn.recv())
+            except EOFError:
+                return
+
+    def take_snapshot(self, timeout=None):
+        """Take the newest result from the worker process.
+
+        Arguments:
+        timeout -- Seconds to wait for a new result. None waits until
+            there is one and 0 does not wait at all (float).
+
+        Returns True if there was a new result, False otherwise.
+        """
+        if self._result is None and timeout != 0:
+            self._wait_for(lambda: self._result is not None, timeout)
+        if self._result is None:
+            return False
+
+        data, self._result = self._result, None
+        self.pupil = data['pupil']
+        self.pupil_smoothed = data['pupil_smoothed']
+        self.pupil_confidence = data['pupil_confidence']
+        self.blink = data['blink']
+        self.frame_time = data['frame_time']
+        self.latency = time.monotonic() - data['frame_time']
+        self.frames_received += 1
+        self._copy_images(data)
+        return True
+
+    def detect_blink(self):
+        """Return blink detected by the worker."""
+        return self.blink
+
+    def track_pupil(self):
+        """Pupil is tracked by the worker, nothing to do."""
+
+    def draw(self):
+        """Result image is drawn by the worker, nothing to do."""
@@ -0,0 +1,370 @@
+"""Filters for smoothing control signals.
+
+Controllers read noisy signals (pupil position, acceleration, key
+presses) and should drive the wheelchair smoothly, but without the lag
+long moving averages add. This module has small filter stages which
+are chained for each signal:
+
+ - MovingAverage -- Average of the last values.
+ - Ema -- Exponential moving average.
+ - OneEuro -- Adaptive low-pass filter, which smooths slow movement a
+   lot and fast movement little, so it lags only a little.
+ - Median -- Median of the last values, removes single spikes.
+ - DeadZone -- Values near zero are zero.
+ - RateLimiter -- Limits how fast the value can grow and shrink.
+ - Hysteresis -- Keeps the value until input moves far enough away.
+
+Each stage is called with a value and its time, and returns the
+filtered value. Each call takes constant time, and the stages keep
+their history in fixed size ring buffers, so they are cheap enough for
+sensors sampled at 1 kHz (see benchmark.py filters).
+
+Usage:
+    chain = FilterChain.from_config([
+        {"type": "one_euro", "min_cutoff": 1.0, "beta": 0.01},
+        {"type": "dead_zone", "width": 10}])
+    value = chain(raw_value, timestamp)
+
+Parameters can be changed at runtime with configure.
+"""
+
+import math
+import time
+import bisect
+
+class Filter:
+    """Base class of filter stages.
+
+    Subclasses implement __call__ and reset. Parameters are attributes
+    named like the arguments of __init__.
+    """
+
+    def __call__(self, value, timestamp=None):
+        """Filter a value.
+
+        Arguments:
+        value -- New value of the signal (float).
+        timestamp -- Time of the value in seconds. time.monotonic() is
+            used if not given (float).
+
+        Returns filtered value.
+        """
+        raise NotImplementedError
+
+    def reset(self):
+        """Forget the history of the signal."""
+
+    def configure(self, **params):
+        """Change parameters of the filter.
+
+        Raises ValueError if the filter has no such parameter.
+        """
+        for name, value in params.items():
+            if name.startswith('_') or not hasattr(self, name):
+                raise ValueError('Unknown parameter {} for {}'.format(
+                    name, type(self).__name__))
+            setattr(self, name, value)
+        self.reset()
+
+
+class MovingAverage(Filter):
+    """Average of the last size values.
+
+    Arguments:
+    size -- Number of values averaged (int).
+    """
+
+    def __init__(self, size=4):
+        self.size = size
+        self.reset()
+
+    def reset(self):
+        self._values = [0.0] * self.size
+        self._index = 0
+        self._sum = 0.0
+        self._filled = False
+
+    def __call__(self, value, timestamp=None):
+        if not self._filled:
+            # Start from the first value instead of zeros.
+            self._values = [value] * self.size
+            self._sum = value * self.size
+            self._filled = True
+        self._sum += value - self._values[self._index]
+        self._values[self._index] = value
+        self._index = (self._index + 1) % self.size
+        return self._sum / self.size
+
+
+class Ema(Filter):
+    """Exponential moving average.
+
+    Arguments:
+    alpha -- Weight of the new value, between 0 and 1 (float).
+    """
+
+    def __init__(self, alpha=0.5):
+        self.alpha = alpha
+        self.reset()
+
+    def reset(self):
+        self._value = None
+
+    def __call__(self, value, timestamp=None):
+        if self._value is None:
+            self._value = value
+        else:
+            self._value += self.alpha * (value - self._value)
+        return self._value
+
+
+class OneEuro(Filter):
+    """One Euro filter, a low-pass filter with adaptive cutoff.
+
+    Cutoff frequency grows with the speed of the signal, so slow
+    changes (jitter) are smoothed and fast ones followed with little
+    lag. See Casiez et al., "1 Euro Filter", CHI 2012.
+
+    Arguments:
+    min_cutoff -- Cutoff frequency when the signal is still (Hz).
+        Lower is smoother.
+    beta -- How much the cutoff grows with speed. Higher lags less.
+    d_cutoff -- Cutoff frequency for the speed (Hz).
+    """
+
+    def __init__(self, min_cutoff=1.0, beta=0.0, d_cutoff=1.0):
+        self.min_cutoff = min_cutoff
+        self.beta = beta
+        self.d_cutoff = d_cutoff
+        self.reset()
+
+    def reset(self):
+        self._value = None
+        self._speed = 0.0
+        self._timestamp = None
+
+    @staticmethod
+    def _alpha(cutoff, period):
+        """Smoothing factor for a cutoff frequency and sample period."""
+        tau = 1.0 / (2*math.pi*cutoff)
+        return 1.0 / (1.0 + tau/period)
+
+    def __call__(self, value, timestamp=None):
+        if timestamp is None:
+            timestamp = time.monotonic()
+        if self._value is None:
+            self._value = value
+            self._timestamp = timestamp
+            return value
+        period = timestamp - self._timestamp
+        if period <= 0:
+            return self._value
+        self._timestamp = timestamp
+
+        speed = (value - self._value) / period
+        self._speed += self._alpha(self.d_cutoff, period) * (speed - self._speed)
+        cutoff = self.min_cutoff + self.beta*abs(self._speed)
+        self._value += self._alpha(cutoff, period) * (value - self._value)
+        return self._value
+
+
+class Median(Filter):
+    """Median of the last size values.
+
+    Values are kept in a ring buffer and in sorted order, so each
+    value costs one insert and one removal in a list of size values.
+
+    Arguments:
+    size -- Number of values, preferably odd (int).
+    """
+
+    def __init__(self, size=3):
+        self.size = size
+        self.reset()
+
+    def reset(self):
+        self._values = []
+        self._sorted = []
+        self._index = 0
+
+    def __call__(self, value, timestamp=None):
+        if len(self._values) < self.size:
+            self._values.append(value)
+        else:
+            old = self._values[self._index]
+            del self._sorted[bisect.bisect_left(self._sorted, old)]
+            self._values[self._index] = value
+            self._index = (self._index + 1) % self.size
+        bisect.insort(self._sorted, value)
+        count = len(self._sorted)
+        if count % 2:
+            return self._sorted[count//2]
+        return (self._sorted[count//2 - 1] + self._sorted[count//2]) / 2
+
+
+class DeadZone(Filter):
+    """Zero values near zero.
+
+    Arguments:
+    width -- Values with absolute value less than this are zero
+        (float).
+    rescale -- Scale values outside the dead zone so that output starts
+        from zero at its edge and reaches limit with the input (bool).
+    limit -- Largest absolute value of the signal, used for rescaling
+        (float).
+    """
+
+    def __init__(self, width=10.0, rescale=False, limit=127.0):
+        self.width = width
+        self.rescale = rescale
+        self.limit = limit
+
+    def __call__(self, value, timestamp=None):
+        if abs(value) < self.width:
+            return 0
+        if not self.rescale:
+            return value
+        magnitude = (abs(value) - self.width) * self.limit / (self.limit - self.width)
+        return math.copysign(magnitude, value)
+
+
+class RateLimiter(Filter):
+    """Limit how fast the value changes.
+
+    Growing speed away from zero is accelerating and towards zero is
+    decelerating, so the wheelchair can start smoothly but still stop
+    right away. When the value changes sign, it decelerates to zero
+    and accelerates for the rest of the period, so reversing is
+    limited like starting.
+
+    Arguments:
+    accelerate -- Largest change away from zero per second (float).
+    decelerate -- Largest change towards zero per second, unlimited if
+        None (float).
+    """
+
+    def __init__(self, accelerate=500.0, decelerate=None):
+        self.accelerate = accelerate
+        self.decelerate = decelerate
+        self.reset()
+
+    def reset(self):
+        self._value = 0.0
+        self._timestamp = None
+
+    def __call__(self, value, timestamp=None):
+        if timestamp is None:
+            timestamp = time.monotonic()
+        if self._timestamp is None:
+            period = 0.0
+        else:
+            period = max(0.0, timestamp - self._timestamp)
+        self._timestamp = timestamp
+
+        current = self._value
+        if current != 0 and (value - current > 0) != (current > 0):
+            # Towards zero first, but not across it at decelerating rate.
+            if (value > 0) == (current > 0):
+                target = value
+            else:
+                target = 0.0
+            distance = abs(target - current)
+            if self.decelerate is None:
+                step = distance
+            else:
+                step = min(distance, self.decelerate * period)
+            current += math.copysign(step, target - current)
+            if step < distance or target == value:
+                self._value = current
+                return current
+            current = 0.0
+            if self.decelerate is not None:
+                period -= step / self.decelerate
+        # Away from zero with the time left.
+        change = value - current
+        if self.accelerate is not None:
+            step = self.accelerate * period
+            change = min(max(change, -step), step)
+        self._value = current + change
+        return self._value
+
+
+class Hysteresis(Filter):
+    """Keep the value until input moves more than width away from it.
+
+    Arguments:
+    width -- Change in input needed to change the output (float).
+    """
+
+    def __init__(self, width=5.0):
+        self.width = width
+        self.reset()
+
+    def reset(self):
+        self._value = None
+
+    def __call__(self, value, timestamp=None):
+        if self._value is None or abs(value - self._value) > self.width:
+            self._value = value
+        return self._value
+
+
+# Filter stages by name used in configuration.
+FILTERS = {
+    'moving_average': MovingAverage,
+    'ema': Ema,
+    'one_euro': OneEuro,
+    'median': Median,
+    'dead_zone': DeadZone,
+    'rate_limiter': RateLimiter,
+    'hysteresis': Hysteresis,
+    }
+
+
+class FilterChain(Filter):
+    """Filter stages run one after another.
+
+    Arguments:
+    stages -- Filter stages in the order they are run.
+    """
+
+    def __init__(self, *stages):
+        self.stages = list(stages)
+
+    @classmethod
+    def from_config(cls, config):
+        """Create a chain from configuration.
+
+        Arguments:
+        config -- List of dictionaries, each with type of the stage
+            (see FILTERS) and its parameters.
+
+        Raises ValueError if a stage is unknown.
+        """
+        stages = []
+        for stage in config:
+            params = dict(stage)
+            kind = params.pop('type')
+            if kind not in FILTERS:
+                raise ValueError('Unknown filter {}'.format(kind))
+            stages.append(FILTERS[kind](**params))
+        return cls(*stages)
+
+    def reset(self):
+        for stage in self.stages:
+            stage.reset()
+
+    def configure(self, index, **params):
+        """Change parameters of a stage, see Filter.configure.
+
+        Arguments:
+        index -- Index of the stage in the chain (int).
+        """
+        self.stages[index].configure(**params)
+
+    def __call__(self, value, timestamp=None):
+        if timestamp is None:
+            timestamp = time.monotonic()
+        for stage in self.stages:
+            value = stage(value, timestamp)
+        return value
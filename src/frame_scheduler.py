@@ -0,0 +1,129 @@
+"""Load-aware scheduling of a periodic task in the Qt event loop.
+
+A QTimer with a fixed interval keeps firing even if the work done on
+each timeout takes longer than the interval, and the events pile up.
+FrameScheduler measures how long the work takes and adjusts the
+interval within given bounds, so that a slower computer runs the task
+at a lower but steady rate instead of falling behind.
+"""
+
+import time
+
+from PySide2.QtCore import QObject, QTimer, Signal, Slot
+
+class FrameScheduler(QObject):
+    """Run a task periodically at a rate adapted to its cost.
+
+    The task is connected to the tick signal. After each tick, the next
+    one is scheduled with a single-shot timer, so ticks are skipped
+    rather than queued. The interval is set so that the task uses at
+    most max_load of the time, but kept between the intervals given by
+    max_fps and min_fps.
+
+    A tick is counted as a deadline miss if it starts more than one
+    interval late, or if the task takes longer than the interval. If
+    the task had nothing to do on a tick (no new frame), it calls idle,
+    and the tick is left out of the cost estimate. rateChanged is emitted about once a second with the effective
+    rate.
+
+    Arguments:
+    min_fps -- Lowest rate to run the task at (float).
+    max_fps -- Highest rate to run the task at (float).
+    max_load -- Largest share of time the task may use (float).
+    """
+    tick = Signal()
+    rateChanged = Signal(float)
+
+    def __init__(self, min_fps=5.0, max_fps=20.0, max_load=0.6):
+        super().__init__()
+        self.min_interval = 1.0 / max_fps
+        self.max_interval = 1.0 / min_fps
+        self.max_load = max_load
+
+        self.interval = self.min_interval
+        self.cost = 0.0
+        self.effective_rate = 0.0
+        self.deadline_misses = 0
+        self.ticks = 0
+
+        self._due = None
+        self._last_start = None
+        self._last_report = 0.0
+        self._active = False
+        self._idle = False
+
+        self._timer = QTimer()
+        self._timer.setSingleShot(True)
+        self._timer.timeout.connect(self._run)
+
+    def start(self):
+        """Start running the task."""
+        self._active = True
+        self._last_start = None
+        self._schedule(0.0)
+
+    def stop(self):
+        """Stop running the task."""
+        self._active = False
+        self._timer.stop()
+
+    def idle(self):
+        """Tell that the task had nothing to do on this tick.
+
+        Called by the task. The cost of the tick is then not used for
+        adapting the interval.
+        """
+        self._idle = True
+
+    def isActive(self):
+        """Return True if the task is being run."""
+        return self._active
+
+    def _schedule(self, delay):
+        """Schedule next tick after delay seconds."""
+        self._due = time.monotonic() + delay
+        self._timer.start(int(delay*1000))
+
+    @Slot()
+    def _run(self):
+        """Run the task and schedule the next run."""
+        start = time.monotonic()
+        late = start - self._due > self.interval
+        if self._last_start is not None:
+            period = start - self._last_start
+            if period > 0:
+                rate = 1.0 / period
+                self.effective_rate += 0.1 * (rate - self.effective_rate)
+        self._last_start = start
+
+        self._idle = False
+        self.tick.emit()
+        self.ticks += 1
+
+        end = time.monotonic()
+        cost = end - start
+        if late or cost > self.interval:
+            self.deadline_misses += 1
+        if not self._idle:
+            self.cost += 0.2 * (cost - self.cost)
+            self._adapt()
+
+        if end - self._last_report > 1.0:
+            self._last_report = end
+            self.rateChanged.emit(self.effective_rate)
+
+        if self._active:
+            self._schedule(max(0.0, start + self.interval - end))
+
+    def _adapt(self):
+        """Adjust interval to the measured cost of the task.
+
+        Slows down right away when the task gets more expensive, but
+        speeds up gradually to avoid oscillating.
+        """
+        wanted = self.cost / self.max_load
+        if wanted > self.interval:
+            self.interval = wanted
+        else:
+            self.interval = max(wanted, self.interval * 0.95)
+        self.interval = min(max(self.interval, self.min_interval), self.max_interval)
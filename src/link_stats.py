@@ -0,0 +1,132 @@
+"""Round-trip time, loss and reordering of commands sent to the wheelchair.
+
+With the extended command format each command carries a sequence
+number and the host's timestamp, and the Arduino sends both back in
+an acknowledgement when it has applied the command:
+
+    command:          drive turn sequence(2) timestamp(4)
+    acknowledgement:  sequence(2) timestamp(4)
+
+Numbers are little endian. The first two bytes of a command are the
+same as in the old two byte format. Timestamps are microseconds of
+time.monotonic() wrapped to 32 bits, so round-trip time is computed
+from the echoed timestamp alone.
+
+Sequence numbers missing from the acknowledgements are counted as
+lost, which includes both commands and acknowledgements lost. An
+acknowledgement older than the newest one is counted as reordered,
+and no longer as lost if it was. The latest sequence numbers missing
+and acknowledged are remembered for this (HISTORY_SEQUENCES).
+"""
+
+import time
+import struct
+import collections
+
+import numpy as np
+
+COMMAND_FORMAT = struct.Struct('<BBHI')
+ACK_FORMAT = struct.Struct('<HI')
+SEQUENCE_MODULO = 1 << 16
+TIMESTAMP_MODULO = 1 << 32
+# Number of missing and of acknowledged sequence numbers remembered.
+HISTORY_SEQUENCES = 1024
+
+def host_timestamp():
+    """Return timestamp for a command (int)."""
+    return int(time.monotonic() * 1e6) % TIMESTAMP_MODULO
+
+
+class LinkStats:
+    """Statistics of commands sent and acknowledged.
+
+    Arguments:
+    history -- Number of round-trip times kept (int).
+    """
+
+    def __init__(self, history=1000):
+        self.history = history
+        self.reset()
+
+    def reset(self):
+        """Forget statistics, for example for a new connection."""
+        self.sent = 0
+        self.acked = 0
+        self.lost = 0
+        self.reordered = 0
+        self.duplicates = 0
+        self.malformed = 0
+        self.rtts = collections.deque(maxlen=self.history)
+        self._sequence = 0
+        self._newest = None
+        # Sequence numbers in insertion order, values unused.
+        self._missing = collections.OrderedDict()
+        self._seen = collections.OrderedDict()
+
+    @staticmethod
+    def _remember(sequences, sequence):
+        """Add sequence number to a bounded set of them."""
+        sequences[sequence] = None
+        if len(sequences) > HISTORY_SEQUENCES:
+            sequences.popitem(last=False)
+
+    def encode(self, cmd):
+        """Return extended command of cmd (drive, turn) and count it sent."""
+        sequence = self._sequence
+        self._sequence = (sequence + 1) % SEQUENCE_MODULO
+        self.sent += 1
+        return COMMAND_FORMAT.pack(cmd[0], cmd[1], sequence, host_timestamp())
+
+    def acknowledge(self, data):
+        """Count an acknowledgement received (bytes).
+
+        Acknowledgements too short to parse are counted as malformed.
+        """
+        now = host_timestamp()
+        data = bytes(data)
+        if len(data) < ACK_FORMAT.size:
+            self.malformed += 1
+            return
+        sequence, timestamp = ACK_FORMAT.unpack_from(data)
+        if sequence in self._seen:
+            self.duplicates += 1
+            return
+        self._remember(self._seen, sequence)
+        self.acked += 1
+        self.rtts.append(((now - timestamp) % TIMESTAMP_MODULO) / 1e6)
+        if self._newest is None:
+            self._newest = sequence
+            return
+        step = (sequence - self._newest) % SEQUENCE_MODULO
+        if step < SEQUENCE_MODULO // 2:
+            self.lost += step - 1
+            end = self._newest + step
+            for missing in range(max(self._newest + 1, end - HISTORY_SEQUENCES), end):
+                self._remember(self._missing, missing % SEQUENCE_MODULO)
+            self._newest = sequence
+        else:
+            self.reordered += 1
+            if sequence in self._missing:
+                # Counted lost when a newer one arrived.
+                del self._missing[sequence]
+                self.lost -= 1
+
+    def stats(self):
+        """Return dictionary of statistics.
+
+        Round-trip times are in milliseconds.
+        """
+        stats = {
+            'sent': self.sent,
+            'acked': self.acked,
+            'lost': self.lost,
+            'reordered': self.reordered,
+            'duplicates': self.duplicates,
+            'malformed': self.malformed,
+            }
+        if self.rtts:
+            millis = np.array(self.rtts)*1000
+            stats['rtt_mean'] = float(millis.mean())
+            stats['rtt_p95'] = float(np.percentile(millis, 95))
+            stats['rtt_max'] = float(millis.max())
+        return stats
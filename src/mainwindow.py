@@ -3,7 +3,8 @@
 Connection adapters and controllers are added to the program here.
 
 Current connection adapters include a dummy for testing which prints
-sent commands to terminal, and a Bluetooth LE -based connection
+sent commands to terminal, a Bluetooth LE -based connection, and a
+serial connection
 
 Current controllers include a simple test controller used with
 arrow keys, and one which uses camera to track eye movements to
@@ -18,6 +19,7 @@ from widget_wheelchair import WheelchairWidget
 
 from wheelchair_dummy import WheelchairDummy
 from wheelchair_bt import WheelchairBluetooth
+from wheelchair_serial import WheelchairSerial
 from controller_keyboard import KeyboardController
 from controller_eyetrack import EyeTrackerController
 from controller_accelerometer import AccelerometerController
@@ -40,6 +42,7 @@ class MainWindow(QMainWindow):
         self.wheelchairs = []
         self.wheelchairs.append(WheelchairDummy())
         self.wheelchairs.append(WheelchairBluetooth())
+        self.wheelchairs.append(WheelchairSerial())
         self.wheelchair = self.wheelchairs[0]
         self.wheelchair_widget = WheelchairWidget(self.wheelchair)
 
@@ -112,6 +115,8 @@ class MainWindow(QMainWindow):
         num -- Index of wheelchair controller selected.
         """
         self.controller_chooser.clearFocus()
+        # The new controller sets its own rate if it needs to.
+        self.wheelchair.set_input_period(None)
         controller = self.controllers[num](self.wheelchair)
         self.layout.replaceWidget(self.controller, controller)
         self.controller.deleteLater()
@@ -0,0 +1,117 @@
+"""Temporal filtering of pupil position.
+
+The pupil moves smoothly between frames, so its position in the next
+frame can be predicted from the previous ones. PupilFilter is a
+constant velocity Kalman filter which gives the predicted position, a
+smoothed position and a confidence value telling how well the
+measurements have matched the predictions lately.
+"""
+
+import numpy as np
+
+class PupilFilter:
+    """Constant velocity Kalman filter for pupil position.
+
+    State is position and velocity (x, y, vx, vy) in pixels and
+    pixels/second. Confidence is between 0 and 1. It grows when
+    measurements agree with the prediction, and drops when pupil is not
+    found or jumps further than the gate from the prediction.
+
+    Arguments:
+    acceleration_noise -- Standard deviation of pupil acceleration
+        (pixels/s^2).
+    measurement_noise -- Standard deviation of measured position
+        (pixels).
+    gate -- Largest distance from prediction (pixels) accepted as the
+        same pupil. Further measurements restart the filter.
+    """
+
+    def __init__(self, acceleration_noise=2000.0, measurement_noise=3.0, gate=40.0):
+        self.acceleration_noise = acceleration_noise
+        self.measurement_noise = measurement_noise
+        self.gate = gate
+
+        self._obs = np.array([[1.0, 0, 0, 0], [0, 1.0, 0, 0]])
+        self._meas_cov = np.eye(2) * measurement_noise**2
+        self.reset()
+
+    def reset(self):
+        """Forget the tracked pupil."""
+        self.state = np.zeros(4)
+        self.covariance = np.eye(4) * 1e6
+        self.timestamp = None
+        self.confidence = 0.0
+
+    @property
+    def position(self):
+        """Smoothed pupil position as tuple (x, y) of floats."""
+        return (self.state[0], self.state[1])
+
+    def predict(self, timestamp):
+        """Predict pupil position at given time.
+
+        Does not change the filter state.
+
+        Arguments:
+        timestamp -- Capture time of the frame (float).
+
+        Returns predicted position as tuple (x, y) of floats.
+        """
+        if self.timestamp is None:
+            return self.position
+        dt = max(0.0, timestamp - self.timestamp)
+        return (self.state[0] + dt*self.state[2], self.state[1] + dt*self.state[3])
+
+    def update(self, measurement, timestamp):
+        """Update filter with a measured pupil position.
+
+        Arguments:
+        measurement -- Measured position as tuple (x, y).
+        timestamp -- Capture time of the frame (float).
+        """
+        measurement = np.asarray(measurement, dtype=float)
+        if self.timestamp is None:
+            self._restart(measurement, timestamp)
+            return
+
+        self._advance(timestamp)
+        innovation = measurement - self._obs @ self.state
+        if np.hypot(*innovation) > self.gate:
+            # Lost the pupil or found something else, start over.
+            self._restart(measurement, timestamp)
+            return
+
+        innovation_cov = self._obs @ self.covariance @ self._obs.T + self._meas_cov
+        gain = self.covariance @ self._obs.T @ np.linalg.inv(innovation_cov)
+        self.state = self.state + gain @ innovation
+        self.covariance = (np.eye(4) - gain @ self._obs) @ self.covariance
+        self.confidence += (1.0 - self.confidence) * 0.5
+
+    def miss(self, timestamp):
+        """Tell the filter that pupil was not found from a frame.
+
+        Arguments:
+        timestamp -- Capture time of the frame (float).
+        """
+        if self.timestamp is not None:
+            self._advance(timestamp)
+        self.confidence *= 0.5
+
+    def _restart(self, measurement, timestamp):
+        """Start tracking from a measurement with no velocity."""
+        self.state = np.array([measurement[0], measurement[1], 0.0, 0.0])
+        self.covariance = np.diag([self.measurement_noise**2]*2 + [1e4]*2)
+        self.timestamp = timestamp
+        self.confidence = 0.25
+
+    def _advance(self, timestamp):
+        """Move filter state forward to given time."""
+        dt = max(0.0, timestamp - self.timestamp)
+        transition = np.eye(4)
+        transition[0, 2] = transition[1, 3] = dt
+        # White noise acceleration model.
+        noise = np.array([dt*dt/2, dt*dt/2, dt, dt])
+        process_cov = np.diag(noise*noise) * self.acceleration_noise**2
+        self.state = transition @ self.state
+        self.covariance = transition @ self.covariance @ transition.T + process_cov
+        self.timestamp = timestamp
@@ -0,0 +1,201 @@
+"""Recording and replaying raw camera frames.
+
+Recordings make it possible to run the eye tracker without a camera
+and a person wearing the cap, for example to benchmark it. A recording
+consists of two files:
+ - <name>.frames: raw frames one after another, all of the same size.
+   The file is memory-mapped when replayed.
+ - <name>.JSON: index with frame shape, element type and capture time
+   of each frame in seconds from the first frame.
+
+Record from a camera from command line:
+    python recording.py CAMERA_INDEX NAME [--seconds SECONDS]
+"""
+
+import sys
+import time
+import json
+import argparse
+
+import cv2
+import numpy as np
+
+class FrameRecorder:
+    """Save frames to a recording.
+
+    Usage: create with recording name, call write for each frame and
+    close when done. Frames must all be of the same size.
+
+    Arguments:
+    name -- Path of the recording without file extension (str).
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._frames_file = open(name + '.frames', 'wb')
+        self.shape = None
+        self.dtype = None
+        self.timestamps = []
+
+    def write(self, frame, timestamp=None):
+        """Append a frame to the recording.
+
+        Arguments:
+        frame -- Frame to save (numpy array).
+        timestamp -- Capture time of the frame from time.monotonic().
+            Current time is used if not given (float).
+        """
+        if timestamp is None:
+            timestamp = time.monotonic()
+        if self.shape is None:
+            self.shape = frame.shape
+            self.dtype = frame.dtype
+        elif frame.shape != self.shape or frame.dtype != self.dtype:
+            raise ValueError('Frame size changed during recording')
+        self._frames_file.write(np.ascontiguousarray(frame).tobytes())
+        self.timestamps.append(timestamp)
+
+    def close(self):
+        """Finish the recording and write its index."""
+        self._frames_file.close()
+        start = self.timestamps[0] if self.timestamps else 0.0
+        index = {
+            'shape': list(self.shape) if self.shape else [],
+            'dtype': np.dtype(self.dtype).str if self.dtype else '|u1',
+            'timestamps': [stamp - start for stamp in self.timestamps],
+            }
+        with open(self.name + '.JSON', 'w') as index_file:
+            json.dump(index, index_file)
+
+
+class ReplayCapture:
+    """Read frames from a recording like from cv2.VideoCapture.
+
+    Can be given to Eyetracker instead of a camera.
+
+    Arguments:
+    name -- Path of the recording without file extension (str).
+    realtime -- Return frames at the pace they were recorded. Otherwise
+        return them as fast as they are read (bool).
+    loop -- Start from the beginning after the last frame (bool).
+    """
+
+    def __init__(self, name, realtime=True, loop=False):
+        with open(name + '.JSON') as index_file:
+            index = json.load(index_file)
+        self.timestamps = index['timestamps']
+        shape = tuple(index['shape'])
+        self.frames = np.memmap(
+            name + '.frames', dtype=np.dtype(index['dtype']), mode='r',
+            shape=(len(self.timestamps),) + shape)
+        self.realtime = realtime
+        self.loop = loop
+        self.position = 0
+        self._start = None
+        self._opened = len(self.timestamps) > 0
+
+    def isOpened(self):
+        """Return True if there are frames to read."""
+        return self._opened
+
+    def release(self):
+        """Close the recording."""
+        self._opened = False
+        self.frames = None
+
+    def read(self, image=None):
+        """Read next frame.
+
+        Arguments:
+        image -- Array to copy the frame to, if its shape matches.
+
+        Returns tuple (ret, frame) like cv2.VideoCapture.read.
+        """
+        if not self._opened:
+            return False, None
+        if self.position >= len(self.timestamps):
+            if not self.loop:
+                return False, None
+            self.position = 0
+            self._start = None
+
+        if self.realtime:
+            if self._start is None:
+                self._start = time.monotonic() - self.timestamps[self.position]
+            delay = self._start + self.timestamps[self.position] - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+        frame = self.frames[self.position]
+        self.position += 1
+        if image is None or image.shape != frame.shape or image.dtype != frame.dtype:
+            image = np.empty(frame.shape, frame.dtype)
+        np.copyto(image, frame)
+        return True, image
+
+    def get(self, prop):
+        """Get recording property, see cv2.VideoCapture.get."""
+        if prop == cv2.CAP_PROP_FRAME_WIDTH:
+            return float(self.frames.shape[2])
+        if prop == cv2.CAP_PROP_FRAME_HEIGHT:
+            return float(self.frames.shape[1])
+        if prop == cv2.CAP_PROP_FRAME_COUNT:
+            return float(len(self.timestamps))
+        if prop == cv2.CAP_PROP_POS_FRAMES:
+            return float(self.position)
+        if prop == cv2.CAP_PROP_FPS and len(self.timestamps) > 1:
+            return (len(self.timestamps) - 1) / self.timestamps[-1]
+        return 0.0
+
+    def set(self, prop, value):
+        """Only the read position can be set, see cv2.VideoCapture.set."""
+        if prop == cv2.CAP_PROP_POS_FRAMES:
+            self.position = int(value)
+            self._start = None
+            return True
+        return False
+
+
+def record(camera, name, seconds):
+    """Record frames from a camera.
+
+    Arguments:
+    camera -- OpenCV index of the camera (int).
+    name -- Path of the recording without file extension (str).
+    seconds -- Length of the recording (float).
+
+    Returns number of frames recorded.
+    """
+    cam = cv2.VideoCapture(camera)
+    if not cam.isOpened():
+        print('Could not open camera {}'.format(camera))
+        return 0
+    recorder = FrameRecorder(name)
+    frame = None
+    end = time.monotonic() + seconds
+    try:
+        while time.monotonic() < end:
+            ret, frame = cam.read(frame)
+            if ret:
+                recorder.write(frame, time.monotonic())
+    finally:
+        recorder.close()
+        cam.release()
+    return len(recorder.timestamps)
+
+
+def main():
+    """Record frames from a camera from command line."""
+    parser = argparse.ArgumentParser(description='Record frames from a camera.')
+    parser.add_argument('camera', type=int, help='OpenCV index of the camera')
+    parser.add_argument('name', help='path of the recording without extension')
+    parser.add_argument('--seconds', type=float, default=10.0,
+                        help='length of the recording (default: 10)')
+    args = parser.parse_args()
+    count = record(args.camera, args.name, args.seconds)
+    print('{} frames recorded to {}'.format(count, args.name))
+    sys.exit(0 if count else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+"""Latency tracing of commands from input event to the wheelchair.
+
+A trace is started when an input event happens (camera frame captured,
+key pressed, acceleration measured) and follows the command made from
+it through the wheelchair adapter. Each stage marks the trace when the
+command passes it, and when the command has been written, the time
+between each two marks (a hop) and the total time are added to
+histograms. Histograms are kept per source of the input.
+
+Tracing is off by default. Then start returns None, and mark and
+finish return right away when given None, so tracing can be left in
+the code. It is turned on with enable, or by setting environment
+variable WHEELCHAIR_TRACE to a file name, where the histograms are
+dumped when the program exits.
+
+Usage:
+    trace = tracing.start('keyboard')
+    ...
+    tracing.mark(trace, 'write_command')
+    ...
+    tracing.finish(trace, 'written')
+    tracing.dump('trace.JSON')
+"""
+
+import os
+import json
+import time
+import atexit
+import threading
+
+# Histogram bucket i counts latencies from 2**(i-1) to 2**i
+# microseconds, and bucket 0 those under one microsecond.
+BUCKETS = 25
+
+_enabled = False
+_lock = threading.Lock()
+# Histograms by source and hop.
+_histograms = {}
+
+class Trace:
+    """Marks of one command on its way to the wheelchair.
+
+    Arguments:
+    source -- Name of the input the command is made from (str).
+    timestamp -- time.monotonic() of the input event (float).
+    """
+    __slots__ = ('source', 'marks')
+
+    def __init__(self, source, timestamp):
+        self.source = source
+        self.marks = [('event', timestamp)]
+
+
+class Histogram:
+    """Latencies in logarithmic buckets, see BUCKETS."""
+
+    def __init__(self):
+        self.counts = [0] * BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        """Add a latency."""
+        micros = int(seconds * 1e6)
+        self.counts[min(micros.bit_length(), BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, percent):
+        """Return upper bound of the bucket of a percentile in seconds."""
+        limit = self.count * percent / 100
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= limit and count:
+                return min(2**index / 1e6, self.max)
+        return self.max
+
+    def summary(self):
+        """Return dictionary of statistics in milliseconds and buckets."""
+        if not self.count:
+            return {'count': 0}
+        return {
+            'count': self.count,
+            'mean': self.total / self.count * 1e3,
+            'p50': self.percentile(50) * 1e3,
+            'p95': self.percentile(95) * 1e3,
+            'p99': self.percentile(99) * 1e3,
+            'max': self.max * 1e3,
+            'buckets_us': [2**index for index in range(BUCKETS)],
+            'counts': list(self.counts),
+            }
+
+
+def enable():
+    """Start tracing commands."""
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    """Stop tracing commands. Histograms are kept."""
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    """Return True if commands are traced."""
+    return _enabled
+
+
+def reset():
+    """Forget all latencies recorded."""
+    with _lock:
+        _histograms.clear()
+
+
+def start(source, timestamp=None):
+    """Start tracing a command from an input event.
+
+    Arguments:
+    source -- Name of the input (str).
+    timestamp -- time.monotonic() of the event, now if not given
+        (float).
+
+    Returns Trace, or None if tracing is disabled.
+    """
+    if not _enabled:
+        return None
+    if timestamp is None:
+        timestamp = time.monotonic()
+    return Trace(source, timestamp)
+
+
+def mark(trace, stage):
+    """Mark that the command of trace has reached stage (str)."""
+    if trace is None:
+        return
+    trace.marks.append((stage, time.monotonic()))
+
+
+def finish(trace, stage):
+    """Mark the last stage and record latencies of the trace."""
+    if trace is None:
+        return
+    mark(trace, stage)
+    with _lock:
+        hops = _histograms.setdefault(trace.source, {})
+        previous, start_time = trace.marks[0]
+        for name, timestamp in trace.marks[1:]:
+            hop = '{}>{}'.format(previous, name)
+            hops.setdefault(hop, Histogram()).add(timestamp - start_time)
+            previous, start_time = name, timestamp
+        total = trace.marks[-1][1] - trace.marks[0][1]
+        hops.setdefault('total', Histogram()).add(total)
+
+
+def stats():
+    """Return latency statistics by source and hop, see Histogram.summary."""
+    with _lock:
+        return {source: {hop: histogram.summary() for hop, histogram in hops.items()}
+                for source, hops in _histograms.items()}
+
+
+def dump(path):
+    """Write latency statistics to a JSON file."""
+    with open(path, 'w') as dump_file:
+        json.dump(stats(), dump_file, indent=2)
+
+
+if os.environ.get('WHEELCHAIR_TRACE'):
+    enable()
+    atexit.register(dump, os.environ['WHEELCHAIR_TRACE'])
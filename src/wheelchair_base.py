@@ -10,6 +10,7 @@ TODO:
 from PySide2.QtCore import QObject, Signal, Slot
 
 from util import ConnectionState
+import tracing
 
 class WheelchairController(QObject):
     """Base class defining wheelchair controller
@@ -33,6 +34,8 @@ class WheelchairController(QObject):
         self.enable_turn = False
 
         self.prev_write = 0
+        # Trace of the latest command, see tracing.py.
+        self.trace = None
         self.connected = ConnectionState.DISCONNECTED
 
     def __str__(self):
@@ -102,10 +105,13 @@ class WheelchairController(QObject):
         self.connection_status_changed.emit()
 
     def write(self):
-        """Send driving command to wheelchair."""
+        """Send driving command to wheelchair.
+
+        The command is traced with self.trace.
+        """
         raise NotImplementedError
 
-    def write_command(self, forward=None, turn=None):
+    def write_command(self, forward=None, turn=None, trace=None):
         """Update internal values for sending to wheelchair
 
         If parameter a parameter is left empty, it is set to neutral
@@ -117,7 +123,10 @@ class WheelchairController(QObject):
         turn -- Values outside signed 7-bit will be limited to
             maximum values of signed 7-bit (-127..127). Turn right
             with positive values (int).
+        trace -- Trace of the input event the command is made from, see
+            tracing.py.
         """
+        tracing.mark(trace, 'write_command')
 
         if(forward is None or not self.enable_drive):
             forward = self.neutral
@@ -126,10 +135,23 @@ class WheelchairController(QObject):
 
         self.drive = self._transform_input(forward)
         self.turn = self._transform_input(turn)
+        tracing.mark(trace, 'transform')
 
+        self.trace = trace
         if self.connected == ConnectionState.CONNECTED:
             self.write()
 
+    def set_input_period(self, period):
+        """Tell how often the controller gives commands at the slowest.
+
+        Adapters sending commands from a control loop lengthen its
+        setpoint timeout to fit, see ControlLoop.set_input_period.
+
+        Arguments:
+        period -- Longest seconds between commands, or None if not
+            known (float).
+        """
+
     @staticmethod
     def _transform_input(value):
         """Transforms command inputs to wheelchair's format.
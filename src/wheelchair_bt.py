@@ -12,9 +12,12 @@ import time
 import threading
 import json
 
-from PySide2.QtCore import Qt, QTimer
+from PySide2.QtCore import Qt, Slot
 
 from wheelchair_base import WheelchairController
+from control_loop import ControlLoop
+from util import ConnectionState
+import tracing
 
 if sys.platform.startswith("linux"):
     from bluez_dbus import BLEHelper
@@ -27,10 +30,26 @@ class WheelchairBluetooth(WheelchairController):
     Connects to an Arduino Nano 33 BLE controlling controlling the
     wheelchair.
 
-    Bluetooth adapter name, address and UUID for the characteristic controlling
-    the wheelchair are loaded from config.JSON. Value for neutral command when
+    Bluetooth adapter name, address, UUID of the service the wheelchair
+    advertises and UUID for the characteristic controlling the
+    wheelchair are loaded from config_bt.JSON. Value for neutral command when
     the wheelchair does not move is also loaded from the config file, since it
-    depends on physical system connected to wheelchair.
+    depends on physical system connected to wheelchair. If
+    write_without_response is set, commands are written without waiting
+    for the wheelchair to acknowledge them, when it supports that.
+
+    Commands are sent by a control loop (see control_loop.py) at
+    control_rate commands per second while connected. A command not
+    updated by the controller in setpoint_timeout seconds, or in three
+    of the controller's longest intervals if that is longer (see
+    set_input_period), is replaced with neutral. The loop thread gets real-time priority
+    control_priority if it is not null.
+
+    UUIDs of the command and acknowledgement characteristics of the
+    extended command format are loaded too. If the wheelchair has
+    them, round-trip time, loss and reordering of commands are
+    available from link_stats. Otherwise the old two byte format is
+    used.
     """
 
     name = "Bluetooth wheelchair"
@@ -44,21 +63,34 @@ class WheelchairBluetooth(WheelchairController):
             self.adapter = config["adapter"]
             self.address = config["address"]
             self.uuid = config["characteristic"]
+            self.service = config["service"]
+            self.command_uuid = config["command"]
+            self.ack_uuid = config["ack"]
             #self.neutral = int(config['neutral'])
             self.neutral = 0
-
-        self.bluetooth = BLEHelper(self.adapter, self.address, self.uuid)
+            self.write_without_response = config["write_without_response"]
+            control_rate = config["control_rate"]
+            setpoint_timeout = config["setpoint_timeout"]
+            control_priority = config["control_priority"]
+
+        self.bluetooth = BLEHelper(
+            self.adapter, self.address, self.uuid,
+            service_uuid=self.service,
+            write_without_response=self.write_without_response,
+            command_uuid=self.command_uuid, ack_uuid=self.ack_uuid)
         self.bluetooth.setParent(self)
 
         self.bluetooth.connection_status.connect(self.set_connection_status)
 
-        self.cmd_timer = QTimer()
-        self.cmd_timer.setInterval(50)
-        self.cmd_timer.timeout.connect(self.write)
-
+        neutral = self._transform_input(self.neutral)
+        self.control_loop = ControlLoop(
+            self._send, [neutral, neutral], rate=control_rate,
+            timeout=setpoint_timeout, priority=control_priority,
+            name="bt-control-loop")
 
     def __del__(self):
         self.bluetooth.stop_thread = True
+        self.control_loop.stop()
 
     def connect_chair(self):
         threading.Thread(
@@ -70,39 +102,49 @@ class WheelchairBluetooth(WheelchairController):
             target=self.bluetooth.bt_disconnect
             ).start()
 
-    def write(self):
-        """Send driving command to wheelchair.
+    @Slot(bool)
+    def set_connection_status(self, status):
+        """Run the control loop only while connected."""
+        super().set_connection_status(status)
+        if status == ConnectionState.CONNECTED:
+            self.control_loop.start()
+        else:
+            self.control_loop.stop()
 
-        Send the command only if at least 200ms has passed from last
-        command sent. This is done to prevent movement commants getting
-        queued up and sent later.
+    def write(self):
+        """Set driving command sent to wheelchair by the control loop.
 
-        TODO: Fix to allow shorter time between two commands. Currently
-        200ms seems to be the minimum delay between two commands which
-        works. If commands are sent with shorter delay between them,
-        they will get queued up and sent one after another with ~300ms
-        delay between them until the queue is empty.
+        The control loop sends the latest command at a fixed rate, so
+        the timing of commands at the wheelchair does not depend on
+        when the controller calls this. See control_stats.
+        """
+        tracing.mark(self.trace, 'write')
+        self.control_loop.set_setpoint([self.drive, self.turn], self.trace)
 
-        Parameters:
-        None
+    def set_input_period(self, period):
+        """Fit setpoint timeout to the controller, see ControlLoop.set_input_period."""
+        self.control_loop.set_input_period(period)
 
-        Returns:
-        boolean: True if the command was written. False if the command
-            was not sent because too little time has passed since
-            previous command.
-        """
-        #command_delay_ms = 100  #100
-        #diff = int(time.monotonic()*1000) - self.prev_write
-        #if diff > command_delay_ms:
-            #self.prev_write = int(time.monotonic()*1000)
-        cmd = [self.drive, self.turn]
+    def _send(self, cmd, trace):
+        """Send command to wheelchair, in the control loop thread.
 
-        self.command_changed.emit(self.drive, self.turn)
+        Commands are not queued up: the command is sent when the
+        previous write has finished, and replaced if a newer one is
+        given before that. See BLEHelper.write_stats for how many were
+        written and replaced.
 
-        self.drive = self.neutral
-        self.turn = self.neutral
+        Writes with response take about 200ms each, which limits how
+        often the wheelchair gets a new command. Writes without
+        response (see write_without_response) do not wait for the
+        wheelchair.
+        """
+        self.command_changed.emit(cmd[0], cmd[1])
+        self.bluetooth.write_characteristic(cmd, trace)
 
-        self.bluetooth.write_characteristic(cmd)
+    def link_stats(self):
+        """Return round-trip statistics of commands, see BLEHelper.link_stats."""
+        return self.bluetooth.link_stats()
 
-        #return True
-        #return False
+    def control_stats(self):
+        """Return statistics of the control loop, see ControlLoop.stats."""
+        return self.control_loop.stats()
@@ -7,6 +7,7 @@ import time
 from wheelchair_base import WheelchairController
 
 from util import ConnectionState
+import tracing
 
 class WheelchairDummy(WheelchairController):
     """Dummy wheelchair controller.
@@ -51,5 +52,6 @@ class WheelchairDummy(WheelchairController):
             self.turn = self.neutral
 
             print('Write, value: ', cmd)
+            tracing.finish(self.trace, 'written')
             return True
         return False
@@ -0,0 +1,253 @@
+""" Serial interface to wheelchair
+
+This module implements a wired serial (USB CDC) connection to the
+Arduino controlling the wheelchair.
+
+Commands are sent as frames of 5 bytes:
+
+    0xAA 0x55 drive turn crc
+
+where crc is the CRC-8 (polynomial 0x07, initial value 0) of drive and
+turn. The two header bytes let the Arduino find the start of a frame
+again if bytes are lost, and frames with a wrong CRC are dropped.
+Unlike a sum, the CRC also catches drive and turn swapped, and all
+errors in a single byte or in two adjacent bits. The Arduino parses
+the frames in the same format in enjaksakavella.ino.
+"""
+
+import os
+import json
+
+from PySide2.QtCore import Signal, Slot
+
+from wheelchair_base import WheelchairController
+from command_mailbox import MailboxWriter
+from control_loop import ControlLoop
+from util import ConnectionState
+
+FRAME_HEADER = b'\xaa\x55'
+FRAME_LENGTH = len(FRAME_HEADER) + 3
+CRC_POLYNOMIAL = 0x07
+# Seconds to wait for the writer thread to stop when disconnecting.
+WRITER_STOP_TIMEOUT = 1.0
+
+def crc8(data):
+    """Return CRC-8 of bytes (int)."""
+    crc = 0
+    for byte in data:
+        crc ^= byte
+        for _ in range(8):
+            if crc & 0x80:
+                crc = ((crc << 1) ^ CRC_POLYNOMIAL) & 0xFF
+            else:
+                crc = (crc << 1) & 0xFF
+    return crc
+
+
+def encode_frame(drive, turn):
+    """Return frame of a command (bytes)."""
+    return FRAME_HEADER + bytes((drive, turn, crc8((drive, turn))))
+
+
+class FrameParser:
+    """Find commands in bytes received, like the Arduino does.
+
+    Bytes are fed as they arrive, and frames may be split between
+    feeds. Used for checking what the Arduino would receive.
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self.dropped = 0
+
+    def feed(self, data):
+        """Parse received bytes.
+
+        Returns list of commands (drive, turn) of complete frames.
+        """
+        self._buffer += data
+        commands = []
+        while True:
+            start = self._buffer.find(FRAME_HEADER)
+            if start < 0:
+                # Keep a possible first byte of the header.
+                del self._buffer[:max(0, len(self._buffer) - 1)]
+                return commands
+            del self._buffer[:start]
+            if len(self._buffer) < FRAME_LENGTH:
+                return commands
+            drive, turn, crc = self._buffer[2:FRAME_LENGTH]
+            if crc8((drive, turn)) == crc:
+                commands.append((drive, turn))
+                del self._buffer[:FRAME_LENGTH]
+            else:
+                # Not a frame after all, search from the next byte.
+                self.dropped += 1
+                del self._buffer[:1]
+
+
+class WheelchairSerial(WheelchairController):
+    """Serial adapter for controlling the wheelchair.
+
+    Connects to an Arduino controlling the wheelchair through a serial
+    port, usually its USB connection.
+
+    Port and baud rate are loaded from config_serial.JSON, as well as
+    rate, setpoint timeout and priority of the control loop like for
+    the Bluetooth adapter (see WheelchairBluetooth). Frames are
+    written without blocking by a writer thread (see
+    command_mailbox.MailboxWriter), which always sends the newest
+    command. A frame is dropped if the serial output buffer is full,
+    since a newer one follows soon.
+
+    Needs pyserial, which is imported only when connecting, so
+    the other adapters work without it.
+
+    Can be tried without an Arduino with a pseudo-terminal pair, see
+    benchmark.py serial.
+
+    Arguments:
+    port -- Serial port, overrides the one in the config file (str).
+    """
+
+    name = "Serial wheelchair"
+    link_lost = Signal()
+
+    def __init__(self, port=None):
+        super().__init__()
+
+        with open("resources/config_serial.JSON") as config_file:
+            config = json.load(config_file)
+
+            self.port_name = port or config["port"]
+            self.baudrate = config["baudrate"]
+            control_rate = config["control_rate"]
+            setpoint_timeout = config["setpoint_timeout"]
+            control_priority = config["control_priority"]
+
+        self.port = None
+        self.writer = None
+        # Frames not written because the output buffer was full.
+        self.dropped = 0
+
+        neutral = self._transform_input(self.neutral)
+        self.control_loop = ControlLoop(
+            self._send, [neutral, neutral], rate=control_rate,
+            timeout=setpoint_timeout, priority=control_priority,
+            name="serial-control-loop")
+
+        self.link_lost.connect(self.disconnect_chair)
+
+    def __str__(self):
+        return "Serial wheelchair"
+
+    def __del__(self):
+        self.control_loop.stop()
+
+    def connect_chair(self):
+        if self.port is not None:
+            return
+        # pyserial is needed only when this adapter is used.
+        try:
+            import serial
+        except ImportError:
+            print("Serial connection needs pyserial, which is not installed.")
+            self.set_connection_status(ConnectionState.DISCONNECTED)
+            return
+        try:
+            self.port = serial.Serial(self.port_name, self.baudrate,
+                                      timeout=0, write_timeout=0)
+        except serial.SerialException as err:
+            print("Opening serial port {} failed: {}".format(self.port_name, err))
+            self.set_connection_status(ConnectionState.DISCONNECTED)
+            return
+        # Output of the Arduino from before the connection is not
+        # interesting.
+        self.port.reset_input_buffer()
+        self.writer = MailboxWriter(self._write_frame, name="serial-writer")
+        self.set_connection_status(ConnectionState.CONNECTED)
+
+    @Slot()
+    def disconnect_chair(self):
+        if self.port is None:
+            return
+        self.set_connection_status(ConnectionState.DISCONNECTED)
+        self.writer.stop(WRITER_STOP_TIMEOUT)
+        self.writer = None
+        try:
+            neutral = self._transform_input(self.neutral)
+            self._write_nonblocking(encode_frame(neutral, neutral))
+        except OSError:
+            # Includes serial.SerialException.
+            pass
+        self.port.close()
+        self.port = None
+
+    @Slot(bool)
+    def set_connection_status(self, status):
+        """Run the control loop only while connected."""
+        super().set_connection_status(status)
+        if status == ConnectionState.CONNECTED:
+            self.control_loop.start()
+        else:
+            self.control_loop.stop()
+
+    def write(self):
+        """Set driving command sent to wheelchair by the control loop."""
+        self.control_loop.set_setpoint([self.drive, self.turn], self.trace)
+
+    def set_input_period(self, period):
+        """Fit setpoint timeout to the controller, see ControlLoop.set_input_period."""
+        self.control_loop.set_input_period(period)
+
+    def _send(self, cmd, trace):
+        """Give command to the writer, in the control loop thread."""
+        self.command_changed.emit(cmd[0], cmd[1])
+        writer = self.writer
+        if writer is not None:
+            writer.post(cmd, trace)
+
+    def _write_frame(self, cmd):
+        """Write frame of command to the port, in the writer thread."""
+        frame = encode_frame(cmd[0], cmd[1])
+        try:
+            written = self._write_nonblocking(frame)
+            if written < len(frame):
+                # The Arduino skips the partial frame and resyncs.
+                # Output it sent before that is discarded too.
+                self.dropped += 1
+                self.port.reset_input_buffer()
+        except OSError:
+            # Unplugged, serial.SerialException included. Disconnect
+            # in the Qt thread.
+            self.link_lost.emit()
+            raise
+
+    def _write_nonblocking(self, data):
+        """Write what fits to the output buffer right away.
+
+        pyserial retries in a busy loop on POSIX when the buffer is
+        full, even with zero write timeout, so the file descriptor
+        (opened non-blocking by pyserial) is written directly there.
+
+        Returns number of bytes written.
+        """
+        if not hasattr(self.port, "fileno"):
+            # Writes with zero timeout do not wait on Windows.
+            return self.port.write(data)
+        try:
+            return os.write(self.port.fileno(), data)
+        except BlockingIOError:
+            return 0
+
+    def write_stats(self):
+        """Return statistics of the writes, see MailboxWriter.stats."""
+        if self.writer is None:
+            return {}
+        stats = self.writer.stats()
+        stats['dropped'] = self.dropped
+        return stats
+
+    def control_stats(self):
+        """Return statistics of the control loop, see ControlLoop.stats."""
+        return self.control_loop.stats()
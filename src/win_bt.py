@@ -6,11 +6,12 @@ Stub. Does nothing with bluetooth.
 from PySide2.QtCore import Slot, Signal, QObject
 
 from util import ConnectionState
+import tracing
 
 class BLEHelper(QObject):
     connection_status = Signal(ConnectionState)
 
-    def __init__(self, bt_adapter, bt_address, bt_uuid):
+    def __init__(self, bt_adapter, bt_address, bt_uuid, **options):
         super().__init__()
         self.connected = ConnectionState.DISCONNECTED
 
@@ -23,6 +24,13 @@ class BLEHelper(QObject):
         self.connected = ConnectionState.DISCONNECTED
         self.connection_status.emit(self.connected)
 
-    def write_characteristic(self, cmd):
+    def write_stats(self):
+        return {}
+
+    def link_stats(self):
+        return {}
+
+    def write_characteristic(self, cmd, trace=None):
         if self.connected == ConnectionState.CONNECTED:
-            print(cmd)
\ No newline at end of file
+            print(cmd)
+            tracing.finish(trace, 'written')
\ No newline at end of file
@@ -0,0 +1,6 @@
+"""Make the modules in src importable like when running main.py."""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, 'src'))
@@ -0,0 +1,160 @@
+"""Tests for writing to and discovering the simulated wheelchair.
+
+BLEHelper is run against ble_simulator.FakeBus, so no Bluetooth
+hardware is needed, but pydbus and python3-gi are.
+"""
+
+import time
+
+import pytest
+
+pytest.importorskip('gi')
+pytest.importorskip('pydbus')
+
+from gi.repository import GLib
+
+import bluez_dbus
+from bluez_dbus import BLEHelper
+from ble_simulator import SimulatedPeripheral, FakeBus, SERVICE_UUID, DRIVE_UUID
+
+ADDRESS = '00:00:00:00:00:01'
+WITHOUT_RESPONSE = ('read', 'write', 'write-without-response')
+
+
+@pytest.fixture(autouse=True)
+def gatt_cache(tmp_path, monkeypatch):
+    """Keep characteristic paths out of the resources directory."""
+    monkeypatch.setattr(bluez_dbus, 'GATT_CACHE_FILE', str(tmp_path / 'gatt_cache.JSON'))
+
+
+def connected_peripheral(flags=WITHOUT_RESPONSE):
+    """Return peripheral already discovered and connected."""
+    peripheral = SimulatedPeripheral(ADDRESS, flags=flags)
+    peripheral.discovered = True
+    peripheral.connect()
+    return peripheral
+
+
+def wait_writes(peripheral, count, timeout=2.0):
+    """Wait until the peripheral has received count commands."""
+    deadline = time.monotonic() + timeout
+    while len(peripheral.writes) < count and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return [data for _, data in peripheral.writes]
+
+
+def test_write_value_command():
+    peripheral = connected_peripheral()
+    characteristic = FakeBus(peripheral).get('org.bluez', peripheral.characteristic_path)
+    characteristic.WriteValue([1, 2], {'type': GLib.Variant('s', 'command')})
+    assert peripheral.value == b'\x01\x02'
+
+
+def test_write_value_options_must_be_variants():
+    peripheral = connected_peripheral()
+    characteristic = FakeBus(peripheral).get('org.bluez', peripheral.characteristic_path)
+    with pytest.raises(TypeError):
+        characteristic.WriteValue([1, 2], {'type': 'command'})
+    assert peripheral.writes == []
+
+
+def test_write_value_command_not_supported():
+    peripheral = connected_peripheral(flags=('read', 'write'))
+    characteristic = FakeBus(peripheral).get('org.bluez', peripheral.characteristic_path)
+    with pytest.raises(GLib.Error) as error:
+        characteristic.WriteValue([1, 2], {'type': GLib.Variant('s', 'command')})
+    assert str(error.value) == ("g-io-error-quark: "
+                                "GDBus.Error:org.bluez.Error.NotSupported: "
+                                "Operation is not supported (36)")
+
+
+def test_acquire_write():
+    peripheral = SimulatedPeripheral(ADDRESS, flags=WITHOUT_RESPONSE,
+                                     advertising_interval=0.01)
+    helper = BLEHelper('hci0', ADDRESS, DRIVE_UUID, bus=FakeBus(peripheral),
+                       service_uuid=SERVICE_UUID, acquire_write=True)
+    helper.bt_connect()
+    try:
+        assert helper.write_socket is not None
+        assert helper.write_stats()['acquired']
+        helper.write_characteristic([130, 128])
+        assert wait_writes(peripheral, 1) == [bytes((130, 128))]
+    finally:
+        helper.bt_disconnect()
+    assert helper.write_socket is None
+
+
+def test_write_value_without_response():
+    peripheral = SimulatedPeripheral(ADDRESS, flags=WITHOUT_RESPONSE,
+                                     advertising_interval=0.01)
+    helper = BLEHelper('hci0', ADDRESS, DRIVE_UUID, bus=FakeBus(peripheral),
+                       service_uuid=SERVICE_UUID, acquire_write=False)
+    helper.bt_connect()
+    try:
+        assert helper.write_socket is None
+        assert helper.write_stats()['without_response']
+        helper.write_characteristic([120, 140])
+        assert wait_writes(peripheral, 1) == [bytes((120, 140))]
+    finally:
+        helper.bt_disconnect()
+
+
+def test_write_value_with_response_when_not_supported():
+    peripheral = SimulatedPeripheral(ADDRESS, flags=('read', 'write'),
+                                     advertising_interval=0.01)
+    helper = BLEHelper('hci0', ADDRESS, DRIVE_UUID, bus=FakeBus(peripheral),
+                       service_uuid=SERVICE_UUID)
+    helper.bt_connect()
+    try:
+        assert helper.write_socket is None
+        assert not helper.write_stats()['without_response']
+        helper.write_characteristic([128, 128])
+        assert wait_writes(peripheral, 1) == [bytes((128, 128))]
+    finally:
+        helper.bt_disconnect()
+
+
+def test_discovery_from_interfaces_added_with_filter():
+    peripheral = SimulatedPeripheral(ADDRESS, flags=WITHOUT_RESPONSE,
+                                     advertising_interval=0.05)
+    helper = BLEHelper('hci0', ADDRESS, DRIVE_UUID, bus=FakeBus(peripheral),
+                       service_uuid=SERVICE_UUID.upper())
+    start = time.monotonic()
+    helper.bt_connect()
+    try:
+        # Found from the signal, without waiting for the next poll.
+        assert time.monotonic() - start < bluez_dbus.DISCOVERY_POLL
+        assert peripheral.discovered
+        assert not peripheral.discovering
+        discovery_filter = peripheral.discovery_filter
+        assert discovery_filter['UUIDs'].unpack() == [SERVICE_UUID]
+        assert discovery_filter['Transport'].unpack() == 'le'
+        assert helper.connected == bluez_dbus.ConnectionState.CONNECTED
+    finally:
+        helper.bt_disconnect()
+
+
+def test_discovery_filter_excludes_other_services():
+    peripheral = SimulatedPeripheral(ADDRESS, advertising_interval=0.01)
+    adapter = FakeBus(peripheral).get('org.bluez', peripheral.adapter_path)
+    added = []
+    peripheral.interfaces_added.connect(lambda path, interfaces: added.append(path))
+    adapter.SetDiscoveryFilter({'UUIDs': GLib.Variant('as', ['0000180d-0000-1000-8000-00805f9b34fb'])})
+    adapter.StartDiscovery()
+    time.sleep(0.1)
+    adapter.StopDiscovery()
+    assert added == []
+    assert not peripheral.discovered
+
+
+def test_known_device_is_not_discovered_again():
+    peripheral = SimulatedPeripheral(ADDRESS, flags=WITHOUT_RESPONSE)
+    peripheral.discovered = True
+    helper = BLEHelper('hci0', ADDRESS, DRIVE_UUID, bus=FakeBus(peripheral),
+                       service_uuid=SERVICE_UUID)
+    helper.bt_connect()
+    try:
+        assert peripheral.discovery_filter == {}
+        assert helper.connected == bluez_dbus.ConnectionState.CONNECTED
+    finally:
+        helper.bt_disconnect()
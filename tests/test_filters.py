@@ -0,0 +1,114 @@
+"""Tests for filter stages in filters.py."""
+
+import pytest
+
+from filters import FilterChain, Median, OneEuro, RateLimiter
+
+
+def test_rate_limiter_accelerates_at_limited_rate():
+    limiter = RateLimiter(accelerate=100.0)
+    assert limiter(0.0, 0.0) == 0.0
+    assert limiter(100.0, 0.1) == pytest.approx(10.0)
+    assert limiter(100.0, 0.2) == pytest.approx(20.0)
+
+
+def test_rate_limiter_stops_right_away_without_deceleration_limit():
+    limiter = RateLimiter(accelerate=100.0)
+    limiter(0.0, 0.0)
+    limiter(100.0, 10.0)
+    assert limiter(0.0, 10.01) == 0.0
+
+
+def test_rate_limiter_decelerates_at_limited_rate():
+    limiter = RateLimiter(accelerate=100.0, decelerate=1000.0)
+    limiter(0.0, 0.0)
+    assert limiter(100.0, 10.0) == 100.0
+    assert limiter(50.0, 10.02) == pytest.approx(80.0)
+    assert limiter(50.0, 10.1) == pytest.approx(50.0)
+
+
+def test_rate_limiter_reverses_like_starting():
+    limiter = RateLimiter(accelerate=1000.0)
+    limiter(0.0, 0.0)
+    assert limiter(100.0, 1.0) == 100.0
+    # Stops right away, then accelerates for the whole period.
+    assert limiter(-100.0, 1.01) == pytest.approx(-10.0)
+
+
+def test_rate_limiter_reverses_through_zero_with_time_left():
+    limiter = RateLimiter(accelerate=1000.0, decelerate=10000.0)
+    limiter(0.0, 0.0)
+    limiter(100.0, 1.0)
+    # 10 ms to stop, 10 ms to accelerate the other way.
+    assert limiter(-100.0, 1.02) == pytest.approx(-10.0)
+
+
+def test_rate_limiter_does_not_cross_zero_while_decelerating():
+    limiter = RateLimiter(accelerate=1000.0, decelerate=1000.0)
+    limiter(0.0, 0.0)
+    limiter(100.0, 1.0)
+    assert limiter(-100.0, 1.05) == pytest.approx(50.0)
+
+
+def test_one_euro_starts_from_first_value():
+    one_euro = OneEuro(min_cutoff=1.0, beta=0.0)
+    assert one_euro(5.0, 0.0) == 5.0
+    assert one_euro(5.0, 0.1) == pytest.approx(5.0)
+
+
+def test_one_euro_smooths_step():
+    one_euro = OneEuro(min_cutoff=1.0, beta=0.0)
+    one_euro(0.0, 0.0)
+    value = one_euro(100.0, 0.01)
+    assert 0.0 < value < 100.0
+
+
+def test_one_euro_follows_fast_changes_with_beta():
+    slow = OneEuro(min_cutoff=1.0, beta=0.0)
+    fast = OneEuro(min_cutoff=1.0, beta=1.0)
+    for filt in (slow, fast):
+        filt(0.0, 0.0)
+    for step in range(1, 10):
+        slow_value = slow(100.0 * step, 0.01 * step)
+        fast_value = fast(100.0 * step, 0.01 * step)
+    assert fast_value > slow_value
+
+
+def test_one_euro_ignores_value_without_time_passing():
+    one_euro = OneEuro()
+    one_euro(1.0, 1.0)
+    assert one_euro(50.0, 1.0) == 1.0
+
+
+def test_median_removes_single_spike():
+    median = Median(size=3)
+    values = [median(value, index) for index, value in enumerate([1, 1, 100, 1, 1])]
+    assert 100 not in values
+    assert values[-1] == 1
+
+
+def test_median_of_last_values():
+    median = Median(size=3)
+    assert median(1) == 1
+    assert median(3) == 2
+    assert median(2) == 2
+    # 1 is dropped from the window.
+    assert median(5) == 3
+
+
+def test_filter_chain_from_config():
+    chain = FilterChain.from_config([
+        {'type': 'median', 'size': 3},
+        {'type': 'dead_zone', 'width': 10}])
+    assert chain(5.0, 0.0) == 0
+    assert chain(50.0, 0.1) == pytest.approx(27.5)
+
+
+def test_filter_chain_rejects_unknown_stage():
+    with pytest.raises(ValueError):
+        FilterChain.from_config([{'type': 'unknown'}])
+
+
+def test_configure_rejects_unknown_parameter():
+    with pytest.raises(ValueError):
+        RateLimiter().configure(speed=1.0)
@@ -0,0 +1,65 @@
+"""Tests for serial frames in wheelchair_serial.py."""
+
+from wheelchair_serial import FRAME_HEADER, FRAME_LENGTH, FrameParser, \
+    crc8, encode_frame
+
+
+def test_crc8_check_value():
+    # Standard check value of CRC-8 with polynomial 0x07.
+    assert crc8(b'123456789') == 0xF4
+
+
+def test_encode_frame():
+    frame = encode_frame(130, 120)
+    assert len(frame) == FRAME_LENGTH
+    assert frame[:2] == FRAME_HEADER
+    assert frame[2:4] == bytes((130, 120))
+    assert frame[4] == crc8((130, 120))
+
+
+def test_parse_frames():
+    commands = [(0, 0), (255, 255), (0xAA, 0x55), (128, 128)]
+    data = b''.join(encode_frame(*cmd) for cmd in commands)
+    parser = FrameParser()
+    assert parser.feed(data) == commands
+    assert parser.dropped == 0
+
+
+def test_parse_frames_split_anywhere():
+    commands = [(0xAA, 0x55), (10, 200), (0x55, 0xAA)]
+    data = b''.join(encode_frame(*cmd) for cmd in commands)
+    for split in range(len(data) + 1):
+        parser = FrameParser()
+        assert parser.feed(data[:split]) + parser.feed(data[split:]) == commands
+
+
+def test_parse_skips_other_bytes():
+    data = b'debug output\n' + encode_frame(1, 2) + b'\xaa\xaa' + encode_frame(3, 4)
+    assert FrameParser().feed(data) == [(1, 2), (3, 4)]
+
+
+def test_corrupted_frame_is_dropped():
+    frame = bytearray(encode_frame(100, 150))
+    frame[3] ^= 0x01
+    parser = FrameParser()
+    assert parser.feed(bytes(frame) + encode_frame(1, 2)) == [(1, 2)]
+    assert parser.dropped == 1
+
+
+def test_swapped_drive_and_turn_is_dropped():
+    frame = encode_frame(100, 150)
+    swapped = frame[:2] + bytes((frame[3], frame[2], frame[4]))
+    assert FrameParser().feed(swapped) == []
+
+
+def test_resync_after_partial_frame():
+    # Frame cut short, the next one follows right after its header.
+    data = encode_frame(0xAA, 0x55)[:3] + encode_frame(7, 8)
+    assert FrameParser().feed(data) == [(7, 8)]
+
+
+def test_resync_to_header_inside_corrupted_frame():
+    data = FRAME_HEADER + encode_frame(5, 6)
+    parser = FrameParser()
+    assert parser.feed(data) == [(5, 6)]
+    assert parser.dropped == 1